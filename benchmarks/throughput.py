@@ -0,0 +1,321 @@
+"""End-to-end throughput benchmark of the grid search master and workers.
+
+Every run submits a task through the Flask routes (/add_resource, /add_task), lets the task controller
+validate, materialize and dispatch it, executes the subtasks and polls /task_info until the task is
+finished. One JSON document with a record per run is written to stdout or to --output.
+
+mongo_ops counts the commands the master sends, or the mongomock collection calls, which in eager mode
+include the subtasks' writes. With a real mongod, server_ops is the serverStatus opcounters delta of
+the run: every client counts, so worker writes are included along with the broker's polling.
+
+Three execution modes are supported:
+
+    eager   Celery runs every batch inline in the task controller thread and the in-memory broker
+            carries task changed events. Works with mongomock, no services needed; master CPU
+            includes the subtasks themselves.
+    broker  Subtasks go through the broker to --workers worker processes started by the benchmark.
+            Needs a real mongod (--mongo mongodb://...) shared by the master and the workers.
+    local   Subtasks run on processes spawned by the master (TaskController.backend = 'local')
+            with --workers processes, no broker. Needs a real mongod as well.
+
+    python benchmarks/throughput.py --mongo mongomock --grid-sizes 1000,10000
+    python benchmarks/throughput.py --mode broker --mongo mongodb://localhost/dgs-bench --workers 1,4
+    python benchmarks/throughput.py --mode local --mongo mongodb://localhost/dgs-bench --workers 8
+"""
+import argparse
+import base64
+import io
+import json
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+SCRIPT = '''
+import time
+
+import numpy as np
+from sklearn.base import BaseEstimator, ClassifierMixin
+
+
+class Estimator(BaseEstimator, ClassifierMixin):
+    def __init__(self, alpha=0, fit_time=0.):
+        self.alpha = alpha
+        self.fit_time = fit_time
+
+    def fit(self, X, y):
+        if self.fit_time:
+            time.sleep(self.fit_time)
+        self.classes_ = np.unique(y)
+        return self
+
+    def predict(self, X):
+        return np.full(len(X), self.classes_[0])
+
+
+X = resources['data']['X']
+y = resources['data']['y']
+param_grid = {{'alpha': list(range({grid_size})), 'fit_time': [{fit_time}]}}
+cv = {cv}
+'''
+
+
+class CommandCounter:
+    """Counts the commands pymongo sends, a stand-in for Mongo ops."""
+
+    def __init__(self):
+        self.commands = Counter()
+        self._lock = threading.Lock()
+
+    def started(self, event):
+        with self._lock:
+            self.commands[event.command_name] += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+    def reset(self):
+        with self._lock:
+            self.commands.clear()
+
+    def patch_mongomock(self):
+        """mongomock has no command monitoring, count the collection calls instead."""
+        from mongomock.collection import Collection
+
+        def counted(name, method):
+            def wrapper(*args, **kwargs):
+                with self._lock:
+                    self.commands[name] += 1
+                return method(*args, **kwargs)
+            return wrapper
+
+        for name in mongomock_operations:
+            if hasattr(Collection, name):
+                setattr(Collection, name, counted(name, getattr(Collection, name)))
+
+
+mongomock_operations = ('find', 'find_one', 'insert_one', 'insert_many', 'update_one', 'update_many', 'replace_one',
+                        'bulk_write', 'find_one_and_update', 'find_one_and_delete', 'delete_one', 'delete_many',
+                        'count_documents', 'estimated_document_count', 'distinct', 'aggregate')
+opcounters = ('insert', 'query', 'update', 'delete', 'getmore', 'command')
+
+
+def get_server_ops():
+    """Operations the mongod served to every client, the workers and the broker included."""
+    from dgs.gsserver.db.gstask import GSTask
+    counters = GSTask._get_db().command('serverStatus')['opcounters']
+    return {name: counters[name] for name in opcounters}
+
+
+def configure(args):
+    from dgs.gsserver.conf import conf
+
+    if args.mongo == 'mongomock':
+        import mongomock
+        conf.Mongo.connection = {'host': 'mongodb://localhost/dgs-bench', 'mongo_client_class': mongomock.MongoClient}
+    else:
+        conf.Mongo.connection = {'host': args.mongo}
+    broker_url = args.mongo if args.mode == 'broker' else 'memory://'
+    conf.Celery.conf.update({'BROKER_URL': broker_url, 'CELERY_ALWAYS_EAGER': args.mode == 'eager',
+                             'CELERY_RESULT_BACKEND': None})
+    conf.TaskController.n_workers = max(args.workers)
+    conf.TaskController.backend = 'local' if args.mode == 'local' else 'celery'
+    conf.TaskController.local_workers = args.workers[0]
+    conf.TaskController.isolate_validation = args.mongo != 'mongomock'
+    conf.TaskController.use_result_cache = False
+    conf.Worker.metrics_port = None
+    conf.Worker.write_buffer_size = args.write_buffer_size
+    conf.Worker.write_flush_interval = args.write_flush_interval
+    return conf
+
+
+def run_worker(args):
+    configure(args)
+    from dgs.gsserver.worker import run_worker as run
+    run(['--concurrency={}'.format(args.concurrency), '--hostname=bench{}@%h'.format(os.getpid()),
+         '--loglevel=warning'])
+
+
+def get_resource(n_rows, n_features):
+    random_state = np.random.RandomState(0)
+    content = io.BytesIO()
+    np.savez(content, X=random_state.rand(n_rows, n_features), y=random_state.randint(2, size=n_rows))
+    return base64.b64encode(content.getvalue()).decode('ascii')
+
+
+def get_json(response):
+    return json.loads(response.data.decode('utf8'))
+
+
+def post_json(client, url, data):
+    return get_json(client.post(url, data=json.dumps(data), content_type='application/json'))
+
+
+def reset_database():
+    from dgs.gsserver.db.indexes import documents
+    for document in documents:
+        document.drop_collection()
+
+
+def get_cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def wait_for_task(client, title, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        items = get_json(client.get('/task_info', query_string={'q': title, 'total': 'none'}))['tasks']['items']
+        if items and items[0]['state'] in ('SUCCESS', 'FAILED', 'CANCELED'):
+            return items[0]
+        time.sleep(0.05)
+    return items[0] if items else None
+
+
+def run_benchmark(args, client, task_controller, commands, grid_size, n_workers):
+    from dgs.gsserver.db.subtask_writer import subtask_writer
+
+    reset_database()
+    response = post_json(client, '/add_resource', {'file': get_resource(args.resource_rows, args.resource_features),
+                                                   'format': 'npz', 'title': 'bench-data'})
+    title = 'bench-{}-{}-{}'.format(grid_size, n_workers, time.time())
+    script = SCRIPT.format(grid_size=grid_size, fit_time=args.fit_time, cv=args.cv)
+
+    task_controller.propagation_latency.reset()
+    subtask_writer.n_writes.reset()
+    commands.reset()
+    server_ops_start = get_server_ops() if args.mongo != 'mongomock' else None
+    cpu_start, start = get_cpu_time(), time.time()
+    post_json(client, '/add_task', {'file': script, 'title': title, 'resources': {'data': response['resource_id']}})
+    task = wait_for_task(client, title, args.timeout)
+    elapsed, cpu_time = time.time() - start, get_cpu_time() - cpu_start
+
+    n_completed = task['n_completed'] if task else 0
+    n_ops = sum(commands.commands.values())
+    server_ops = None
+    if server_ops_start is not None:
+        server_ops = {name: count - server_ops_start[name] for name, count in get_server_ops().items()}
+    n_server_ops = sum(server_ops.values()) if server_ops is not None else None
+    return {
+        'mode': args.mode, 'grid_size': grid_size, 'n_workers': n_workers, 'cv': args.cv,
+        'resource_rows': args.resource_rows, 'resource_features': args.resource_features,
+        'fit_time': args.fit_time, 'state': task['state'] if task else None, 'n_completed': n_completed,
+        'elapsed_seconds': elapsed, 'subtasks_per_second': n_completed / elapsed if elapsed else None,
+        'master_cpu_seconds': cpu_time,
+        'mongo_ops': n_ops, 'mongo_ops_per_subtask': n_ops / n_completed if n_completed else None,
+        'mongo_ops_by_command': dict(commands.commands),
+        'server_ops': n_server_ops,
+        'server_ops_per_subtask': n_server_ops / n_completed if n_server_ops is not None and n_completed else None,
+        'server_ops_by_type': server_ops,
+        'write_buffer_size': args.write_buffer_size,
+        'subtask_writes_per_subtask': subtask_writer.n_writes.value / n_completed
+        if args.mode == 'eager' and n_completed else None,
+        'propagation_latency': task_controller.propagation_latency.to_json(),
+    }
+
+
+def start_workers(args, n_workers):
+    return [subprocess.Popen([sys.executable, os.path.abspath(__file__), 'worker', '--mongo', args.mongo,
+                              '--concurrency', '1', '--write-buffer-size', str(args.write_buffer_size),
+                              '--write-flush-interval', str(args.write_flush_interval)]) for _ in range(n_workers)]
+
+
+def stop_workers(workers):
+    for worker in workers:
+        worker.terminate()
+    for worker in workers:
+        worker.wait()
+
+
+def run(args):
+    commands = CommandCounter()
+    if args.mongo != 'mongomock':
+        from pymongo import monitoring
+        monitoring.register(commands)
+    else:
+        commands.patch_mongomock()
+    conf = configure(args)
+
+    from dgs.gsserver import daemon
+    from dgs.gsserver.celeryapp import init_celery_app
+    from dgs.gsserver.db import init_mongodb
+    from dgs.gsserver.db.indexes import ensure_indexes
+
+    init_celery_app(conf.Celery.conf)
+    init_mongodb(conf.Mongo.connection)
+    if args.mongo != 'mongomock':
+        ensure_indexes()
+    daemon.task_controller.daemon = daemon.resource_controller.daemon = True
+    daemon.task_controller.start()
+    daemon.resource_controller.start()
+    client = daemon.app.test_client()
+
+    results = []
+    try:
+        for n_workers in args.workers if args.mode == 'broker' else args.workers[:1]:
+            workers = start_workers(args, n_workers) if args.mode == 'broker' else []
+            try:
+                for grid_size in args.grid_sizes:
+                    result = run_benchmark(args, client, daemon.task_controller, commands, grid_size, n_workers)
+                    results.append(result)
+                    print('grid_size={grid_size} n_workers={n_workers}: {subtasks_per_second:.1f} subtasks/s'.format(
+                        **result), file=sys.stderr)
+            finally:
+                stop_workers(workers)
+    finally:
+        if args.mode == 'local':
+            daemon.local_backend.stop()
+
+    output = json.dumps({'results': results}, indent=2, default=str)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+def parse_ints(value):
+    return [int(x) for x in value.split(',')]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', nargs='?', default='run', choices=('run', 'worker'),
+                        help='worker is used by the benchmark to start its own workers')
+    parser.add_argument('--mode', default='eager', choices=('eager', 'broker', 'local'))
+    parser.add_argument('--mongo', default='mongomock', help='mongomock or a MongoDB URI')
+    parser.add_argument('--grid-sizes', type=parse_ints, default=[1000, 10000])
+    parser.add_argument('--workers', type=parse_ints, default=[1],
+                        help='worker processes of broker mode, the first one sizes the local pool')
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--resource-rows', type=int, default=1000)
+    parser.add_argument('--resource-features', type=int, default=10)
+    parser.add_argument('--fit-time', type=float, default=0., help='seconds every fit sleeps')
+    parser.add_argument('--cv', type=int, default=3)
+    parser.add_argument('--write-buffer-size', type=int, default=256,
+                        help='subtask updates a worker buffers before writing them, 1 writes every subtask')
+    parser.add_argument('--write-flush-interval', type=float, default=5)
+    parser.add_argument('--timeout', type=float, default=3600)
+    parser.add_argument('--output', help='file for the JSON results, stdout by default')
+    args = parser.parse_args()
+    if args.mode != 'eager' and args.mongo == 'mongomock':
+        parser.error('{} mode needs a real MongoDB shared with the workers'.format(args.mode))
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.command == 'worker':
+        run_worker(args)
+    else:
+        run(args)
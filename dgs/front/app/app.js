@@ -22,7 +22,7 @@ taskApp.controller('navbarController', function ($scope, $location) {
 
 });
 
-taskApp.controller('taskController', function ($scope, $http, $interval, $log) {
+taskApp.controller('taskController', function ($scope, $http, $interval, $timeout, $log) {
     $scope.list = {
         items: []
     };
@@ -37,7 +37,8 @@ taskApp.controller('taskController', function ($scope, $http, $interval, $log) {
             'Failed',
             'Success',
             'Cancelled',
-            'Pending'
+            'Pending',
+            'Validating'
         ],
         sort: [
             'Date'
@@ -71,13 +72,74 @@ taskApp.controller('taskController', function ($scope, $http, $interval, $log) {
     };
 
 
+    $scope.events = undefined;
+
+    var eventsUrl;
+
+    var reload;
+
+    $scope.reloadSoon = function () {
+        if (!reload) {
+            reload = $timeout(function () {
+                reload = undefined;
+                $scope.update();
+            }, 1000);
+        }
+    };
+
+    // New tasks are listed first, only the first page of all or validating tasks shows them
+    $scope.showsNewTasks = function () {
+        return !$scope.params.offset && ($scope.params.state === 'All' || $scope.params.state === 'Validating');
+    };
+
+    // Subscribes to the tasks on the current page, and to new tasks when they would be listed on it
+    $scope.watch = function () {
+        var taskIds = $scope.list.items.map(function (task) {
+            return task.task_id;
+        });
+        var url = 'http://localhost:5000/task_events?task_id=' + encodeURIComponent(taskIds.join(',')) +
+            ($scope.showsNewTasks() ? '&new=1' : '');
+        if ($scope.events && url === eventsUrl) {
+            return;
+        }
+        if ($scope.events) {
+            $scope.events.close();
+            $scope.events = undefined;
+        }
+        eventsUrl = url;
+        if (!taskIds.length && !$scope.showsNewTasks()) {
+            return;
+        }
+        $scope.events = new EventSource(url);
+        $scope.events.addEventListener('task', function (e) {
+            var delta = JSON.parse(e.data);
+            $scope.$apply(function () {
+                var isKnown = false;
+                $scope.list.items.forEach(function (task) {
+                    if (task.task_id === delta.task_id) {
+                        angular.extend(task, delta);
+                        isKnown = true;
+                    }
+                });
+                // A new task, the reload subscribes to it
+                if (!isKnown) {
+                    $scope.reloadSoon();
+                }
+            });
+        });
+        $scope.events.addEventListener('resync', function () {
+            $scope.update();
+        });
+    };
+
     $scope.update = function () {
         $http({
             method: 'GET',
             url: 'http://localhost:5000/task_info',
             params: $scope.params
         }).then(function successCallback(response) {
-            $scope.list = response.data.tasks
+            $scope.list = response.data.tasks;
+            $scope.watch();
         }, function errorCallback(response) {
             $log.warn('error loading data')
         });
@@ -95,13 +157,20 @@ taskApp.controller('taskController', function ($scope, $http, $interval, $log) {
     };
 
     $scope.canCancel = function (state) {
-        return state == 'IDLE' || state == 'PENDING' || state == 'RUNNING';
+        return state == 'VALIDATING' || state == 'IDLE' || state == 'PENDING' || state == 'RUNNING';
     };
 
 
     $scope.update();
 
-    $interval($scope.update, 10000)
+    $scope.$on('$destroy', function () {
+        if ($scope.events) {
+            $scope.events.close();
+        }
+        if (reload) {
+            $timeout.cancel(reload);
+        }
+    });
 
 
 });
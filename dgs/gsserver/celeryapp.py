@@ -1,7 +1,13 @@
+import logging
+import time
 from multiprocessing import current_process
+from threading import Lock
 
 from celery import Celery
-from celery.signals import worker_process_init
+from celery.exceptions import Reject
+from celery.signals import celeryd_after_setup, task_postrun, worker_init, worker_process_init, worker_process_shutdown, worker_shutdown
+
+dataset_broker_manager = None
 
 
 @worker_process_init.connect
@@ -10,6 +16,98 @@ def fix_multiprocessing(**kwargs):
         current_process()._config = {'semprefix': '/mp'}
 
 
+@worker_init.connect
+def start_dataset_broker(**kwargs):
+    global dataset_broker_manager
+    from dgs.gsserver.conf import conf
+    from dgs.gsserver.dataset_broker import start_broker
+    from dgs.gsserver.exporter import start_exporter
+    if conf.Worker.share_datasets or conf.Worker.metrics_port:
+        dataset_broker_manager = start_broker()
+    if conf.Worker.metrics_port:
+        try:
+            start_exporter(dataset_broker_manager, conf.Worker.metrics_port)
+        except OSError:
+            logging.exception('can not start metrics exporter')
+
+
+@worker_process_init.connect
+def open_event_dispatcher(**kwargs):
+    # The dispatcher inherited from the parent shares its broker connection, open one per child
+    global _event_dispatcher, _event_lock
+    _event_dispatcher, _event_lock = None, Lock()
+    try:
+        _get_event_dispatcher()
+    except Exception:
+        logging.exception('can not open event dispatcher')
+
+
+@celeryd_after_setup.connect
+def add_worker_queue(sender=None, instance=None, **kwargs):
+    from dgs.gsserver.routing import get_worker_queue, set_worker_id
+    set_worker_id(sender)
+    instance.app.amqp.queues.select_add(get_worker_queue())
+
+
+@worker_init.connect
+def register_worker(sender=None, **kwargs):
+    from dgs.gsserver.routing import set_worker_id, start_heartbeat
+    if getattr(sender, 'hostname', None):
+        set_worker_id(sender.hostname)
+    start_heartbeat(getattr(sender, 'concurrency', None))
+
+
+@worker_process_init.connect
+def connect_worker_residency(**kwargs):
+    from dgs.gsserver.routing import worker_residency
+    worker_residency.connect()
+
+
+@worker_process_init.connect
+def connect_dataset_broker(**kwargs):
+    from dgs.gsserver.conf import conf
+    from dgs.gsserver.dataset_broker import shared_datasets
+    if conf.Worker.share_datasets:
+        shared_datasets.connect()
+
+
+@worker_process_init.connect
+def connect_metrics_reporter(**kwargs):
+    from dgs.gsserver.conf import conf
+    from dgs.gsserver.exporter import metrics_reporter
+    if conf.Worker.metrics_port:
+        metrics_reporter.connect()
+
+
+@task_postrun.connect
+def push_metrics(**kwargs):
+    from dgs.gsserver.exporter import metrics_reporter
+    metrics_reporter.push()
+
+
+@worker_process_shutdown.connect
+@worker_shutdown.connect
+def flush_subtask_updates(**kwargs):
+    from dgs.gsserver.db.subtask_writer import subtask_writer
+    try:
+        subtask_writer.flush()
+    except Exception:
+        logging.exception('can not flush subtask updates')
+
+
+@worker_process_shutdown.connect
+def flush_metrics(**kwargs):
+    from dgs.gsserver.exporter import metrics_reporter
+    metrics_reporter.push(force=True)
+
+
+@worker_shutdown.connect
+def stop_dataset_broker(**kwargs):
+    from dgs.gsserver.dataset_broker import stop_broker
+    if dataset_broker_manager is not None:
+        stop_broker(dataset_broker_manager)
+
+
 app = Celery()
 
 app.conf.update(
@@ -24,8 +122,86 @@ def init_celery_app(conf):
     return app
 
 
+TASK_CHANGED_EVENT = 'dgs-task-changed'
+
+
+_event_sink = None
+
+
+def set_event_sink(callback):
+    """Routes task changed events to `callback(task_id, event_time)` instead of Celery events."""
+    global _event_sink
+    _event_sink = callback
+
+
+_event_dispatcher = None
+_event_lock = Lock()
+
+
+def _get_event_dispatcher():
+    global _event_dispatcher
+    if _event_dispatcher is None:
+        _event_dispatcher = app.events.Dispatcher(app.connection())
+    return _event_dispatcher
+
+
+def _close_event_dispatcher():
+    global _event_dispatcher
+    dispatcher, _event_dispatcher = _event_dispatcher, None
+    if dispatcher is not None:
+        try:
+            dispatcher.close()
+            dispatcher.connection.release()
+        except Exception:
+            pass
+
+
+def send_task_changed_event(task_id):
+    if _event_sink is not None:
+        _event_sink(task_id, time.time())
+        return
+    with _event_lock:
+        try:
+            _get_event_dispatcher().send(TASK_CHANGED_EVENT, task_id=task_id, event_time=time.time())
+        except Exception:
+            logging.exception('can not send {} event for task {}'.format(TASK_CHANGED_EVENT, task_id))
+            _close_event_dispatcher()
+
+
+def _flush_subtask_writer():
+    # Called from the task body, before the late ack: a message whose results are still buffered is
+    # requeued rather than acknowledged. Signal handlers can not do it, Celery only logs what they raise.
+    from dgs.gsserver.db.subtask_writer import subtask_writer
+    try:
+        subtask_writer.flush()
+    except Exception as e:
+        logging.exception('can not flush subtask updates')
+        raise Reject(e, requeue=True)
+
+
 @app.task
 def run_subtask(id):
     from dgs.gsserver.db.gstask import GSSubtask
-    subtask = GSSubtask.objects.get(subtask_id=id)
-    subtask.execute()
+    try:
+        subtask = GSSubtask.objects.get(subtask_id=id)
+        subtask.execute()
+    finally:
+        _flush_subtask_writer()
+
+
+@app.task
+def run_subtasks(ids, parent_task_id=None):
+    from dgs.gsserver.db.gstask import GSSubtask
+    try:
+        GSSubtask.execute_batch(ids, parent_task_id)
+    finally:
+        _flush_subtask_writer()
+
+
+@app.task
+def run_subtask_folds(units, parent_task_id=None):
+    from dgs.gsserver.db.gstask import GSSubtask
+    try:
+        GSSubtask.execute_fold_batch(units, parent_task_id)
+    finally:
+        _flush_subtask_writer()
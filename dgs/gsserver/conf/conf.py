@@ -46,14 +46,32 @@ class Celery:
 
 
 class Master:
-    def __init__(self, host, port):
+    def __init__(self, host, port, count_cache_ttl=10, event_buffer_size=256, event_keepalive_interval=15,
+                 check_query_plans=False):
         self.host = host
         self.port = port
+        self.count_cache_ttl = count_cache_ttl
+        self.event_buffer_size = event_buffer_size
+        self.event_keepalive_interval = event_keepalive_interval
+        self.check_query_plans = check_query_plans
 
 
 class GSServerConf:
-    def __init__(self, mongo, celery, master, task_controller):
+    def __init__(self, mongo, celery, master, task_controller, worker, resource):
         self.Mongo = mongo
         self.Celery = celery
         self.Master = master
         self.TaskController = task_controller
+        self.Worker = worker
+        self.Resource = resource
+
+    def get_values(self):
+        """The settings of every section, for a spawned process which would start from the default conf."""
+        return {name: {key: value for key, value in vars(section).items() if not key.startswith('__')}
+                for name, section in vars(self).items()}
+
+    def set_values(self, values):
+        for name, section_values in values.items():
+            section = getattr(self, name)
+            for key, value in section_values.items():
+                setattr(section, key, value)
@@ -1,3 +1,6 @@
+import os
+import tempfile
+
 from dgs.gsserver.conf.conf import Celery, Mongo, Master, GSServerConf
 
 mongo_conf = {
@@ -10,17 +13,64 @@ mongo_conf = {
 
 master_conf = {
     'host': '::',
-    'port': 5000
+    'port': 5000,
+    'count_cache_ttl': 10,
+    'event_buffer_size': 256,
+    'event_keepalive_interval': 15,
+    'check_query_plans': False
 }
 
 
 class TaskControllerConfig:
-    tick_interval = 1
-    wait_task_add_event = False
+    tick_interval = 30
+    use_celery_events = True
+    event_coalesce_interval = 0.05
+    n_workers = 8
+    batches_per_worker = 4
+    max_batch_size = 256
+    materialization_window = 2000
+    max_queued_subtasks = 10000
+    use_result_cache = True
+    result_cache_ttl = 30 * 24 * 60 * 60
+    use_cost_model = True
+    cost_model_min_observations = 10
+    cost_model_max_observations = 1000
+    cost_model_probe_size = 50
+    use_affinity_routing = True
+    worker_timeout = 60
+    n_validators = 2
+    isolate_validation = True
+    validation_timeout = 300
+    validation_memory_limit = 4 * 1024 ** 3
+    max_pending_validations = 64
+    validation_cache_size = 1024
+    backend = 'celery'
+    local_workers = None
+
+
+class WorkerConfig:
+    script_cache_size = 4
+    script_cache_max_bytes = 2 * 1024 ** 3
+    spool_dir = os.path.join(tempfile.gettempdir(), 'dgs-spool')
+    share_datasets = True
+    dataset_broker_dir = os.path.join(spool_dir, 'brokers')
+    dataset_broker_reap_interval = 30
+    heartbeat_interval = 10
+    cancel_check_interval = 1
+    metrics_port = 9150
+    metrics_push_interval = 1
+    write_buffer_size = 256
+    write_flush_interval = 5
+
+
+class ResourceConfig:
+    codec = 'zlib'
+    chunk_size = 4 * 1024 ** 2
+    blob_reuse_grace = 600
 
 
 mongo = Mongo(**mongo_conf)
 master = Master(**master_conf)
 celery = Celery(mongo)
 
-conf = GSServerConf(mongo, celery, master, TaskControllerConfig)
+conf = GSServerConf(mongo, celery, master, TaskControllerConfig, WorkerConfig, ResourceConfig)
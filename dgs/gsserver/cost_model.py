@@ -0,0 +1,115 @@
+import math
+import numbers
+
+import numpy as np
+
+
+def _is_number(value):
+    return isinstance(value, numbers.Real) and not isinstance(value, bool)
+
+
+def get_cost(subtask):
+    times = [t for t in (subtask.fit_times or []) + (subtask.score_times or []) if t is not None]
+    return sum(times) if times else None
+
+
+class CostModel:
+    """Predicts the runtime of a parameter combination.
+
+    Runtime is modelled as log(cost) = w . features, where numeric parameters (and the halving sample
+    size) enter as their logarithm and all other parameters are one-hot encoded, fitted by ridge
+    regression on completed subtasks. Until enough of them are observed, the prediction falls back to
+    the user's `cost_hints`, which map a numeric parameter to its cost exponent: {'n_estimators': 1}
+    says the cost grows linearly with n_estimators.
+    """
+
+    ridge = 1e-3
+
+    def __init__(self, cost_hints=None, min_observations=10):
+        self.cost_hints = cost_hints or {}
+        self.min_observations = min_observations
+        self.n_observations = 0
+        self.error = None
+        self._features = None
+        self._weights = None
+
+    @staticmethod
+    def _get_items(candidate):
+        items = dict(candidate['params'])
+        if candidate.get('n_samples'):
+            items['__n_samples__'] = candidate['n_samples']
+        return items
+
+    def _build_features(self, candidates):
+        features = set()
+        for candidate in candidates:
+            for name, value in self._get_items(candidate).items():
+                features.add((name, None) if _is_number(value) else (name, repr(value)))
+        self._features = {feature: i + 1 for i, feature in enumerate(sorted(features))}
+
+    def _featurize(self, candidates):
+        A = np.zeros((len(candidates), len(self._features) + 1))
+        A[:, 0] = 1
+        for row, candidate in enumerate(candidates):
+            for name, value in self._get_items(candidate).items():
+                if _is_number(value):
+                    column = self._features.get((name, None))
+                    value = math.log(max(abs(value), 1e-12))
+                else:
+                    column = self._features.get((name, repr(value)))
+                    value = 1
+                if column is not None:
+                    A[row, column] = value
+        return A
+
+    def fit(self, candidates, costs):
+        observed = [(candidate, cost) for candidate, cost in zip(candidates, costs) if cost and cost > 0]
+        self.n_observations = len(observed)
+        if self.n_observations < self.min_observations:
+            return self
+        candidates, costs = zip(*observed)
+        self._build_features(candidates)
+        A = self._featurize(candidates)
+        y = np.log(costs)
+        self._weights = np.linalg.solve(A.T @ A + self.ridge * np.eye(A.shape[1]), A.T @ y)
+        return self
+
+    def _predict_from_hints(self, candidate):
+        cost = 1.
+        for name, exponent in self.cost_hints.items():
+            value = self._get_items(candidate).get(name)
+            if _is_number(value) and value > 0:
+                cost *= value ** exponent
+        return cost
+
+    def predict(self, candidates):
+        if self._weights is None:
+            return [self._predict_from_hints(candidate) for candidate in candidates]
+        if not candidates:
+            return []
+        return [float(cost) for cost in np.exp(self._featurize(candidates) @ self._weights)]
+
+    def score(self, candidates, predicted, actual):
+        """Median absolute log-ratio of predicted and actual costs, 0 is a perfect model."""
+        errors = [abs(math.log(p / a)) for p, a in zip(predicted, actual) if p and a and p > 0 and a > 0]
+        self.error = float(np.median(errors)) if errors else None
+        return self.error
+
+    def is_informative(self):
+        return self._weights is not None or bool(self.cost_hints)
+
+
+def balance_batches(items, costs, batch_size):
+    """Packs items longest-first into batches of at most `batch_size` items with balanced total cost.
+
+    Batches are returned most expensive first, so the longest work starts first.
+    """
+    n_batches = math.ceil(len(items) / batch_size)
+    batches = [[] for _ in range(n_batches)]
+    totals = [0.] * n_batches
+    for i in sorted(range(len(items)), key=lambda i: -costs[i]):
+        batch = min((b for b in range(n_batches) if len(batches[b]) < batch_size), key=lambda b: totals[b])
+        batches[batch].append(items[i])
+        totals[batch] += costs[i]
+    order = sorted(range(n_batches), key=lambda b: -totals[b])
+    return [batches[b] for b in order]
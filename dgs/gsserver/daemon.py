@@ -1,39 +1,52 @@
+import base64
+import binascii
 import logging
 import re
-import uuid
 from json.decoder import JSONDecodeError
 
 from flask import Flask
+from flask import Response
 from flask import request
 from flask.ext.cors import cross_origin
 from flask.ext.responses import json_response
 
+from dgs.gsserver import metrics
 from dgs.gsserver.celeryapp import init_celery_app
 from dgs.gsserver.conf import conf
 from dgs.gsserver.db import init_mongodb
+from dgs.gsserver.db.gsblob import codecs
 from dgs.gsserver.db.gsresource import GSResource
 from dgs.gsserver.db.gstask import GSTask, TaskState
-from dgs.gsserver.errors import ScriptParseError, ResourceUnavailableError, SearchRequestError, TaskStateError, \
-    ResourceNotFoundError
+from dgs.gsserver.db.gsworker import GSWorker
+from dgs.gsserver.db.indexes import init_indexes
+from dgs.gsserver.errors import ResourceUnavailableError, SearchRequestError, TaskStateError, \
+    ResourceNotFoundError, ValidationQueueFullError
+from dgs.gsserver.local_backend import local_backend
+from dgs.gsserver.pagination import count_modes, decode_cursor
 from dgs.gsserver.resource_controller import ResourceController
-from dgs.gsserver.task_controller import TaskController
+from dgs.gsserver.routing import worker_router
+from dgs.gsserver.spool import array_formats
+from dgs.gsserver.task_events import delta_fields, format_event, get_delta
+from dgs.gsserver.task_controller import TaskController, task_orders
 from dgs.gsserver.task_controller import TaskNotFoundError
 
 app = Flask(__name__)
 task_controller = TaskController()
 resource_controller = ResourceController()
+task_controller.add_listener(resource_controller.notify)
 
 
 @app.route('/cancel/<task_id>')
 @cross_origin()
 def cancel(task_id):
     try:
-        TaskController.cancel_task(task_id)
+        task_controller.cancel_task(task_id)
     except TaskNotFoundError as e:
         return json_response({'message': 'task not found'}, status_code=400)
     except TaskStateError as e:
         return json_response({'message': e.message}, status_code=400)
     else:
+        resource_controller.notify()
         return json_response({'message': 'ok'})
 
 
@@ -41,40 +54,31 @@ def cancel(task_id):
 @cross_origin()
 def cancel_all():
     task_controller.cancel_all_tasks()
+    resource_controller.notify()
     return json_response({'message': 'ok'})
 
 
 @app.route('/add_task', methods=['POST'])
 @cross_origin()
 def add_task():
-    temp_locker = str(uuid.uuid4())
-    resource_ids = None
-    is_successfully_created = False
     try:
         args = request.json
 
         resources = args.get('resources', {})
-        resource_ids = resources.values()
         title = args.get('title', '')
         script = args.get('file', '')
-        # TODO: probably, should be moved elsewhere
-        resource_controller.lock_resources(temp_locker, resource_ids)
-        task = GSTask.create_from_script(script, resources, title=title, task_id=temp_locker)
-        is_successfully_created = True
-    except ScriptParseError as e:
-        return json_response({'message': e.script_errors}, status_code=400)
+        task = GSTask.create_validating(script, resources, title=title)
+        task_controller.submit_task(task)
     except ResourceUnavailableError as e:
         return json_response({'message': 'Some resources are unavailable'}, status_code=400)
+    except ValidationQueueFullError as e:
+        return json_response({'message': 'Too many tasks are being validated, try again later'}, status_code=503)
     except JSONDecodeError as e:
         return json_response({'message': 'Data is not in json format'}, status_code=400)
     except Exception as e:
         return json_response({'message': str(e)}, status_code=500)
     else:
-        task_controller.add_task(task)
-        return json_response({'message': 'ok'})
-    finally:
-        if resource_ids and not is_successfully_created:
-            GSResource.unlock_resources(temp_locker, resource_ids)
+        return json_response({'message': 'ok', 'task_id': task.task_id, 'state': task.state})
 
 
 def validate_search_params(raw_params, config):
@@ -102,20 +106,49 @@ def validate_search_params(raw_params, config):
 @cross_origin()
 def task_info():
     config = {
-        'sort': ('date', None, None, None),
+        'sort': ('date', lambda x: x in task_orders, None, 'No such sort order'),
         'q': ('', None, None, None),
         'state': ('ALL', lambda x: x.upper() in list(vars(TaskState)) + ['ALL'], lambda x: x.upper(), 'No such state'),
         'offset': ('0', lambda x: re.match(r'\d+', x), lambda x: int(x), None),
-        'count': ('50', lambda x: re.match(r'\d+', x), lambda x: int(x), None)
+        'count': ('50', lambda x: re.match(r'\d+', x), lambda x: int(x), None),
+        'cursor': ('', None, lambda x: decode_cursor(x) if x else None, 'Malformed cursor'),
+        'total': ('cached', lambda x: x in count_modes, None, 'No such count mode')
     }
 
     try:
         params = validate_search_params(request.args, config)
     except SearchRequestError as e:
         return json_response({'errors': e.errors})
-    else:
-        total, items = task_controller.get_tasks(**params)
-        return json_response({'tasks': {'count': total, 'items': items}})
+    try:
+        total, items, next_cursor = task_controller.get_tasks(**params)
+    except ValueError:
+        return json_response({'errors': {'cursor': 'Malformed cursor'}})
+    return json_response({'tasks': {'count': total, 'items': items, 'next': next_cursor}})
+
+
+@app.route('/task_events')
+@cross_origin()
+def task_events():
+    task_ids = [task_id for task_id in request.args.get('task_id', '').split(',') if task_id]
+    subscription = task_controller.events.subscribe(task_ids, include_new=request.args.get('new') == '1')
+    snapshot = GSTask.objects(task_id__in=task_ids).only('task_id', *delta_fields) if task_ids else []
+
+    def stream():
+        try:
+            yield 'retry: 3000\n\n'
+            for task in snapshot:
+                yield format_event('task', get_delta(task))
+            while True:
+                events = subscription.get(conf.Master.event_keepalive_interval)
+                for event, data in events:
+                    yield format_event(event, data)
+                if not events:
+                    yield ': keepalive\n\n'
+        finally:
+            task_controller.events.unsubscribe(subscription)
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 
 @app.route('/add_resource', methods=['POST'])
@@ -126,13 +159,27 @@ def add_resource():
     if 'file' not in args or not isinstance(args['file'], str) or not args['file']:
         return json_response({'message': 'can not add an empty resource'}, status_code=400)
 
-    resource = GSResource.create(args['file'].encode('utf8'), args.get('title'))
+    resource_format = args.get('format', 'raw')
+    if resource_format not in ('raw',) + array_formats:
+        return json_response({'message': 'unknown resource format'}, status_code=400)
+    if args.get('codec') and args['codec'] not in codecs:
+        return json_response({'message': 'codec {} is not available'.format(args['codec'])}, status_code=400)
+    try:
+        if args.get('encoding') == 'base64' or resource_format in array_formats:
+            content = base64.b64decode(args['file'], validate=True)
+        else:
+            content = args['file'].encode('utf8')
+    except binascii.Error:
+        return json_response({'message': 'file is not valid base64'}, status_code=400)
+
     try:
+        resource = GSResource.create(content, args.get('title'), codec=args.get('codec'),
+                                     resource_format=resource_format)
         resource_controller.add_resource(resource)
     except Exception as e:
         return json_response({'message': str(e)}, status_code=400)
     else:
-        return json_response({'message': 'ok'})
+        return json_response({'message': 'ok', 'resource_id': resource.resource_id})
 
 
 @app.route('/resource_info')
@@ -145,15 +192,19 @@ def resource_info():
                       lambda x: {'true': True, 'false': False}.get(x.lower()),
                       'No such state'),
         'offset': ('0', lambda x: re.match(r'\d+', x), lambda x: int(x), None),
-        'count': ('50', lambda x: re.match(r'\d+', x), lambda x: int(x), None)
+        'count': ('50', lambda x: re.match(r'\d+', x), lambda x: int(x), None),
+        'cursor': ('', None, lambda x: decode_cursor(x) if x else None, 'Malformed cursor'),
+        'total': ('cached', lambda x: x in count_modes, None, 'No such count mode')
     }
     try:
         params = validate_search_params(request.args, config)
     except SearchRequestError as e:
         return json_response({'errors': e.errors})
-    else:
-        total, items = resource_controller.get_resources(include_content=False, **params)
-        return json_response({'resources': {'count': total, 'items': items}})
+    try:
+        total, items, next_cursor = resource_controller.get_resources(include_content=False, **params)
+    except ValueError:
+        return json_response({'errors': {'cursor': 'Malformed cursor'}})
+    return json_response({'resources': {'count': total, 'items': items, 'next': next_cursor}})
 
 
 @app.route('/delete_resource/<resource_id>')
@@ -167,9 +218,28 @@ def delete_resource(resource_id):
         return json_response({'message': 'ok'})
 
 
+@app.route('/metrics')
+def metrics_info():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/worker_info')
+@cross_origin()
+def worker_info():
+    workers = [worker.to_json() for worker in GSWorker.get_alive(conf.TaskController.worker_timeout)]
+    for worker in workers:
+        try:
+            worker['queue_depth'] = worker_router.get_queue_depth(worker['queue'])
+        except Exception:
+            worker['queue_depth'] = None
+    return json_response({'workers': workers, 'routing': {'warm': worker_router.n_warm.value,
+                                                          'cold': worker_router.n_cold.value}})
+
+
 def run_master():
     init_celery_app(conf.Celery.conf)
     init_mongodb(conf.Mongo.connection)
+    init_indexes()
     task_controller.start()
     resource_controller.start()
 
@@ -177,6 +247,10 @@ def run_master():
         app.run(host=conf.Master.host, port=conf.Master.port, use_reloader=False, threaded=True)
     except:
         logging.exception('error while starting flask server, shutting down')
+    finally:
+        if conf.TaskController.backend == 'local':
+            # Unlinks the shared memory segments of the dataset broker
+            local_backend.stop()
 
 
 def entry_point():
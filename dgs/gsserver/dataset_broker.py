@@ -0,0 +1,301 @@
+import hashlib
+import logging
+import multiprocessing
+import os
+import time
+from multiprocessing.managers import BaseManager
+from threading import Lock, Thread
+
+try:
+    from multiprocessing import resource_tracker
+    from multiprocessing.shared_memory import SharedMemory
+except ImportError:
+    # Python < 3.8, datasets are not shared
+    resource_tracker = SharedMemory = None
+
+import numpy as np
+
+from dgs.gsserver.conf import conf
+from dgs.gsserver.metrics import SnapshotCollector
+from dgs.gsserver.script_cache import script_cache
+
+
+def _untrack(segment):
+    # Segments outlive the process that created them, the broker unlinks them
+    try:
+        resource_tracker.unregister(segment._name, 'shared_memory')
+    except Exception:
+        pass
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _unlink(name):
+    if SharedMemory is None:
+        return
+    try:
+        segment = SharedMemory(name=name)
+    except FileNotFoundError:
+        return
+    segment.close()
+    segment.unlink()
+
+
+class DatasetBroker:
+    def __init__(self):
+        self._segments = {}
+        self._finished_tasks = set()
+        self._lock = Lock()
+
+    def acquire(self, key, pid):
+        with self._lock:
+            segment = self._segments.get(key)
+            if segment is None:
+                return None
+            segment['refs'].add(pid)
+            return segment['name'], segment['shape'], segment['dtype']
+
+    def register(self, key, task_id, name, shape, dtype, pid):
+        with self._lock:
+            if key not in self._segments:
+                self._segments[key] = {'task_id': task_id, 'name': name, 'shape': shape, 'dtype': dtype,
+                                       'refs': set()}
+            segment = self._segments[key]
+            segment['refs'].add(pid)
+            return segment['name'], segment['shape'], segment['dtype']
+
+    def release(self, task_id, pid):
+        with self._lock:
+            for segment in self._segments.values():
+                if segment['task_id'] == task_id:
+                    segment['refs'].discard(pid)
+            self._collect()
+
+    def finish_task(self, task_id):
+        with self._lock:
+            self._finished_tasks.add(task_id)
+            self._collect()
+
+    def unlink_all(self):
+        with self._lock:
+            for segment in self._segments.values():
+                _unlink(segment['name'])
+            self._segments.clear()
+
+    def get_task_ids(self):
+        with self._lock:
+            return list({segment['task_id'] for segment in self._segments.values()})
+
+    def stats(self):
+        with self._lock:
+            return {'n_segments': len(self._segments),
+                    'n_refs': sum(len(segment['refs']) for segment in self._segments.values())}
+
+    def _collect(self):
+        for key, segment in list(self._segments.items()):
+            segment['refs'] = {pid for pid in segment['refs'] if _is_alive(pid)}
+            if segment['task_id'] in self._finished_tasks and not segment['refs']:
+                _unlink(segment['name'])
+                del self._segments[key]
+        active_task_ids = {segment['task_id'] for segment in self._segments.values()}
+        self._finished_tasks &= active_task_ids
+
+
+_broker = None
+
+
+def _get_broker():
+    global _broker
+    if _broker is None:
+        _broker = DatasetBroker()
+    return _broker
+
+
+_metrics_collector = None
+
+
+def _get_metrics_collector():
+    global _metrics_collector
+    if _metrics_collector is None:
+        _metrics_collector = SnapshotCollector()
+    return _metrics_collector
+
+
+def _reap_finished_tasks():
+    from dgs.gsserver import spool
+    from dgs.gsserver.db.gstask import GSTask, terminal_states
+
+    broker = _get_broker()
+    while True:
+        time.sleep(conf.Worker.dataset_broker_reap_interval)
+        try:
+            task_ids = broker.get_task_ids()
+            if task_ids:
+                for task_id in GSTask.objects(task_id__in=task_ids, state__in=terminal_states).scalar('task_id'):
+                    broker.finish_task(task_id)
+        except Exception:
+            logging.exception('can not reap shared datasets')
+        try:
+            spool.prune()
+        except Exception:
+            logging.exception('can not prune spool')
+
+
+def _init_broker_process(conf_values):
+    # Runs in a spawned process, which starts from the default conf and without a Mongo connection
+    from dgs.gsserver.db import init_mongodb
+
+    conf.set_values(conf_values)
+    init_mongodb(conf.Mongo.connection)
+    Thread(target=_reap_finished_tasks, daemon=True).start()
+
+
+class DatasetBrokerManager(BaseManager):
+    pass
+
+
+DatasetBrokerManager.register('get_broker', callable=_get_broker)
+DatasetBrokerManager.register('get_metrics_collector', callable=_get_metrics_collector)
+
+
+_broker_address = None
+_broker_authkey = None
+
+
+def _make_private_dir(path):
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    os.chmod(path, 0o700)
+
+
+def start_broker():
+    """Starts the broker of this worker on a private socket with a random authkey its children inherit.
+
+    The broker process is spawned: a fork of a master running threads could inherit their locks held.
+    """
+    global _broker_address, _broker_authkey
+    _make_private_dir(conf.Worker.spool_dir)
+    _make_private_dir(conf.Worker.dataset_broker_dir)
+    address = os.path.join(conf.Worker.dataset_broker_dir, '{}.sock'.format(os.getpid()))
+    if os.path.exists(address):
+        # Left behind by a dead process which had the same pid
+        os.remove(address)
+    authkey = os.urandom(32)
+    manager = DatasetBrokerManager(address=address, authkey=authkey, ctx=multiprocessing.get_context('spawn'))
+    manager.start(initializer=_init_broker_process, initargs=(conf.get_values(),))
+    os.chmod(address, 0o600)
+    _broker_address, _broker_authkey = address, authkey
+    return manager
+
+
+def get_broker_credentials():
+    return _broker_address, _broker_authkey
+
+
+def set_broker_credentials(address, authkey):
+    """Lets a spawned process, which inherits nothing, connect to the broker of its parent."""
+    global _broker_address, _broker_authkey
+    _broker_address, _broker_authkey = address, authkey
+
+
+def connect_broker():
+    if _broker_address is None:
+        raise ConnectionRefusedError('no dataset broker was started by this worker')
+    manager = DatasetBrokerManager(address=_broker_address, authkey=_broker_authkey)
+    manager.connect()
+    return manager
+
+
+def stop_broker(manager):
+    manager.get_broker().unlink_all()
+    manager.shutdown()
+
+
+class SharedDatasets:
+    """Swaps the arrays of a script namespace for read only views of segments shared by the worker children.
+
+    Every child still runs the script itself, so while it runs it holds its own copy of what the script
+    derives from the resources: the namespace holds the classes and functions the script defines, which can
+    not be built once and handed to other processes. Array resources are spooled once per host and only
+    memory mapped by the children. Once shared, every array of the namespace, intermediate ones included,
+    exists once per worker instead of once per child.
+    """
+
+    def __init__(self):
+        self._broker = None
+        self._segments = {}
+
+    def connect(self):
+        if SharedMemory is None:
+            logging.warning('shared memory needs Python 3.8, datasets will not be shared')
+            return
+        try:
+            manager = connect_broker()
+        except (FileNotFoundError, ConnectionRefusedError):
+            logging.warning('dataset broker is not running, datasets will not be shared')
+        else:
+            self._broker = manager.get_broker()
+            script_cache.add_eviction_listener(self.release)
+
+    @staticmethod
+    def _attach(name, shape, dtype):
+        segment = SharedMemory(name=name)
+        _untrack(segment)
+        array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=segment.buf)
+        array.setflags(write=False)
+        return segment, array
+
+    def _share_array(self, task_id, key, array):
+        meta = self._broker.acquire(key, os.getpid())
+        if meta is None:
+            segment = SharedMemory(create=True, size=array.nbytes)
+            view = np.ndarray(array.shape, dtype=array.dtype, buffer=segment.buf)
+            view[...] = array
+            del view
+            meta = self._broker.register(key, task_id, segment.name, array.shape, array.dtype.str, os.getpid())
+            segment.close()
+            if meta[0] != segment.name:
+                segment.unlink()
+            else:
+                _untrack(segment)
+        segment, shared_array = self._attach(*meta)
+        self._segments.setdefault(task_id, []).append(segment)
+        return shared_array
+
+    def share(self, cache_key, namespace):
+        if self._broker is None:
+            return namespace
+        task_id = cache_key[0]
+        digest = hashlib.sha1(repr(cache_key).encode('utf8')).hexdigest()
+        for name, value in list(namespace.items()):
+            if isinstance(value, np.ndarray) and not isinstance(value, np.memmap) and value.nbytes and \
+                    not value.dtype.hasobject and not name.startswith('__'):
+                try:
+                    namespace[name] = self._share_array(task_id, '{}:{}'.format(digest, name), value)
+                except Exception:
+                    logging.exception('can not share {} of task {}'.format(name, task_id))
+        return namespace
+
+    def release(self, task_id, is_finished=False):
+        for segment in self._segments.pop(task_id, []):
+            try:
+                segment.close()
+            except BufferError:
+                pass
+        if self._broker is not None:
+            try:
+                self._broker.release(task_id, os.getpid())
+                if is_finished:
+                    self._broker.finish_task(task_id)
+            except Exception:
+                logging.exception('can not release shared datasets of task {}'.format(task_id))
+
+
+shared_datasets = SharedDatasets()
@@ -0,0 +1,119 @@
+import datetime
+import lzma
+import uuid
+import zlib
+
+import mongoengine as me
+from pymongo import UpdateOne
+
+from dgs.gsserver.conf import conf
+from dgs.gsserver.errors import UnknownCodecError
+
+codecs = {
+    'none': (lambda data: data, lambda data: data),
+    'zlib': (zlib.compress, zlib.decompress),
+    'lzma': (lzma.compress, lzma.decompress),
+}
+
+try:
+    import lz4.frame
+except ImportError:
+    pass
+else:
+    codecs['lz4'] = (lz4.frame.compress, lz4.frame.decompress)
+
+try:
+    import zstandard
+except ImportError:
+    pass
+else:
+    codecs['zstd'] = (lambda data: zstandard.ZstdCompressor().compress(data),
+                      lambda data: zstandard.ZstdDecompressor().decompress(data))
+
+
+class GSBlobChunk(me.Document):
+    chunk_id = me.StringField(primary_key=True)
+    blob_id = me.StringField()
+    generation = me.StringField()
+    n = me.IntField()
+    data = me.BinaryField()
+
+    meta = {
+        'indexes': [
+            ('blob_id', 'generation', 'n'),
+        ]
+    }
+
+
+class GSBlob(me.Document):
+    blob_id = me.StringField(primary_key=True)
+    generation = me.StringField()
+    codec = me.StringField()
+    size = me.IntField()
+    stored_size = me.IntField()
+    chunk_size = me.IntField()
+    n_chunks = me.IntField()
+    last_used = me.DateTimeField()
+
+    @classmethod
+    def get_by_id(cls, blob_id):
+        return GSBlob.objects.filter(blob_id=blob_id).first()
+
+    @classmethod
+    def put(cls, blob_id, content, codec=None):
+        codec = codec or conf.Resource.codec
+        if codec not in codecs:
+            raise UnknownCodecError(codec)
+        # Touching a reused blob keeps delete_unreferenced off it until its new resource is saved
+        now = datetime.datetime.utcnow()
+        if GSBlob.objects(blob_id=blob_id).update_one(set__last_used=now):
+            blob = cls.get_by_id(blob_id)
+            if blob is not None:
+                return blob
+
+        # Chunks of every generation get their own ids, a concurrent delete never removes the new ones
+        generation = uuid.uuid4().hex
+        data = codecs[codec][0](content)
+        chunk_size = conf.Resource.chunk_size
+        chunks = [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+        if chunks:
+            GSBlobChunk._get_collection().bulk_write([
+                UpdateOne({'_id': '{}:{}:{}'.format(blob_id, generation, n)},
+                          {'$set': {'blob_id': blob_id, 'generation': generation, 'n': n, 'data': chunk}},
+                          upsert=True)
+                for n, chunk in enumerate(chunks)], ordered=False)
+        blob = cls(blob_id=blob_id, generation=generation, codec=codec, size=len(content), stored_size=len(data),
+                   chunk_size=chunk_size, n_chunks=len(chunks), last_used=now)
+        try:
+            blob.save(force_insert=True)
+        except me.NotUniqueError:
+            GSBlobChunk.objects(blob_id=blob_id, generation=generation).delete()
+            return cls.put(blob_id, content, codec)
+        return blob
+
+    def read(self):
+        chunks = GSBlobChunk.objects(blob_id=self.blob_id, generation=self.generation).order_by('n').scalar('data')
+        return codecs[self.codec][1](b''.join(chunks))
+
+    @classmethod
+    def delete_unreferenced(cls, blob_ids):
+        """Deletes the blobs no resource references.
+
+        Returns the ids of the deleted blobs and of the ones kept back because they were just reused.
+        """
+        from dgs.gsserver.db.gsresource import GSResource
+        referenced = set(GSResource.objects(content_hash__in=list(blob_ids)).distinct('content_hash'))
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=conf.Resource.blob_reuse_grace)
+        deleted = set()
+        recently_used = set()
+        for blob_id in blob_ids:
+            if blob_id in referenced:
+                continue
+            blob = cls._get_collection().find_one_and_delete({'_id': blob_id, 'last_used': {'$not': {'$gte': cutoff}}},
+                                                            projection={'generation': True})
+            if blob is not None:
+                GSBlobChunk._get_collection().delete_many({'blob_id': blob_id, 'generation': blob.get('generation')})
+                deleted.add(blob_id)
+            elif cls._get_collection().count_documents({'_id': blob_id}):
+                recently_used.add(blob_id)
+        return deleted, recently_used
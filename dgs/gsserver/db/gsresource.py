@@ -1,23 +1,75 @@
+import hashlib
 import uuid
 
 import mongoengine as me
 
+from dgs.gsserver.db.gsblob import GSBlob
 from dgs.gsserver.errors import ResourceUnavailableError
+from dgs.gsserver.spool import array_formats, get_array_meta
 
 
 class GSResource(me.Document):
     resource_id = me.StringField(primary_key=True)
     title = me.StringField(default=resource_id)
+    title_lower = me.StringField()
     content = me.BinaryField()
+    content_hash = me.StringField()
     is_deletion_requested = me.BooleanField(default=False)
     lockers = me.ListField()
     size = me.IntField()
+    stored_size = me.IntField()
+    format = me.StringField(default='raw')
+    dtype = me.StringField()
+    shape = me.ListField(me.IntField())
+    arrays = me.DictField()
+
+    meta = {
+        'indexes': [
+            'content_hash',
+            'lockers',
+            'is_deletion_requested',
+            ('title_lower', 'resource_id'),
+        ]
+    }
+
+    def clean(self):
+        self.title_lower = (self.title or '').lower()
 
     @classmethod
-    def create(cls, content, title=None):
+    def create(cls, content, title=None, codec=None, resource_format='raw'):
+        array_meta = {}
+        if resource_format == 'npy':
+            array_meta = get_array_meta(content, resource_format)
+        elif resource_format == 'npz':
+            array_meta = {'arrays': get_array_meta(content, resource_format)}
+        content_hash = hashlib.sha1(content).hexdigest()
+        # The same bytes uploaded in another format are another resource, with their own array metadata
+        formats = [resource_format, None] if resource_format == 'raw' else [resource_format]
+        resource = GSResource.objects(content_hash=content_hash, format__in=formats,
+                                      is_deletion_requested=False).exclude('content').first()
+        if resource is not None:
+            return resource
+
         resource_id = str(uuid.uuid4())
         title = title or resource_id
-        return cls(resource_id=resource_id, title=title, content=content, size=len(content))
+        blob = GSBlob.put(content_hash, content, codec)
+        return cls(resource_id=resource_id, title=title, size=len(content), stored_size=blob.stored_size,
+                   content_hash=content_hash, format=resource_format, **array_meta)
+
+    @property
+    def is_array(self):
+        return self.format in array_formats
+
+    def read_content(self):
+        if self.content is not None:
+            return self.content
+        blob = GSBlob.get_by_id(self.content_hash) if self.content_hash else None
+        if blob is not None:
+            return blob.read()
+        content = GSResource.objects(resource_id=self.resource_id).scalar('content').first()
+        if content is None:
+            raise ResourceUnavailableError()
+        return content
 
     @classmethod
     def get_by_id(cls, resource_id, include_content=True):
@@ -26,13 +78,19 @@ class GSResource(me.Document):
         else:
             return GSResource.objects.filter(resource_id=resource_id).exclude('content').first()
 
+    @classmethod
+    def get_content_hashes(cls, resource_ids):
+        resources = GSResource.objects(resource_id__in=list(resource_ids)).only('resource_id', 'content_hash')
+        return {resource.resource_id: resource.content_hash or resource.resource_id for resource in resources}
+
+    @classmethod
+    def _get_available_filter(cls, resource_ids):
+        return {'_id': {'$in': resource_ids}, 'is_deletion_requested': {'$ne': True}}
+
     @classmethod
     def is_resources_available(cls, resource_ids):
-        for resource_id in resource_ids:
-            resource = cls.get_by_id(resource_id)
-            if not resource or resource.is_deletion_requested:
-                return False
-        return True
+        resource_ids = list(set(resource_ids))
+        return cls._get_collection().count_documents(cls._get_available_filter(resource_ids)) == len(resource_ids)
 
     @property
     def is_locked(self):
@@ -40,30 +98,23 @@ class GSResource(me.Document):
 
     @classmethod
     def lock_resources(cls, locker_id, resource_ids):
-        if cls.is_resources_available(resource_ids):
-            for resource_id in resource_ids:
-                resource = cls.get_by_id(resource_id)
-                if locker_id not in resource.lockers:
-                    resource.lockers.append(locker_id)
-                    resource.save()
-        else:
+        resource_ids = list(set(resource_ids))
+        if not resource_ids:
+            return
+        collection = cls._get_collection()
+        result = collection.update_many(cls._get_available_filter(resource_ids), {'$addToSet': {'lockers': locker_id}})
+        if result.matched_count != len(resource_ids):
+            collection.update_many({'_id': {'$in': resource_ids}}, {'$pull': {'lockers': locker_id}})
             raise ResourceUnavailableError()
 
     @classmethod
     def unlock_resources(cls, locker_id, resource_ids):
-        if cls.is_resources_available(resource_ids):
-            for resource_id in resource_ids:
-                resource = cls.get_by_id(resource_id)
-                try:
-                    resource.lockers.remove(locker_id)
-                except ValueError:
-                    pass
-                else:
-                    resource.save()
-        else:
-            raise ResourceUnavailableError()
+        resource_ids = list(set(resource_ids))
+        if resource_ids:
+            cls._get_collection().update_many({'_id': {'$in': resource_ids}}, {'$pull': {'lockers': locker_id}})
 
     def to_json(self):
         return {'resource_id': self.resource_id, 'title': self.title,
-                'size': self.size, 'is_locked': self.is_locked,
-                'lockers': self.lockers, 'is_deletion_requested': self.is_deletion_requested}
+                'size': self.size, 'stored_size': self.stored_size or self.size, 'is_locked': self.is_locked,
+                'lockers': self.lockers, 'is_deletion_requested': self.is_deletion_requested,
+                'format': self.format, 'dtype': self.dtype, 'shape': self.shape, 'arrays': self.arrays}
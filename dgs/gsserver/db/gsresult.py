@@ -0,0 +1,49 @@
+import datetime
+import hashlib
+import json
+
+import mongoengine as me
+from pymongo import UpdateOne
+
+from dgs.gsserver.conf import conf
+
+
+class GSResult(me.Document):
+    result_key = me.StringField(primary_key=True)
+    score = me.FloatField()
+    fold_scores = me.ListField(me.FloatField(null=True))
+    fit_times = me.ListField(me.FloatField(null=True))
+    score_times = me.ListField(me.FloatField(null=True))
+    create_time = me.DateTimeField()
+    last_used = me.DateTimeField()
+    n_hits = me.IntField(default=0)
+
+    meta = {
+        'indexes': [
+            {'fields': ['last_used'], 'expireAfterSeconds': conf.TaskController.result_cache_ttl},
+        ]
+    }
+
+    @staticmethod
+    def get_key(*parts):
+        key = json.dumps(parts, sort_keys=True, default=str)
+        return hashlib.sha256(key.encode('utf8')).hexdigest()
+
+    @classmethod
+    def lookup(cls, result_keys):
+        results = {result.result_key: result for result in cls.objects(result_key__in=list(result_keys))}
+        if results:
+            cls.objects(result_key__in=list(results)).update(set__last_used=datetime.datetime.utcnow(),
+                                                             inc__n_hits=1)
+        return results
+
+    @classmethod
+    def store(cls, subtasks):
+        now = datetime.datetime.utcnow()
+        updates = [UpdateOne({'_id': subtask.result_key}, {
+            '$set': {'score': subtask.score, 'fold_scores': subtask.fold_scores, 'fit_times': subtask.fit_times,
+                     'score_times': subtask.score_times, 'last_used': now},
+            '$setOnInsert': {'create_time': now, 'n_hits': 0}}, upsert=True)
+            for subtask in subtasks if subtask.result_key]
+        if updates:
+            cls._get_collection().bulk_write(updates, ordered=False)
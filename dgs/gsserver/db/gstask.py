@@ -1,20 +1,37 @@
+import ast
 import datetime
+import hashlib
+import math
 import sys
+import time
 import traceback
 import uuid
 from types import FunctionType
 
+import bson
 import mongoengine as me
 import numpy as np
 from celery import group
-from sklearn.base import ClassifierMixin, RegressorMixin
-from sklearn.cross_validation import cross_val_score
-from sklearn.grid_search import ParameterGrid
-
-from dgs.gsserver.celeryapp import run_subtask
+from pymongo import ReturnDocument, UpdateOne
+from sklearn.base import ClassifierMixin, RegressorMixin, clone, is_classifier
+from sklearn.cross_validation import check_cv
+from sklearn.metrics.scorer import check_scoring
+
+from dgs.gsserver import metrics, spool
+from dgs.gsserver.celeryapp import app, run_subtasks, run_subtask_folds, send_task_changed_event
+from dgs.gsserver.conf import conf
+from dgs.gsserver.cost_model import CostModel, balance_batches, get_cost
+from dgs.gsserver.dataset_broker import shared_datasets
 from dgs.gsserver.db.gsresource import GSResource
-from dgs.gsserver.errors import ScriptParseError, TaskStateError
+from dgs.gsserver.db.gsresult import GSResult
+from dgs.gsserver.db.gsworker import GSWorker
+from dgs.gsserver.db.subtask_writer import subtask_writer
+from dgs.gsserver.errors import ScriptParseError, TaskCanceledError, TaskStateError
+from dgs.gsserver.local_backend import local_backend
 from dgs.gsserver.resource_controller import ResourceNotFoundError
+from dgs.gsserver.routing import worker_router
+from dgs.gsserver.script_cache import script_cache
+from dgs.gsserver.search import search_strategies, is_valid_distributions
 
 
 class TaskState:
@@ -24,6 +41,10 @@ class TaskState:
     SUCCESS = 'SUCCESS'
     CANCELED = 'CANCELED'
     PENDING = 'PENDING'
+    VALIDATING = 'VALIDATING'
+
+
+terminal_states = (TaskState.FAILED, TaskState.SUCCESS, TaskState.CANCELED)
 
 
 task_params = {
@@ -32,10 +53,101 @@ task_params = {
     'scoring': (False, lambda x: isinstance(x, (str, FunctionType)), 'Scoring should be of type str or function'),
     'X': (True, lambda x: isinstance(x, np.ndarray), 'X should be of type numpy.ndarray'),
     'y': (True, lambda x: isinstance(x, np.ndarray), 'y should be of type numpy.ndarray'),
-    'param_grid': (True, lambda x: isinstance(x, dict), 'param_grid should be of type dict'),
+    'param_grid': (False, lambda x: isinstance(x, dict), 'param_grid should be of type dict'),
+    'param_distributions': (False, lambda x: isinstance(x, dict) and is_valid_distributions(x),
+                            'param_distributions should map names to lists of values or to '
+                            '{"uniform" | "loguniform" | "randint": [low, high]}'),
+    'n_iter': (False, lambda x: isinstance(x, int) and x > 0, 'n_iter should be a positive int'),
+    'time_budget': (False, lambda x: isinstance(x, (int, float)) and x > 0, 'time_budget should be a positive number'),
+    'batch_size': (False, lambda x: isinstance(x, int) and x > 0, 'batch_size should be a positive int'),
+    'search_mode': (False, lambda x: x in search_strategies,
+                    'search_mode should be one of {}'.format(', '.join(sorted(search_strategies)))),
+    'halving_params': (False, lambda x: isinstance(x, dict), 'halving_params should be of type dict'),
+    'cv': (False, lambda x: isinstance(x, int) and x > 1, 'cv should be an int greater than 1'),
+    'fold_parallel': (False, lambda x: isinstance(x, bool), 'fold_parallel should be of type bool'),
+    'cost_hints': (False, lambda x: isinstance(x, dict) and all(isinstance(v, (int, float)) for v in x.values()),
+                   'cost_hints should map parameter names to cost exponents'),
 }
 
 
+# Script parameters stored in search_params besides halving_params
+search_param_names = ('param_distributions', 'n_iter', 'time_budget', 'cost_hints')
+
+
+phases = ('queue_wait', 'resource_load', 'script_exec', 'fit_score', 'result_write')
+phase_durations = {phase: metrics.histogram('dgs_subtask_{}_seconds'.format(phase),
+                                            'Time subtasks spend in the {} phase'.format(phase))
+                   for phase in phases}
+subtasks_completed = metrics.counter('dgs_subtasks_completed_total', 'Subtasks completed by this process')
+subtasks_failed = metrics.counter('dgs_subtasks_failed_total', 'Subtasks failed in this process')
+
+
+def observe_phases(timings):
+    for phase, duration in timings.items():
+        phase_durations[phase].observe(duration)
+
+
+_task_states = {}
+
+# Cost models fitted in the master, by task id: (n_completed when fitted, model)
+_cost_models = {}
+
+
+def is_task_finished(task_id):
+    """Tells whether the task has reached a terminal state, asking Mongo at most once per check interval."""
+    state, checked_at = _task_states.get(task_id, (None, 0))
+    if state not in terminal_states and time.time() - checked_at >= conf.Worker.cancel_check_interval:
+        state = GSTask.objects(task_id=task_id).scalar('state').first()
+        _task_states[task_id] = state, time.time()
+        if len(_task_states) > 1024:
+            _task_states.pop(next(iter(_task_states)))
+    return state is None or state in terminal_states
+
+
+def _to_bson_value(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, (list, tuple)):
+        return [_to_bson_value(item) for item in value]
+    if isinstance(value, dict):
+        return {key: _to_bson_value(item) for key, item in value.items()}
+    return value
+
+
+def normalize_param_grid(param_grid):
+    """Returns the grid as plain lists of BSON values and the names of the parameters that can not be stored."""
+    grid = {}
+    invalid = []
+    for name, values in param_grid.items():
+        try:
+            grid[name] = [_to_bson_value(value) for value in values]
+        except TypeError:
+            invalid.append(str(name))
+            continue
+        if not is_bson_encodable(grid[name]):
+            invalid.append(str(name))
+    return grid, invalid
+
+
+def is_bson_encodable(value):
+    try:
+        bson.encode({'value': value})
+    except (TypeError, bson.errors.InvalidDocument, OverflowError):
+        return False
+    return True
+
+
+def get_error_info():
+    ex_type, ex, tb = sys.exc_info()
+    return {
+        'ex_type': str(ex_type),
+        'ex_message': str(ex),
+        'traceback': ''.join(traceback.format_tb(tb))
+    }
+
+
 class GSSubtask(me.Document):
     subtask_id = me.StringField(primary_key=True)
     parent_task_id = me.StringField()
@@ -45,6 +157,28 @@ class GSSubtask(me.Document):
     score = me.FloatField()
     state = me.StringField()
     error_info = me.DictField()
+    rung = me.IntField()
+    n_samples = me.IntField()
+    fold_scores = me.ListField(me.FloatField(null=True))
+    fit_times = me.ListField(me.FloatField(null=True))
+    score_times = me.ListField(me.FloatField(null=True))
+    result_key = me.StringField()
+    is_cached = me.BooleanField(default=False)
+    predicted_cost = me.FloatField()
+    dispatch_time = me.DateTimeField()
+    timings = me.DictField()
+    queue = me.StringField()
+    run_id = me.StringField()
+
+    meta = {
+        'indexes': [
+            ('parent_task_id', 'state'),
+            ('parent_task_id', 'state', '-end_time'),
+            ('parent_task_id', '-score'),
+            ('parent_task_id', 'rung', 'state', '-score'),
+            {'fields': ('queue', 'state'), 'sparse': True},
+        ]
+    }
 
     @classmethod
     def get_by_id(cls, subtask_id):
@@ -60,43 +194,270 @@ class GSSubtask(me.Document):
     def _get_script(self):
         return self.parent_task.script
 
-    def execute(self):
-        if self.state == TaskState.CANCELED:
-            return
-        if self.parent_task.state in (TaskState.CANCELED, TaskState.FAILED):
-            return
+    @staticmethod
+    def _load_namespace(parent_task, timings=None):
+        key = parent_task.get_cache_key()
+        namespace = script_cache.get(key)
+        if namespace is None:
+            load_start = time.time()
+            namespace = {'resources': parent_task.get_resources()}
+            exec_start = time.time()
+            exec(parent_task.script, {}, namespace)
+            del namespace['resources']
+            script_cache.put(key, shared_datasets.share(key, namespace))
+            if timings is not None:
+                timings['resource_load'] = exec_start - load_start
+                timings['script_exec'] = time.time() - exec_start
+        return namespace
+
+    def _get_data(self, parent_task, namespace):
+        X, y = namespace['X'], namespace['y']
+        if self.n_samples is None or self.n_samples >= len(X):
+            return X, y
+        if '__permutation__' not in namespace:
+            random_state = np.random.RandomState(parent_task.search_params.get('random_state', 0))
+            namespace['__permutation__'] = random_state.permutation(len(X))
+        indices = np.sort(namespace['__permutation__'][:self.n_samples])
+        return X[indices], y[indices]
+
+    @staticmethod
+    def _get_folds(parent_task, namespace, estimator, X, y):
+        folds = namespace.setdefault('__folds__', {})
+        if len(X) not in folds:
+            folds[len(X)] = list(check_cv(parent_task.cv, X, y, classifier=is_classifier(estimator)))
+        return folds[len(X)]
+
+    def _fit_and_score(self, parent_task, namespace, fold_indices=None):
+        X, y = self._get_data(parent_task, namespace)
+        estimator = namespace['Estimator'](**self.params)
+        scorer = check_scoring(estimator, scoring=namespace.get('scoring'))
+        folds = self._get_folds(parent_task, namespace, estimator, X, y)
+        results = []
+        for fold in range(len(folds)) if fold_indices is None else fold_indices:
+            if results and is_task_finished(parent_task.task_id):
+                raise TaskCanceledError(parent_task.task_id)
+            train, test = folds[fold]
+            fold_estimator = clone(estimator)
+            fit_start = time.time()
+            fold_estimator.fit(X[train], y[train])
+            score_start = time.time()
+            score = scorer(fold_estimator, X[test], y[test])
+            results.append((fold, score, score_start - fit_start, time.time() - score_start))
+        return results
+
+    def _run(self, parent_task, batch_start=None):
         success = False
-        self.state = TaskState.RUNNING
+        canceled = False
         self.start_time = datetime.datetime.utcnow()
-        self.save()
-        script = self._get_script()
-        resources = self.parent_task.get_resources()
-        module_globals = {'resources': resources}
+        timings = {}
+        if self.dispatch_time is not None:
+            # Up to the start of the batch, the subtasks ahead in it are not queue wait
+            timings['queue_wait'] = max(0., ((batch_start or self.start_time) - self.dispatch_time).total_seconds())
         try:
-            exec(script, {}, module_globals)
-            self.score = cross_val_score(module_globals['Estimator'](**self.params), X=module_globals['X'],
-                                         y=module_globals['y'],
-                                         scoring=module_globals.get('scoring')).mean()
+            module_globals = self._load_namespace(parent_task, timings)
+            fit_start = time.time()
+            _, self.fold_scores, self.fit_times, self.score_times = map(
+                list, zip(*self._fit_and_score(parent_task, module_globals)))
+            timings['fit_score'] = time.time() - fit_start
+            self.score = float(np.mean(self.fold_scores))
             success = True
+        except TaskCanceledError:
+            canceled = True
         except Exception as e:
-            ex_type, ex, tb = sys.exc_info()
-            self.error_info = {
-                'ex_type': str(ex_type),
-                'ex_message': str(ex),
-                'traceback': ''.join(traceback.format_tb(tb))
-            }
+            self.error_info = get_error_info()
         finally:
             if success:
                 self.state = TaskState.SUCCESS
                 self.end_time = datetime.datetime.utcnow()
+                subtasks_completed.inc()
+            elif canceled:
+                self.state = TaskState.CANCELED
             else:
                 self.state = TaskState.FAILED
-            self.save()
+                subtasks_failed.inc()
+            self.timings = timings
+            observe_phases(timings)
+        return success
+
+    def execute(self):
+        if self.state == TaskState.CANCELED or is_task_finished(self.parent_task_id):
+            script_cache.invalidate(self.parent_task_id)
+            return
+        parent_task = self.parent_task
+        if parent_task is None or parent_task.state in terminal_states:
+            script_cache.invalidate(self.parent_task_id)
+            return
+        start_time = datetime.datetime.utcnow()
+        n_started = self._claim([self], start_time)
+        if n_started:
+            GSTask.mark_subtasks_started(self.parent_task_id, n_started, start_time)
+        send_task_changed_event(self.parent_task_id)
+        self._run(parent_task)
+        subtask_writer.add(self.parent_task_id, self._to_result_update(), self)
+
+    @staticmethod
+    def _claim(subtasks, start_time):
+        """Marks the subtasks RUNNING under a new run id, returns how many of them were IDLE.
+
+        A subtask which is already RUNNING, redelivered or sent again while its worker looked dead, is taken
+        over: only the run which claimed it last can write its result, so it is aggregated once.
+        """
+        run_id = uuid.uuid4().hex
+        subtask_ids = [subtask.subtask_id for subtask in subtasks]
+        n_started = GSSubtask.objects(subtask_id__in=subtask_ids, state=TaskState.IDLE).update(
+            set__state=TaskState.RUNNING, set__start_time=start_time, set__run_id=run_id)
+        if n_started < len(subtask_ids):
+            GSSubtask.objects(subtask_id__in=subtask_ids, state=TaskState.RUNNING).update(
+                set__start_time=start_time, set__run_id=run_id)
+        for subtask in subtasks:
+            subtask.state, subtask.start_time, subtask.run_id = TaskState.RUNNING, start_time, run_id
+        return n_started
+
+    def _get_run_filter(self):
+        return {'_id': self.subtask_id, 'state': TaskState.RUNNING, 'run_id': self.run_id}
+
+    def _to_result_update(self):
+        return UpdateOne(self._get_run_filter(), {'$set': {
+            'state': self.state, 'start_time': self.start_time, 'end_time': self.end_time,
+            'score': self.score, 'error_info': self.error_info, 'fold_scores': self.fold_scores,
+            'fit_times': self.fit_times, 'score_times': self.score_times, 'timings': self.timings}})
+
+    @classmethod
+    def execute_batch(cls, subtask_ids, parent_task_id=None):
+        if parent_task_id is not None and is_task_finished(parent_task_id):
+            script_cache.invalidate(parent_task_id)
+            return
+        subtasks = list(GSSubtask.objects(subtask_id__in=subtask_ids,
+                                          state__in=[TaskState.IDLE, TaskState.RUNNING]))
+        if not subtasks:
+            return
+        parent_task = subtasks[0].parent_task
+        if parent_task is None or parent_task.state in terminal_states:
+            script_cache.invalidate(subtasks[0].parent_task_id)
+            return
+        start_time = datetime.datetime.utcnow()
+        n_started = cls._claim(subtasks, start_time)
+        if n_started:
+            GSTask.mark_subtasks_started(parent_task.task_id, n_started, start_time)
+        if parent_task.state == TaskState.PENDING:
+            send_task_changed_event(parent_task.task_id)
+
+        processed = []
+        is_canceled = False
+        for subtask in subtasks:
+            if processed and is_task_finished(parent_task.task_id):
+                is_canceled = True
+                break
+            processed.append(subtask)
+            success = subtask._run(parent_task, start_time)
+            subtask_writer.add(parent_task.task_id, subtask._to_result_update(), subtask)
+            if not success:
+                is_canceled = subtask.state == TaskState.CANCELED
+                break
+
+        returned = subtasks[len(processed):]
+        released_state = {'state': TaskState.CANCELED} if is_canceled else {'state': TaskState.IDLE, 'start_time': None}
+        for subtask in returned:
+            update = UpdateOne(subtask._get_run_filter(), {'$set': released_state})
+            subtask.state = released_state['state']
+            subtask_writer.add(parent_task.task_id, update, subtask, is_returned=True)
+
+    @classmethod
+    def execute_fold_batch(cls, units, parent_task_id=None):
+        if parent_task_id is not None and is_task_finished(parent_task_id):
+            script_cache.invalidate(parent_task_id)
+            return
+        subtasks = {subtask.subtask_id: subtask for subtask in GSSubtask.objects(
+            subtask_id__in=list({subtask_id for subtask_id, _ in units}),
+            state__in=[TaskState.IDLE, TaskState.RUNNING])}
+        if not subtasks:
+            return
+        parent_task_id = next(iter(subtasks.values())).parent_task_id
+        parent_task = GSTask.get_by_id(parent_task_id)
+        if parent_task is None or parent_task.state in terminal_states:
+            script_cache.invalidate(parent_task_id)
+            return
+        start_time = datetime.datetime.utcnow()
+        n_started = GSSubtask.objects(subtask_id__in=list(subtasks), state=TaskState.IDLE).update(
+            set__state=TaskState.RUNNING, set__start_time=start_time)
+        if n_started:
+            GSTask.mark_subtasks_started(parent_task_id, n_started, start_time)
+            send_task_changed_event(parent_task_id)
+
+        collection = GSSubtask._get_collection()
+        failed = []
+        updates = []
+        phase_times = {}
+        is_canceled = False
+        # Queue wait is counted once per subtask, by the batch which starts it
+        waiting = {subtask_id for subtask_id, subtask in subtasks.items()
+                   if subtask.state == TaskState.IDLE and subtask.dispatch_time is not None}
+        for subtask_id, fold in units:
+            subtask = subtasks.get(subtask_id)
+            if subtask is None:
+                continue
+            if updates and is_task_finished(parent_task_id):
+                is_canceled = True
+                break
+            timings = {}
+            if subtask_id in waiting:
+                waiting.discard(subtask_id)
+                timings['queue_wait'] = max(0., (start_time - subtask.dispatch_time).total_seconds())
+            try:
+                namespace = cls._load_namespace(parent_task, timings)
+                fit_start = time.time()
+                (_, score, fit_time, score_time), = subtask._fit_and_score(parent_task, namespace, [fold])
+                timings['fit_score'] = time.time() - fit_start
+            except Exception as e:
+                subtask.state = TaskState.FAILED
+                subtask.error_info = get_error_info()
+                subtasks_failed.inc()
+                if collection.update_one({'_id': subtask_id, 'state': TaskState.RUNNING}, {'$set': {
+                        'state': subtask.state, 'error_info': subtask.error_info}}).modified_count:
+                    failed.append(subtask)
+                break
+            finally:
+                observe_phases(timings)
+                for phase, duration in timings.items():
+                    phase_times[phase] = phase_times.get(phase, 0) + duration
+            timings_update = {'timings.{}'.format(phase): duration for phase, duration in timings.items()
+                              if phase != 'queue_wait'}
+            updates.append(UpdateOne({'_id': subtask_id}, {'$set': {
+                'fold_scores.{}'.format(fold): score, 'fit_times.{}'.format(fold): fit_time,
+                'score_times.{}'.format(fold): score_time}, '$inc': timings_update,
+                '$max': {'timings.queue_wait': timings.get('queue_wait', 0.)}}))
+        write_start = time.time()
+        if updates:
+            collection.bulk_write(updates, ordered=False)
+        if is_canceled:
+            collection.update_many({'_id': {'$in': list(subtasks)}, 'state': TaskState.RUNNING},
+                                   {'$set': {'state': TaskState.CANCELED}})
+
+        finished = []
+        for subtask in GSSubtask.objects(subtask_id__in=list(subtasks), state=TaskState.RUNNING).only(
+                'subtask_id', 'params', 'rung', 'fold_scores', 'fit_times', 'score_times', 'result_key'):
+            if subtask.fold_scores and all(score is not None for score in subtask.fold_scores):
+                subtask.state = TaskState.SUCCESS
+                subtask.score = float(np.mean(subtask.fold_scores))
+                subtask.end_time = datetime.datetime.utcnow()
+                if collection.update_one({'_id': subtask.subtask_id, 'state': TaskState.RUNNING}, {'$set': {
+                        'state': subtask.state, 'score': subtask.score,
+                        'end_time': subtask.end_time}}).modified_count:
+                    finished.append(subtask)
+        subtasks_completed.inc(len(finished))
+        GSResult.store(finished)
+        write_time = time.time() - write_start
+        observe_phases({'result_write': write_time})
+        phase_times['result_write'] = write_time
+        GSTask.aggregate_subtask_results(parent_task_id, finished + failed, phase_times=phase_times)
+        if finished or failed:
+            send_task_changed_event(parent_task_id)
 
 
 class GSTask(me.Document):
     task_id = me.StringField(primary_key=True)
     title = me.StringField()
+    title_lower = me.StringField()
     resources = me.DictField()
     state = me.StringField()
     script = me.StringField()
@@ -104,32 +465,102 @@ class GSTask(me.Document):
     end_time = me.DateTimeField()
     actualize_date = me.DateTimeField()
     n_subtasks = me.IntField()
+    param_grid = me.DictField()
+    n_materialized = me.IntField()
+    batch_size = me.IntField()
+    search_mode = me.StringField(default='grid')
+    cv = me.IntField()
+    fold_parallel = me.BooleanField(default=False)
+    search_params = me.DictField()
+    rungs = me.ListField(me.DictField())
+    result_namespace = me.StringField()
+    n_cache_lookups = me.IntField(default=0)
+    n_cache_hits = me.IntField(default=0)
+    n_started = me.IntField(default=0)
     n_completed = me.IntField(default=0)
+    n_failed = me.IntField(default=0)
     best_score = me.FloatField()
     best_params = me.DictField()
+    best_rung = me.IntField()
+    cost_model = me.DictField()
+    phase_times = me.DictField()
+    n_batches = me.IntField(default=0)
     param_errors = me.DictField()
     note = me.StringField()
     runtime_errors = me.ListField()
 
-    def __custom__init__(self, param_grid, script, resources=None, title='', task_id=None):
+    meta = {
+        'indexes': [
+            ('state', '-start_time', '-task_id'),
+            ('-start_time', '-task_id'),
+            ('title_lower', 'task_id'),
+        ]
+    }
+
+    def clean(self):
+        self.title_lower = (self.title or '').lower()
+
+    def __custom__init__(self, param_grid, script, resources=None, title='', task_id=None, batch_size=None,
+                         search_mode='grid', search_params=None, cv=None, fold_parallel=False):
         resources = resources or {}
         task_id = task_id or str(uuid.uuid4())
+        super().__init__(task_id=task_id, title=title, script=script, resources=resources)
+        self.configure(param_grid, batch_size=batch_size, search_mode=search_mode, search_params=search_params,
+                       cv=cv, fold_parallel=fold_parallel)
         GSResource.lock_resources(task_id, resources.values())
-        subtasks = [
-            GSSubtask(subtask_id=str(uuid.uuid4()), state=TaskState.IDLE, params=param_comb, parent_task_id=task_id) for
-            param_comb in ParameterGrid(param_grid)]
-        GSSubtask.objects.insert(subtasks)
-        super().__init__(task_id=task_id, title=title, script=script, n_subtasks=len(subtasks),
-                         resources=resources)
         return self
 
+    def configure(self, param_grid, batch_size=None, search_mode='grid', search_params=None, cv=None,
+                  fold_parallel=False):
+        search_params = search_params or {}
+        self.n_subtasks, self.rungs = search_strategies[search_mode].plan(param_grid, search_params)
+        self.param_grid = param_grid
+        self.n_materialized = 0
+        self.batch_size = batch_size
+        self.search_mode = search_mode
+        self.search_params = search_params
+        self.cv = cv
+        self.fold_parallel = fold_parallel
+        self.result_namespace = self.get_result_namespace(self.script, self.resources, cv)
+
     @classmethod
-    def create(cls, param_grid, script, resources=None, title='', task_id=None):
-        return cls().__custom__init__(param_grid, script, resources, title=title, task_id=task_id)
+    def create(cls, param_grid, script, resources=None, title='', task_id=None, batch_size=None,
+               search_mode='grid', search_params=None, cv=None, fold_parallel=False):
+        return cls().__custom__init__(param_grid, script, resources, title=title, task_id=task_id,
+                                      batch_size=batch_size, search_mode=search_mode, search_params=search_params,
+                                      cv=cv, fold_parallel=fold_parallel)
+
+    @staticmethod
+    def get_result_namespace(script, resources, cv):
+        if not conf.TaskController.use_result_cache:
+            return None
+        script_hash = hashlib.sha256(ast.dump(ast.parse(script)).encode('utf8')).hexdigest()
+        content_hashes = GSResource.get_content_hashes(resources.values())
+        return GSResult.get_key(script_hash, {alias: content_hashes.get(resource_id, resource_id)
+                                              for alias, resource_id in resources.items()}, cv)
+
+    @classmethod
+    def create_validating(cls, script, resources=None, title='', task_id=None):
+        resources = resources or {}
+        task_id = task_id or str(uuid.uuid4())
+        task = cls(task_id=task_id, title=title, script=script, resources=resources, state=TaskState.VALIDATING)
+        # Saved first: the resource controller releases the locks of lockers which are not tasks
+        task.save()
+        try:
+            GSResource.lock_resources(task_id, resources.values())
+        except Exception:
+            task.delete()
+            raise
+        return task
 
-    # TODO: test it
     @classmethod
     def create_from_script(cls, code, resources=None, title='', task_id=None):
+        spec = cls.validate_script(code, resources)
+        return GSTask.create(spec.pop('param_grid'), code, resources, title=title, task_id=task_id, **spec)
+
+    # TODO: test it
+    @classmethod
+    def validate_script(cls, code, resources=None):
         script_errors = {}
         try:
             resource_contents = cls._get_resources(resources or {})
@@ -146,6 +577,11 @@ class GSTask(me.Document):
             }
             raise ScriptParseError(script_errors)
         else:
+            # Stored with the task: numpy values are converted before they are checked
+            for param_name in search_param_names + ('halving_params',):
+                if param_name in module_globals:
+                    module_globals[param_name] = _to_bson_value(module_globals[param_name])
+
             for param_name, (required, check_func, error_msg) in task_params.items():
                 param_in_module = param_name in module_globals
                 if not param_in_module and required:
@@ -166,22 +602,56 @@ class GSTask(me.Document):
                             'traceback': ''.join(traceback.format_tb(tb))
                         }
 
+            search_mode = module_globals.get('search_mode',
+                                             'tpe' if 'param_distributions' in module_globals else 'grid')
+            search_space = 'param_distributions' if search_mode in ('random', 'tpe') else 'param_grid'
+            if search_space not in module_globals:
+                script_errors[search_space] = {
+                    'ex_message': 'There is no {} in script'.format(search_space)
+                }
+
+            param_grid = module_globals.get('param_grid', {})
+            if 'param_grid' not in script_errors:
+                param_grid, invalid = normalize_param_grid(param_grid)
+                if invalid:
+                    script_errors['param_grid'] = {
+                        'ex_message': 'param_grid values of {} should be lists of numbers, strings, booleans or '
+                                      'None'.format(', '.join(sorted(invalid)))
+                    }
+            for param_name in search_param_names + ('halving_params',):
+                if (param_name in module_globals and param_name not in script_errors and
+                        not is_bson_encodable(module_globals[param_name])):
+                    script_errors[param_name] = {
+                        'ex_message': '{} values should be numbers, strings, booleans or None'.format(param_name)
+                    }
+
             if script_errors:
                 raise ScriptParseError(script_errors)
 
-            return GSTask.create(module_globals['param_grid'], code, resources, title=title, task_id=task_id)
+            search_params = dict(module_globals.get('halving_params', {}), n_samples=len(module_globals['X']))
+            for param_name in search_param_names:
+                if param_name in module_globals:
+                    search_params[param_name] = module_globals[param_name]
+            return {'param_grid': param_grid, 'batch_size': module_globals.get('batch_size'),
+                    'search_mode': search_mode, 'search_params': search_params, 'cv': module_globals.get('cv'),
+                    'fold_parallel': module_globals.get('fold_parallel', False)}
 
     def get_resources(self):
         return self._get_resources(self.resources)
 
+    def get_cache_key(self):
+        content_hashes = GSResource.get_content_hashes(self.resources.values())
+        return self.task_id, tuple(sorted((alias, content_hashes.get(resource_id, resource_id))
+                                          for alias, resource_id in self.resources.items()))
+
     @staticmethod
     def _get_resources(resources):
         result = {}
         for resource_alias, resource_id in resources.items():
-            resource = GSResource.get_by_id(resource_id)
+            resource = GSResource.get_by_id(resource_id, include_content=False)
             if not resource:
                 raise ResourceNotFoundError(resource_id)
-            result[resource_alias] = resource.content
+            result[resource_alias] = spool.load(resource) if resource.is_array else resource.read_content()
         return result
 
     @classmethod
@@ -197,68 +667,345 @@ class GSTask(me.Document):
                 'n_subtasks': self.n_subtasks, 'n_completed': self.n_completed,
                 'best_score': self.best_score, 'best_params': self.best_params,
                 'param_errors': self.param_errors, 'title': self.title,
-                'runtime_errors': self.runtime_errors}
-
-    def _get_unique_runtime_errors(self):
-        unique_errors = {(subtask.error_info['ex_type'],
-                          subtask.error_info['ex_message'],
-                          subtask.error_info['traceback']) for subtask
-                         in self.get_subtasks() if subtask.error_info}
-        return [{'ex_type': ex_type, 'ex_message': ex_message, 'traceback': traceback} for
-                ex_type, ex_message, traceback in unique_errors]
+                'runtime_errors': self.runtime_errors, 'search_mode': self.search_mode, 'rungs': self.rungs,
+                'fold_parallel': self.fold_parallel, 'n_cache_hits': self.n_cache_hits,
+                'cache_hit_rate': self.n_cache_hits / self.n_cache_lookups if self.n_cache_lookups else None,
+                'cost_model': self.cost_model, 'phase_times': self.phase_times}
 
     def get_subtasks(self):
         return GSSubtask.objects(parent_task_id=self.task_id)
 
-    def update_state(self):
-        subtasks = self.get_subtasks()
-        subtask_states = [subtask.state for subtask in subtasks if subtask.state is not None]
-        unique_subtask_states = set(subtask_states)
-        if self.state != TaskState.CANCELED:
-            if TaskState.FAILED in unique_subtask_states:
-                self.state = TaskState.FAILED
-                self.runtime_errors = self._get_unique_runtime_errors()
-            elif TaskState.RUNNING in unique_subtask_states or all(
-                            state in unique_subtask_states for state in (TaskState.IDLE, TaskState.SUCCESS)):
-                self.state = TaskState.RUNNING
-            elif all(state == TaskState.SUCCESS for state in unique_subtask_states):
-                self.state = TaskState.SUCCESS
+    @classmethod
+    def mark_subtasks_started(cls, task_id, n_started, start_time):
+        cls._get_collection().update_one({'_id': task_id}, {'$inc': {'n_started': n_started},
+                                                            '$min': {'start_time': start_time}})
 
-        if self.state in (TaskState.FAILED, TaskState.CANCELED, TaskState.SUCCESS):
-            GSResource.unlock_resources(self.task_id, self.resources.values())
+    @classmethod
+    def aggregate_subtask_results(cls, task_id, subtasks, n_returned=0, phase_times=None):
+        cls.count_subtask_results(task_id, subtasks, n_returned, phase_times)
+        cls.update_best_scores(task_id, subtasks)
 
-        self.n_completed = sum(1 for state in subtask_states if state == TaskState.SUCCESS)
+    @classmethod
+    def count_subtask_results(cls, task_id, subtasks, n_returned=0, phase_times=None):
+        """Adds the finished subtasks to the counters of the task, in a single increment."""
+        succeeded = [subtask for subtask in subtasks if subtask.state == TaskState.SUCCESS]
+        failed = [subtask for subtask in subtasks if subtask.state == TaskState.FAILED]
+        update = {'$inc': {'n_completed': len(succeeded), 'n_failed': len(failed), 'n_started': -n_returned}}
+        for phase, duration in (phase_times or {}).items():
+            update['$inc']['phase_times.{}'.format(phase)] = duration
+        if succeeded:
+            update['$max'] = {'end_time': max(subtask.end_time for subtask in succeeded)}
+        if failed:
+            update['$addToSet'] = {'runtime_errors': {'$each': [subtask.error_info for subtask in failed]}}
+        for subtask in succeeded:
+            if subtask.rung is not None:
+                key = 'rungs.{}.n_completed'.format(subtask.rung)
+                update['$inc'][key] = update['$inc'].get(key, 0) + 1
+
+        collection = cls._get_collection()
+        task = collection.find_one_and_update({'_id': task_id}, update,
+                                              projection={'n_subtasks': True, 'n_completed': True, 'n_failed': True},
+                                              return_document=ReturnDocument.AFTER)
+        if task is None or task.get('n_failed') or task.get('n_completed', 0) >= task.get('n_subtasks', 0):
+            script_cache.invalidate(task_id)
 
-        start_times = [subtask.start_time for subtask in subtasks if subtask.start_time is not None]
-        if start_times:
-            self.start_time = min(start_times)
+    @classmethod
+    def update_best_scores(cls, task_id, subtasks):
+        """Keeps the best scores of the task and of its rungs, can be applied again without effect."""
+        collection = cls._get_collection()
+        rungs = {}
+        for subtask in subtasks:
+            if subtask.state != TaskState.SUCCESS:
+                continue
+            if subtask.rung not in rungs or rungs[subtask.rung].score < subtask.score:
+                rungs[subtask.rung] = subtask
+        for rung, best in rungs.items():
+            if rung is not None:
+                collection.update_one(
+                    {'_id': task_id, '$or': [{'rungs.{}.best_score'.format(rung): None},
+                                             {'rungs.{}.best_score'.format(rung): {'$lt': best.score}}]},
+                    {'$set': {'rungs.{}.best_score'.format(rung): best.score,
+                              'rungs.{}.best_params'.format(rung): best.params}})
+        if rungs:
+            rung = max(rungs, key=lambda rung: -1 if rung is None else rung)
+            best, rung = rungs[rung], rung or 0
+            collection.update_one(
+                {'_id': task_id, '$or': [{'best_score': None}, {'best_rung': {'$lt': rung}},
+                                         {'best_rung': {'$in': [rung, None]}, 'best_score': {'$lt': best.score}}]},
+                {'$set': {'best_score': best.score, 'best_params': best.params, 'best_rung': rung}})
 
-        end_times = [subtask.end_time for subtask in subtasks if
-                     subtask.state == TaskState.SUCCESS and subtask.end_time is not None]
-        if end_times:
-            self.end_time = max(end_times)
+    def update_state(self):
+        if self.state != TaskState.CANCELED:
+            if self.n_failed:
+                self.state = TaskState.FAILED
+            elif self.n_completed >= self.n_subtasks:
+                self.state = TaskState.SUCCESS
+            elif self.n_started:
+                self.state = TaskState.RUNNING
 
         self.actualize_date = datetime.datetime.now()
+        if not self._save_unless_finished():
+            return False
 
-        scores = [subtask.score for subtask in subtasks if subtask.state == TaskState.SUCCESS]
-        if scores:
-            self.best_score = max(scores)
-            self.best_params = [subtask.params for subtask in subtasks if subtask.score == self.best_score][0]
+        if self.state in terminal_states:
+            GSResource.unlock_resources(self.task_id, self.resources.values())
+            _cost_models.pop(self.task_id, None)
+        return True
 
-        self.save()
+    def _save_unless_finished(self):
+        """Saves the task unless it was finished meanwhile, e.g. canceled, in which case it is reloaded."""
+        try:
+            self.save(save_condition={'state__nin': terminal_states})
+        except me.errors.SaveConditionError:
+            self.reload()
+            return False
+        return True
 
     def set_param_errors(self, errors):
         self.param_errors = errors
         self.save()
 
     def cancel(self):
-        if self.state not in (TaskState.IDLE, TaskState.PENDING, TaskState.RUNNING):
+        if self.state not in (TaskState.VALIDATING, TaskState.IDLE, TaskState.PENDING, TaskState.RUNNING):
             raise TaskStateError('Cannot cancel task with {} state'.format(self.state))
         self.state = TaskState.CANCELED
-        GSResource.unlock_resources(self.task_id, self.resources.values())
         self.save()
+        n_batches = GSTask.objects(task_id=self.task_id).scalar('n_batches').first() or 0
+        if n_batches:
+            batch_ids = [self.get_batch_id(batch_no) for batch_no in range(n_batches)]
+            if conf.TaskController.backend == 'local':
+                local_backend.revoke(batch_ids)
+            else:
+                app.control.revoke(batch_ids)
+        GSSubtask.objects(parent_task_id=self.task_id, state=TaskState.IDLE).update(
+            set__state=TaskState.CANCELED)
+        GSResource.unlock_resources(self.task_id, self.resources.values())
+
+    def get_batch_size(self):
+        if self.batch_size or self.search_strategy.default_batch_size:
+            return self.batch_size or self.search_strategy.default_batch_size
+        cfg = conf.TaskController
+        n_units = self.n_subtasks * self.n_folds if self.fold_parallel else self.n_subtasks
+        if cfg.backend == 'local':
+            n_workers = local_backend.n_workers
+        else:
+            n_workers = GSWorker.get_total_concurrency(cfg.worker_timeout) or cfg.n_workers
+        batch_size = math.ceil(n_units / (n_workers * cfg.batches_per_worker))
+        return max(1, min(batch_size, cfg.max_batch_size))
+
+    @property
+    def n_folds(self):
+        return self.cv or 3
+
+    @property
+    def search_strategy(self):
+        return search_strategies[self.search_mode or 'grid']
+
+    def get_cost_model(self):
+        cfg = conf.TaskController
+        n_completed = self.n_completed or 0
+        fitted_at, model = _cost_models.get(self.task_id, (None, None))
+        # Refit once completions have grown by a quarter, not on every materialization
+        if model is not None and n_completed - fitted_at < max(cfg.cost_model_min_observations, fitted_at // 4):
+            return model
+        model = CostModel(self.search_params.get('cost_hints'), cfg.cost_model_min_observations)
+        if n_completed < model.min_observations:
+            return model
+        # The latest completions, so later halving rungs with larger samples are seen too
+        observed = list(GSSubtask.objects(parent_task_id=self.task_id, state=TaskState.SUCCESS).only(
+            'params', 'n_samples', 'predicted_cost', 'fit_times', 'score_times').order_by('-end_time').limit(
+            cfg.cost_model_max_observations))
+        candidates = [{'params': subtask.params, 'n_samples': subtask.n_samples} for subtask in observed]
+        costs = [get_cost(subtask) for subtask in observed]
+        model.score(candidates, [subtask.predicted_cost for subtask in observed], costs)
+        model.fit(candidates, costs)
+        GSTask.objects(task_id=self.task_id).update_one(set__cost_model={
+            'n_observations': model.n_observations, 'error': model.error})
+        _cost_models[self.task_id] = (n_completed, model)
+        return model
+
+    def _limit_to_probe(self, n_available):
+        """Holds a large grid back to a probe round until the cost model can order the rest of it.
+
+        The probe is released once the model is fitted on its completions, or once all of it has run.
+        """
+        cfg = conf.TaskController
+        probe_size = max(cfg.cost_model_probe_size, cfg.cost_model_min_observations)
+        if not cfg.use_cost_model or n_available <= probe_size:
+            return n_available
+        if self.n_materialized >= probe_size and (self.n_completed or 0) + (self.n_failed or 0) >= self.n_materialized:
+            return n_available
+        if self.get_cost_model().is_informative():
+            return n_available
+        return max(self.n_materialized, probe_size)
+
+    def _predict_costs(self, subtasks):
+        if not conf.TaskController.use_cost_model:
+            return False
+        model = self.get_cost_model()
+        if not model.is_informative():
+            return False
+        costs = model.predict([{'params': subtask.params, 'n_samples': subtask.n_samples} for subtask in subtasks])
+        for subtask, cost in zip(subtasks, costs):
+            subtask.predicted_cost = cost
+        return True
+
+    def _materialize(self, limit, n_available):
+        start = self.n_materialized
+        stop = min(start + limit, n_available)
+        if start >= stop or not GSTask.objects(task_id=self.task_id, n_materialized=start,
+                                               state__nin=terminal_states).update_one(set__n_materialized=stop):
+            return [], 0
+        self.n_materialized = stop
+        fold_results = {}
+        if self.fold_parallel:
+            fold_results = {name: [None] * self.n_folds for name in ('fold_scores', 'fit_times', 'score_times')}
+        subtasks = [GSSubtask(subtask_id=str(uuid.uuid4()), state=TaskState.IDLE, parent_task_id=self.task_id,
+                              **candidate, **fold_results)
+                    for candidate in self.search_strategy.get_candidates(self, start, stop)]
+        hits = self._apply_cached_results(subtasks)
+        pending = [subtask for subtask in subtasks if not subtask.is_cached]
+        self._predict_costs(pending)
+        dispatch_time = datetime.datetime.utcnow()
+        for subtask in pending:
+            subtask.dispatch_time = dispatch_time
+        GSSubtask.objects.insert(subtasks, load_bulk=False)
+        if hits:
+            self.mark_subtasks_started(self.task_id, len(hits), hits[0].start_time)
+            self.aggregate_subtask_results(self.task_id, hits)
+        return pending, len(hits)
+
+    def _apply_cached_results(self, subtasks):
+        if not self.result_namespace:
+            return []
+        for subtask in subtasks:
+            subtask.result_key = GSResult.get_key(self.result_namespace, subtask.params, subtask.n_samples)
+        results = GSResult.lookup(subtask.result_key for subtask in subtasks)
+        now = datetime.datetime.utcnow()
+        hits = [subtask for subtask in subtasks if subtask.result_key in results]
+        for subtask in hits:
+            result = results[subtask.result_key]
+            subtask.state = TaskState.SUCCESS
+            subtask.is_cached = True
+            subtask.start_time = subtask.end_time = now
+            subtask.score = result.score
+            subtask.fold_scores, subtask.fit_times, subtask.score_times = (
+                result.fold_scores, result.fit_times, result.score_times)
+        GSTask.objects(task_id=self.task_id).update_one(inc__n_cache_lookups=len(subtasks),
+                                                        inc__n_cache_hits=len(hits))
+        return hits
+
+    def dispatch(self):
+        if self.n_materialized is None or self.state in terminal_states:
+            return
+        cfg = conf.TaskController
+        n_cached = 0
+        while True:
+            n_available = self._limit_to_probe(self.search_strategy.get_n_available(self))
+            n_free = cfg.max_queued_subtasks - (self.n_materialized - self.n_started - n_cached)
+            if n_free < min(cfg.materialization_window, n_available - self.n_materialized):
+                return
+            subtasks, n_hits = self._materialize(min(n_free, cfg.materialization_window), n_available)
+            n_cached += n_hits
+            if subtasks:
+                break
+            if not n_hits:
+                return
+
+        if self.fold_parallel:
+            units = [(subtask.subtask_id, fold) for subtask in subtasks for fold in range(self.n_folds)]
+            costs = [subtask.predicted_cost for subtask in subtasks for _ in range(self.n_folds)]
+        else:
+            units = [subtask.subtask_id for subtask in subtasks]
+            costs = [subtask.predicted_cost for subtask in subtasks]
+        self._send(units, costs)
+
+    def _send(self, units, costs=None):
+        cfg = conf.TaskController
+        batch_size = self.get_batch_size()
+        if costs is None or None in costs:
+            unit_batches = [units[i:i + batch_size] for i in range(0, len(units), batch_size)]
+        else:
+            unit_batches = balance_batches(units, costs, batch_size)
+        first_batch = self._get_collection().find_one_and_update(
+            {'_id': self.task_id}, {'$inc': {'n_batches': len(unit_batches)}}, projection={'n_batches': True},
+            return_document=ReturnDocument.BEFORE).get('n_batches') or 0
+        if cfg.backend == 'local':
+            for i, unit_batch in enumerate(unit_batches):
+                local_backend.submit(self.get_batch_id(first_batch + i), unit_batch, self.task_id, self.fold_parallel)
+            return
+        run = run_subtask_folds if self.fold_parallel else run_subtasks
+        batches = [run.s(unit_batch, self.task_id).set(task_id=self.get_batch_id(first_batch + i))
+                   for i, unit_batch in enumerate(unit_batches)]
+        # The folds of a subtask may land on several queues, fold batches always go to the default queue
+        queues = [None] * len(batches) if self.fold_parallel else worker_router.assign(self.task_id, len(batches))
+        routed = {}
+        for unit_batch, queue in zip(unit_batches, queues):
+            if queue is not None:
+                routed.setdefault(queue, []).extend(unit_batch)
+        for queue, subtask_ids in routed.items():
+            GSSubtask.objects(subtask_id__in=subtask_ids).update(set__queue=queue)
+        group(batch.set(queue=queue) if queue else batch
+              for batch, queue in zip(batches, queues)).apply_async(compression='zlib')
+
+    @classmethod
+    def _reset_lost(cls, task_id, subtasks):
+        """Puts subtasks lost with their process back to IDLE, returns their task unless it is finished."""
+        subtask_ids = [subtask.subtask_id for subtask in subtasks]
+        task = cls.get_by_id(task_id)
+        if task is None or task.state in terminal_states:
+            GSSubtask.objects(subtask_id__in=subtask_ids).update(set__state=TaskState.CANCELED, unset__queue=True)
+            return None
+        GSSubtask.objects(subtask_id__in=subtask_ids).update(set__state=TaskState.IDLE, set__start_time=None,
+                                                             unset__queue=True)
+        n_running = sum(subtask.state == TaskState.RUNNING for subtask in subtasks)
+        if n_running:
+            cls._get_collection().update_one({'_id': task_id}, {'$inc': {'n_started': -n_running}})
+        return task
+
+    @classmethod
+    def requeue_stranded(cls, queue):
+        """Sends the subtasks routed to the queue of a dead worker again, through the default queue."""
+        stranded = list(GSSubtask.objects(queue=queue, state__in=[TaskState.IDLE, TaskState.RUNNING]).only(
+            'subtask_id', 'parent_task_id', 'state', 'predicted_cost'))
+        by_task = {}
+        for subtask in stranded:
+            by_task.setdefault(subtask.parent_task_id, []).append(subtask)
+        for task_id, subtasks in by_task.items():
+            task = cls._reset_lost(task_id, subtasks)
+            if task is not None:
+                task._send([subtask.subtask_id for subtask in subtasks],
+                           [subtask.predicted_cost for subtask in subtasks])
+        return len(stranded)
+
+    @classmethod
+    def requeue_batch(cls, units, parent_task_id, fold_parallel=False):
+        """Sends the unfinished units of a batch lost with its process again."""
+        subtask_ids = list({subtask_id for subtask_id, _ in units}) if fold_parallel else list(units)
+        subtasks = {subtask.subtask_id: subtask for subtask in GSSubtask.objects(
+            subtask_id__in=subtask_ids, state__in=[TaskState.IDLE, TaskState.RUNNING]).only(
+            'subtask_id', 'state', 'predicted_cost', 'fold_scores')}
+        if not subtasks:
+            return 0
+        task = cls._reset_lost(parent_task_id, list(subtasks.values()))
+        if task is None:
+            return 0
+        if fold_parallel:
+            # Folds scored before the process died are kept
+            units = [(subtask_id, fold) for subtask_id, fold in units if subtask_id in subtasks and (
+                fold >= len(subtasks[subtask_id].fold_scores) or subtasks[subtask_id].fold_scores[fold] is None)]
+            costs = None
+        else:
+            units = [subtask_id for subtask_id in units if subtask_id in subtasks]
+            costs = [subtasks[subtask_id].predicted_cost for subtask_id in units]
+        if units:
+            task._send(units, costs)
+        return len(units)
+
+    def get_batch_id(self, batch_no):
+        return '{}:{}'.format(self.task_id, batch_no)
 
     def delay(self):
         self.state = TaskState.PENDING
-        self.save()
-        group(run_subtask.s(subtask.subtask_id) for subtask in self.get_subtasks()).apply_async(compression='zlib')
+        if self._save_unless_finished():
+            self.dispatch()
@@ -0,0 +1,60 @@
+import datetime
+
+import mongoengine as me
+
+
+class GSWorker(me.Document):
+    worker_id = me.StringField(primary_key=True)
+    queue = me.StringField()
+    concurrency = me.IntField()
+    residency = me.DictField()
+    start_time = me.DateTimeField()
+    last_heartbeat = me.DateTimeField()
+
+    meta = {
+        'indexes': [
+            'last_heartbeat',
+        ]
+    }
+
+    @classmethod
+    def register(cls, worker_id, queue, concurrency):
+        now = datetime.datetime.utcnow()
+        cls._get_collection().update_one({'_id': worker_id}, {'$set': {
+            'queue': queue, 'concurrency': concurrency, 'residency': {}, 'start_time': now, 'last_heartbeat': now}},
+            upsert=True)
+
+    @classmethod
+    def heartbeat(cls, worker_id):
+        cls._get_collection().update_one({'_id': worker_id},
+                                         {'$set': {'last_heartbeat': datetime.datetime.utcnow()}})
+
+    @classmethod
+    def add_resident(cls, worker_id, task_id, n):
+        cls._get_collection().update_one({'_id': worker_id}, {'$inc': {'residency.{}'.format(task_id): n}})
+
+    @classmethod
+    def get_alive(cls, max_age):
+        return GSWorker.objects(last_heartbeat__gte=datetime.datetime.utcnow() - datetime.timedelta(seconds=max_age))
+
+    @classmethod
+    def get_dead(cls, max_age):
+        return GSWorker.objects(last_heartbeat__lt=datetime.datetime.utcnow() - datetime.timedelta(seconds=max_age))
+
+    @classmethod
+    def get_total_concurrency(cls, max_age):
+        return sum(worker.concurrency or 1 for worker in cls.get_alive(max_age).only('concurrency'))
+
+    @classmethod
+    def get_warm(cls, task_id, max_age):
+        workers = cls.get_alive(max_age).filter(__raw__={'residency.{}'.format(task_id): {'$gt': 0}})
+        return sorted(workers, key=lambda worker: -worker.residency[task_id])
+
+    @property
+    def resident_tasks(self):
+        return sorted(task_id for task_id, n in self.residency.items() if n > 0)
+
+    def to_json(self):
+        return {'worker_id': self.worker_id, 'queue': self.queue, 'concurrency': self.concurrency,
+                'resident_tasks': self.resident_tasks, 'start_time': self.start_time,
+                'last_heartbeat': self.last_heartbeat}
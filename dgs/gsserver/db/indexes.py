@@ -0,0 +1,75 @@
+import logging
+
+from dgs.gsserver.conf import conf
+from dgs.gsserver.db.gsblob import GSBlob, GSBlobChunk
+from dgs.gsserver.db.gsresource import GSResource
+from dgs.gsserver.db.gsresult import GSResult
+from dgs.gsserver.db.gstask import GSSubtask, GSTask, TaskState, terminal_states
+from dgs.gsserver.db.gsworker import GSWorker
+
+documents = (GSTask, GSSubtask, GSResource, GSBlob, GSBlobChunk, GSResult, GSWorker)
+
+
+def _backfill_title_lower(document):
+    # Documents saved before title_lower existed are invisible to title search
+    document._get_collection().update_many({'title_lower': {'$exists': False}},
+                                           [{'$set': {'title_lower': {'$toLower': {'$ifNull': ['$title', '']}}}}])
+
+
+def ensure_indexes():
+    for document in documents:
+        document.ensure_indexes()
+    for document in (GSTask, GSResource):
+        _backfill_title_lower(document)
+
+
+def get_hot_queries():
+    return {
+        'subtasks_of_task': GSSubtask.objects(parent_task_id=''),
+        'stranded_subtasks': GSSubtask.objects(queue='', state__in=[TaskState.IDLE, TaskState.RUNNING]),
+        'subtasks_by_state': GSSubtask.objects(parent_task_id='', state=TaskState.SUCCESS),
+        'cost_observations': GSSubtask.objects(parent_task_id='', state=TaskState.SUCCESS).order_by('-end_time'),
+        'subtasks_by_score': GSSubtask.objects(parent_task_id='').order_by('-score'),
+        'rung_leaders': GSSubtask.objects(parent_task_id='', rung=0, state=TaskState.SUCCESS).order_by(
+            '-score', 'subtask_id'),
+        'tasks_to_update': GSTask.objects(state__nin=terminal_states),
+        'tasks_by_state': GSTask.objects(state=TaskState.RUNNING).order_by('-start_time', '-task_id'),
+        'tasks_by_title': GSTask.objects(title_lower__startswith='a').order_by('title_lower', 'task_id'),
+        'tasks_by_date': GSTask.objects.order_by('-start_time', '-task_id'),
+        'resources_by_title': GSResource.objects(title_lower__startswith='a').order_by('title_lower', 'resource_id'),
+        'resources_by_hash': GSResource.objects(content_hash=''),
+        'locked_resources': GSResource.objects(lockers__0__exists=True),
+        'resources_to_delete': GSResource.objects(is_deletion_requested=True),
+        'blob_chunks': GSBlobChunk.objects(blob_id='', generation='').order_by('n'),
+    }
+
+
+def _get_stages(plan):
+    # Walks classic plans (inputStage(s), outerStage, innerStage) as well as SBE ones (queryPlan)
+    if isinstance(plan, list):
+        return [stage for child in plan for stage in _get_stages(child)]
+    if not isinstance(plan, dict):
+        return []
+    stages = [plan['stage']] if 'stage' in plan else []
+    for key, value in plan.items():
+        if key != 'slotBasedPlan':
+            stages.extend(_get_stages(value))
+    return stages
+
+
+def check_query_plans():
+    """Returns the names of the hot queries the planner answers with a collection scan."""
+    unindexed = []
+    for name, queryset in get_hot_queries().items():
+        plan = queryset.explain()['queryPlanner']['winningPlan']
+        if 'COLLSCAN' in _get_stages(plan):
+            unindexed.append(name)
+    return unindexed
+
+
+def init_indexes():
+    ensure_indexes()
+    if conf.Master.check_query_plans:
+        unindexed = check_query_plans()
+        if unindexed:
+            logging.warning('queries without index: {}'.format(', '.join(unindexed)))
@@ -0,0 +1,163 @@
+import logging
+import time
+from threading import Lock
+
+from dgs.gsserver import metrics
+from dgs.gsserver.conf import conf
+
+
+class SubtaskWriter:
+    """Collects the subtask updates of the Celery message being processed and writes them in bulk.
+
+    The buffer is flushed at the end of every message, by the task itself and so before its late ack: a
+    message whose results can not be written is requeued, it is never acknowledged while they are only
+    in memory. Within a long batch it is also flushed once it holds `Worker.write_buffer_size` updates
+    or its oldest one is `Worker.write_flush_interval` seconds old. The counters of the parent tasks are
+    merged per task, so a flush does one unordered bulk write, one result cache write and one aggregate
+    update per task whatever the number of subtasks.
+    """
+
+    n_writes = metrics.counter('dgs_subtask_writes_total', 'Write requests done to store subtask updates')
+    n_written = metrics.counter('dgs_subtask_updates_written_total', 'Subtask updates stored by the subtask writer')
+    n_flushes = metrics.counter('dgs_subtask_writer_flushes_total', 'Flushes of the subtask writer')
+
+    def __init__(self):
+        self._updates = []
+        self._tasks = {}
+        self._first_add = None
+        self._lock = Lock()
+        self._flush_lock = Lock()
+
+    def __len__(self):
+        return len(self._updates)
+
+    def _get_pending(self, task_id):
+        # Subtasks move to 'counted' once they are in the counters of their task, so a retry only keeps
+        # the best scores of these, it never counts them twice
+        return self._tasks.setdefault(task_id, {'subtasks': [], 'returned': [], 'counted': [], 'phase_times': {}})
+
+    def add(self, task_id, update, subtask, is_returned=False):
+        """Buffers the update of a finished subtask, or of one `is_returned` unprocessed by its batch."""
+        with self._lock:
+            if self._first_add is None:
+                self._first_add = time.time()
+            self._updates.append(update)
+            pending = self._get_pending(task_id)
+            if is_returned:
+                pending['returned'].append(subtask)
+            else:
+                pending['subtasks'].append(subtask)
+                for phase, duration in (subtask.timings or {}).items():
+                    pending['phase_times'][phase] = pending['phase_times'].get(phase, 0) + duration
+        if self.is_due():
+            try:
+                self.flush()
+            except Exception:
+                # What was not written stays buffered, the flush at the end of the message retries it
+                logging.exception('can not flush subtask updates')
+
+    def is_due(self):
+        return len(self._updates) >= conf.Worker.write_buffer_size or \
+            self._first_add is not None and time.time() - self._first_add >= conf.Worker.write_flush_interval
+
+    def _requeue(self, updates, tasks):
+        with self._lock:
+            self._updates[:0] = updates
+            for task_id, pending in tasks.items():
+                current = self._get_pending(task_id)
+                current['subtasks'][:0] = pending['subtasks']
+                current['returned'][:0] = pending['returned']
+                current['counted'][:0] = pending['counted']
+                for phase, duration in pending['phase_times'].items():
+                    current['phase_times'][phase] = current['phase_times'].get(phase, 0) + duration
+            if self._first_add is None:
+                self._first_add = time.time()
+
+    @staticmethod
+    def _drop_unmatched(tasks):
+        # An update only matches while its run still owns the subtask, a subtask taken over by another run
+        # (or canceled meanwhile) is aggregated by that run, not this one
+        from dgs.gsserver.db.gstask import GSSubtask
+
+        subtask_ids = [subtask.subtask_id for pending in tasks.values()
+                       for subtask in pending['subtasks'] + pending['returned']]
+        stored = {doc['_id']: doc for doc in GSSubtask._get_collection().find(
+            {'_id': {'$in': subtask_ids}}, {'state': True, 'run_id': True})}
+
+        def is_applied(subtask):
+            doc = stored.get(subtask.subtask_id, {})
+            return doc.get('run_id') == subtask.run_id and doc.get('state') == subtask.state
+
+        for pending in tasks.values():
+            pending['subtasks'] = [subtask for subtask in pending['subtasks'] if is_applied(subtask)]
+            pending['returned'] = [subtask for subtask in pending['returned'] if is_applied(subtask)]
+
+    def flush(self):
+        """Writes the buffer, whatever could not be written stays buffered for the next flush."""
+        from dgs.gsserver.celeryapp import send_task_changed_event
+        from dgs.gsserver.db.gsresult import GSResult
+        from dgs.gsserver.db.gstask import GSSubtask, GSTask, TaskState, observe_phases
+
+        with self._flush_lock:
+            with self._lock:
+                updates, tasks = self._updates, self._tasks
+                self._updates, self._tasks, self._first_add = [], {}, None
+            if not updates and not tasks:
+                return
+
+            write_start = time.time()
+            n_writes = 0
+            if updates:
+                try:
+                    result = GSSubtask._get_collection().bulk_write(updates, ordered=False)
+                    if result.matched_count < len(updates):
+                        self._drop_unmatched(tasks)
+                except Exception:
+                    # Updates applied before the failure do not match anymore, they are dropped by the retry
+                    self._requeue(updates, tasks)
+                    raise
+                n_writes += 1
+            succeeded = [subtask for pending in tasks.values() for subtask in pending['subtasks']
+                         if subtask.state == TaskState.SUCCESS and subtask.result_key]
+            if succeeded:
+                try:
+                    GSResult.store(succeeded)
+                    n_writes += 1
+                except Exception:
+                    logging.exception('can not store results in the result cache')
+            write_time = time.time() - write_start
+            observe_phases({'result_write': write_time})
+
+            # The counters are increments: only the steps which were not applied are kept for the next flush
+            failed = {}
+            for task_id, pending in tasks.items():
+                if pending['subtasks'] or pending['returned']:
+                    phase_times = dict(pending['phase_times'])
+                    phase_times['result_write'] = write_time * max(len(pending['subtasks']), 1) / max(len(updates), 1)
+                    try:
+                        GSTask.count_subtask_results(task_id, pending['subtasks'], n_returned=len(pending['returned']),
+                                                     phase_times=phase_times)
+                        n_writes += 1
+                    except Exception:
+                        logging.exception('can not count subtask results of task {}'.format(task_id))
+                        failed[task_id] = pending
+                        continue
+                counted = pending['counted'] + pending['subtasks']
+                try:
+                    GSTask.update_best_scores(task_id, counted)
+                except Exception:
+                    logging.exception('can not update best scores of task {}'.format(task_id))
+                    failed[task_id] = {'subtasks': [], 'returned': [], 'counted': counted, 'phase_times': {}}
+            self.n_writes.inc(n_writes)
+            self.n_written.inc(len(updates))
+            self.n_flushes.inc()
+            if failed:
+                self._requeue([], failed)
+        for task_id in tasks:
+            if task_id not in failed:
+                send_task_changed_event(task_id)
+        if failed:
+            raise RuntimeError('subtask results of {} task(s) are not aggregated yet'.format(len(failed)))
+
+
+subtask_writer = SubtaskWriter()
@@ -2,6 +2,12 @@ class ResourceUnavailableError(Exception):
     pass
 
 
+class UnknownCodecError(Exception):
+    def __init__(self, codec):
+        super().__init__('codec {} is not available'.format(codec))
+        self.codec = codec
+
+
 class ResourceNotFoundError(Exception):
     def __init__(self, resource_id):
         self.resource_id = resource_id
@@ -25,3 +31,12 @@ class TaskStateError(Exception):
 class TaskNotFoundError(Exception):
     def __init__(self, task_id):
         self.task_id = task_id
+
+
+class ValidationQueueFullError(Exception):
+    pass
+
+
+class TaskCanceledError(Exception):
+    def __init__(self, task_id):
+        self.task_id = task_id
@@ -0,0 +1,59 @@
+import logging
+import os
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+
+from dgs.gsserver import metrics
+from dgs.gsserver.conf import conf
+from dgs.gsserver.dataset_broker import connect_broker
+
+
+class MetricsReporter:
+    """Pushes the metrics of a worker child to the collector in the worker's broker process."""
+
+    def __init__(self):
+        self._collector = None
+        self._last_push = 0
+
+    def connect(self):
+        try:
+            self._collector = connect_broker().get_metrics_collector()
+        except (FileNotFoundError, ConnectionRefusedError):
+            logging.warning('dataset broker is not running, metrics of this process will not be exported')
+
+    def push(self, force=False):
+        if self._collector is None or not force and time.time() - self._last_push < conf.Worker.metrics_push_interval:
+            return
+        self._last_push = time.time()
+        try:
+            self._collector.push(os.getpid(), metrics.snapshot())
+        except Exception:
+            logging.exception('can not push metrics')
+
+
+metrics_reporter = MetricsReporter()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = metrics.render(metrics.merge_snapshots([metrics.snapshot(), self.server.collector.merged()])).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_exporter(manager, port):
+    server = ThreadingHTTPServer(('', port), _MetricsHandler)
+    server.daemon_threads = True
+    server.collector = manager.get_metrics_collector()
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
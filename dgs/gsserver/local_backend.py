@@ -0,0 +1,139 @@
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from threading import Lock, Thread
+
+from dgs.gsserver.celeryapp import init_celery_app, set_event_sink
+from dgs.gsserver.conf import conf
+from dgs.gsserver.dataset_broker import (get_broker_credentials, set_broker_credentials, shared_datasets,
+                                         start_broker, stop_broker)
+from dgs.gsserver.db.subtask_writer import subtask_writer
+
+
+def _init_process(conf_values, events, broker_credentials):
+    # Runs in a spawned process: it inherits nothing from the master, not even the conf it was started with
+    from dgs.gsserver.db import init_mongodb
+
+    conf.set_values(conf_values)
+    init_mongodb(conf.Mongo.connection)
+    init_celery_app(conf.Celery.conf)
+    set_event_sink(lambda task_id, event_time: events.put((task_id, event_time)))
+    if conf.Worker.share_datasets:
+        set_broker_credentials(*broker_credentials)
+        shared_datasets.connect()
+
+
+def _run_batch(units, parent_task_id, fold_parallel):
+    from dgs.gsserver.db.gstask import GSSubtask
+
+    try:
+        if fold_parallel:
+            GSSubtask.execute_fold_batch(units, parent_task_id)
+        else:
+            GSSubtask.execute_batch(units, parent_task_id)
+    finally:
+        subtask_writer.flush()
+
+
+class LocalBackend:
+    """Runs subtask batches on a pool of processes spawned by the master, without Celery or a broker.
+
+    The processes are spawned rather than forked: the master runs threads (Flask, the controllers, the
+    validator) whose locks a forked child could inherit held, and so is the dataset broker which shares
+    the datasets. When a process dies the pool breaks, the batches it was running are sent again on a new
+    pool.
+    """
+
+    def __init__(self, n_workers=None):
+        self.n_workers = n_workers or os.cpu_count()
+        self._context = multiprocessing.get_context('spawn')
+        self._executor = None
+        self._events = None
+        self._dataset_broker = None
+        self._futures = {}
+        self._is_stopped = False
+        self._lock = Lock()
+
+    def start(self, on_task_changed):
+        self._events = self._context.SimpleQueue()
+        set_event_sink(on_task_changed)
+        Thread(target=self._forward_events, args=(on_task_changed,), daemon=True).start()
+        if conf.Worker.share_datasets:
+            self._dataset_broker = start_broker()
+        self._executor = self._create_executor()
+
+    def _create_executor(self):
+        return ProcessPoolExecutor(self.n_workers, mp_context=self._context, initializer=_init_process,
+                                   initargs=(conf.get_values(), self._events, get_broker_credentials()))
+
+    def _restart(self, executor):
+        # Called with the lock held, the pool is only replaced once whatever the number of failed batches
+        if self._executor is executor and not self._is_stopped:
+            logging.error('local process pool is broken, restarting it')
+            executor.shutdown(wait=False)
+            self._executor = self._create_executor()
+
+    def _forward_events(self, on_task_changed):
+        while True:
+            task_id, event_time = self._events.get()
+            on_task_changed(task_id, event_time)
+
+    def _on_done(self, batch_id, future):
+        from dgs.gsserver.db.gstask import GSTask
+
+        with self._lock:
+            executor, _, units, parent_task_id, fold_parallel = self._futures.pop(batch_id)
+            is_broken = not future.cancelled() and isinstance(future.exception(), BrokenProcessPool)
+            if is_broken:
+                self._restart(executor)
+            if self._is_stopped:
+                return
+        if future.cancelled() or future.exception() is None:
+            return
+        if not is_broken:
+            logging.error('batch {} failed'.format(batch_id), exc_info=future.exception())
+            return
+        # Its subtasks would stay RUNNING forever, with n_started counting them
+        try:
+            GSTask.requeue_batch(units, parent_task_id, fold_parallel)
+        except Exception:
+            logging.exception('can not send batch {} again'.format(batch_id))
+
+    def submit(self, batch_id, units, parent_task_id, fold_parallel=False):
+        with self._lock:
+            executor = self._executor
+            try:
+                future = executor.submit(_run_batch, units, parent_task_id, fold_parallel)
+            except BrokenProcessPool:
+                self._restart(executor)
+                executor = self._executor
+                future = executor.submit(_run_batch, units, parent_task_id, fold_parallel)
+            self._futures[batch_id] = (executor, future, units, parent_task_id, fold_parallel)
+        future.add_done_callback(lambda future: self._on_done(batch_id, future))
+
+    def revoke(self, batch_ids):
+        # Running batches stop by themselves once they see their task is finished
+        for future in self._get_futures(batch_ids):
+            future.cancel()
+
+    def _get_futures(self, batch_ids=None):
+        with self._lock:
+            return [future for batch_id, (_, future, *_) in self._futures.items()
+                    if batch_ids is None or batch_id in batch_ids]
+
+    def stop(self):
+        """Cancels the pending batches, stops the pool and unlinks the shared datasets."""
+        with self._lock:
+            self._is_stopped = True
+        for future in self._get_futures():
+            future.cancel()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        if self._dataset_broker is not None:
+            stop_broker(self._dataset_broker)
+            self._dataset_broker = None
+
+
+local_backend = LocalBackend(conf.TaskController.local_workers)
@@ -0,0 +1,151 @@
+import bisect
+from collections import deque
+from threading import Lock
+
+
+class Counter:
+    def __init__(self, name, description=''):
+        self.name = name
+        self.description = description
+        self.value = 0
+        self._lock = Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def reset(self):
+        with self._lock:
+            self.value = 0
+
+    def snapshot(self):
+        return {'type': 'counter', 'description': self.description, 'value': self.value}
+
+
+class Histogram:
+    default_buckets = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, name, description='', buckets=None, n_samples=1024):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(buckets or self.default_buckets)
+        self.bucket_counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0
+        self._samples = deque(maxlen=n_samples)
+        self._lock = Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.sum += value
+            self._samples.append(value)
+
+    def reset(self):
+        with self._lock:
+            self.bucket_counts = [0] * (len(self.buckets) + 1)
+            self.count = 0
+            self.sum = 0
+            self._samples.clear()
+
+    def quantile(self, q):
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+    def to_json(self):
+        return {'count': self.count, 'sum': self.sum,
+                'p50': self.quantile(.5), 'p99': self.quantile(.99)}
+
+    def snapshot(self):
+        with self._lock:
+            return {'type': 'histogram', 'description': self.description, 'buckets': list(self.buckets),
+                    'bucket_counts': list(self.bucket_counts), 'count': self.count, 'sum': self.sum}
+
+
+class SnapshotCollector:
+    """Keeps the latest metric snapshot of every process reporting to it."""
+
+    def __init__(self):
+        self._snapshots = {}
+        self._lock = Lock()
+
+    def push(self, source, metrics):
+        with self._lock:
+            self._snapshots[source] = metrics
+
+    def merged(self):
+        with self._lock:
+            snapshots = list(self._snapshots.values())
+        return merge_snapshots(snapshots)
+
+
+_registry = {}
+_registry_lock = Lock()
+
+
+def _get_or_create(metric_cls, name, *args, **kwargs):
+    with _registry_lock:
+        if name not in _registry:
+            _registry[name] = metric_cls(name, *args, **kwargs)
+        return _registry[name]
+
+
+def counter(name, description=''):
+    return _get_or_create(Counter, name, description)
+
+
+def histogram(name, description='', buckets=None):
+    return _get_or_create(Histogram, name, description, buckets)
+
+
+def get_metrics():
+    with _registry_lock:
+        return dict(_registry)
+
+
+def snapshot():
+    return {name: metric.snapshot() for name, metric in get_metrics().items()}
+
+
+def merge_snapshots(snapshots):
+    merged = {}
+    for metrics in snapshots:
+        for name, metric in metrics.items():
+            if name not in merged:
+                merged[name] = dict(metric, bucket_counts=list(metric.get('bucket_counts', [])))
+                continue
+            total = merged[name]
+            if metric['type'] == 'counter':
+                total['value'] += metric['value']
+            elif metric['type'] == 'histogram' and metric['buckets'] == total['buckets']:
+                total['bucket_counts'] = [a + b for a, b in zip(total['bucket_counts'], metric['bucket_counts'])]
+                total['count'] += metric['count']
+                total['sum'] += metric['sum']
+    return merged
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(metrics=None):
+    """Renders metric snapshots in the Prometheus text exposition format."""
+    lines = []
+    for name, metric in sorted((snapshot() if metrics is None else metrics).items()):
+        if metric['description']:
+            lines.append('# HELP {} {}'.format(name, metric['description']))
+        lines.append('# TYPE {} {}'.format(name, metric['type']))
+        if metric['type'] == 'counter':
+            lines.append('{} {}'.format(name, _format_value(metric['value'])))
+            continue
+        cumulative = 0
+        for bound, count in zip(list(metric['buckets']) + ['+Inf'], metric['bucket_counts']):
+            cumulative += count
+            lines.append('{}_bucket{{le="{}"}} {}'.format(name, bound, cumulative))
+        lines.append('{}_sum {}'.format(name, _format_value(metric['sum'])))
+        lines.append('{}_count {}'.format(name, metric['count']))
+    return '\n'.join(lines) + '\n'
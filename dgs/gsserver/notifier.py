@@ -0,0 +1,41 @@
+import logging
+import time
+from threading import Condition, Thread
+
+
+class Notifier:
+    def __init__(self):
+        self._condition = Condition()
+        self._pending = {}
+
+    def notify(self, key=None, event_time=None):
+        with self._condition:
+            if key not in self._pending or self._pending[key] is None:
+                self._pending[key] = event_time
+            self._condition.notify_all()
+
+    def wait(self, timeout=None):
+        with self._condition:
+            if not self._pending:
+                self._condition.wait(timeout)
+            pending, self._pending = self._pending, {}
+        return pending
+
+
+class CeleryEventListener(Thread):
+    reconnect_interval = 5
+
+    def __init__(self, app, handlers):
+        super().__init__(daemon=True)
+        self.app = app
+        self.handlers = handlers
+
+    def run(self):
+        while True:
+            try:
+                with self.app.connection() as connection:
+                    receiver = self.app.events.Receiver(connection, handlers=self.handlers)
+                    receiver.capture(limit=None, timeout=None, wakeup=True)
+            except Exception:
+                logging.exception('celery event receiver failed, reconnecting')
+                time.sleep(self.reconnect_interval)
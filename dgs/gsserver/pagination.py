@@ -0,0 +1,102 @@
+import base64
+import datetime
+import time
+from threading import Lock
+
+from bson import json_util
+
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json_util.dumps(values).encode('utf8')).decode('ascii')
+
+
+# Cursor values end up in a raw query, anything else could smuggle operators in
+cursor_value_types = (type(None), bool, int, float, str, datetime.datetime)
+
+
+def decode_cursor(cursor):
+    values = json_util.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf8'))
+    if not isinstance(values, list) or not all(isinstance(value, cursor_value_types) for value in values):
+        raise ValueError('malformed cursor')
+    return values
+
+
+def _get_sort_keys(document, order):
+    order = list(order)
+    id_field = document._meta['id_field']
+    if not order or order[-1].lstrip('-') != id_field:
+        order.append(('-' if order and order[-1].startswith('-') else '') + id_field)
+    return [(key.lstrip('-'), document._fields[key.lstrip('-')].db_field, -1 if key.startswith('-') else 1)
+            for key in order]
+
+
+def _get_after_filter(sort_keys, values):
+    # Documents strictly after `values` in the sort order; MongoDB sorts nulls before any other value
+    clauses = []
+    for i, (_, db_field, direction) in enumerate(sort_keys):
+        value = values[i]
+        if value is None:
+            if direction < 0:
+                continue
+            after = {'$ne': None}
+        else:
+            after = {'$gt': value} if direction > 0 else {'$not': {'$gte': value}}
+        clause = {prev_db_field: values[j] for j, (_, prev_db_field, _) in enumerate(sort_keys[:i])}
+        clause[db_field] = after
+        clauses.append(clause)
+    return {'$or': clauses} if clauses else None
+
+
+def paginate(queryset, order, cursor=None, offset=0, count=50):
+    """Returns a page of `queryset` and the cursor of the next page, None for the last one.
+
+    Pages are keyed on the values of the `order` fields with the primary key as a tie breaker, so fetching
+    a page costs the same however deep it is. Without a cursor the page starts at `offset`.
+    """
+    sort_keys = _get_sort_keys(queryset._document, order)
+    queryset = queryset.order_by(*[('-' if direction < 0 else '') + field for field, _, direction in sort_keys])
+    if cursor is not None:
+        if len(cursor) != len(sort_keys):
+            raise ValueError('cursor does not match the sort order')
+        after = _get_after_filter(sort_keys, cursor)
+        if after is None:
+            return [], None
+        queryset = queryset.filter(__raw__=after)
+    elif offset:
+        queryset = queryset.skip(offset)
+
+    items = list(queryset.limit(count + 1))
+    if len(items) <= count:
+        return items, None
+    items = items[:count]
+    return items, encode_cursor([getattr(items[-1], field) for field, _, _ in sort_keys])
+
+
+count_modes = ('cached', 'exact', 'none')
+
+
+class CountCache:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._counts = {}
+        self._lock = Lock()
+
+    def count(self, queryset, mode='cached'):
+        if mode == 'none':
+            return None
+        if not queryset._query:
+            return queryset._document._get_collection().estimated_document_count()
+        if mode == 'exact':
+            return queryset.count()
+
+        key = (queryset._document.__name__, json_util.dumps(queryset._query, sort_keys=True))
+        now = time.time()
+        with self._lock:
+            cached = self._counts.get(key)
+            if cached is not None and now - cached[1] < self.ttl:
+                return cached[0]
+            self._counts = {k: v for k, v in self._counts.items() if now - v[1] < self.ttl}
+        total = queryset.count()
+        with self._lock:
+            self._counts[key] = (total, now)
+        return total
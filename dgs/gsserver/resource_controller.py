@@ -1,88 +1,89 @@
+import logging
 import time
-from threading import Thread, Condition, Lock
+from threading import Thread
 
+from dgs.gsserver import metrics, spool
+from dgs.gsserver.conf import conf
+from dgs.gsserver.db.gsblob import GSBlob
 from dgs.gsserver.db.gsresource import GSResource
-from dgs.gsserver.errors import ResourceNotFoundError, ResourceUnavailableError
+from dgs.gsserver.errors import ResourceNotFoundError
+from dgs.gsserver.notifier import Notifier
+from dgs.gsserver.pagination import CountCache, paginate
 
 
 class ResourceController(Thread):
-    tick_interval = 1
+    tick_interval = 30
+    sweep_duration = metrics.histogram('dgs_resource_sweep_seconds', 'Duration of resource controller sweeps')
 
     def __init__(self):
         super().__init__()
         self._running = False
-        self._resource_add_request_condition = Condition()
-        self._resource_locking_lock = Lock()
+        self._notifier = Notifier()
+        self._counts = CountCache(conf.Master.count_cache_ttl)
+        self._pending_blobs = set()
 
-    def _raise_resource_add_event(self):
-        self._resource_add_request_condition.acquire()
-        self._resource_add_request_condition.notify()
-        self._resource_add_request_condition.release()
-
-    def _wait_for_resource_add_event(self):
-        self._resource_add_request_condition.acquire()
-        self._resource_add_request_condition.wait()
-        self._resource_add_request_condition.release()
+    def notify(self, *args):
+        self._notifier.notify()
 
     def add_resource(self, resource):
         resource.save()
-        self._raise_resource_add_event()
+        self.notify()
 
-    @staticmethod
-    def schedule_resource_deletion(resource_id):
-        resource = GSResource.objects.get(resource_id=resource_id)
-        if resource:
-            resource.is_deletion_requested = True
-            resource.save()
+    def schedule_resource_deletion(self, resource_id):
+        if GSResource.objects(resource_id=resource_id).update_one(set__is_deletion_requested=True):
+            self.notify()
         else:
             raise ResourceNotFoundError(resource_id)
 
-    def lock_resources(self, locker_id, resource_ids):
-        if not resource_ids:
-            return
-        with self._resource_locking_lock:
-            for resource_id in resource_ids:
-                resource = GSResource.get_by_id(resource_id, include_content=False)
-                if resource is None or resource.is_deletion_requested:
-                    raise ResourceUnavailableError()
-                if locker_id not in resource.lockers:
-                    resource.lockers.append(locker_id)
-                    resource.save()
-
     @staticmethod
-    def get_resources(q='', is_locked=None, offset=0, count=50, include_content=True):
-        resources = GSResource.objects(title__icontains=q)
+    def lock_resources(locker_id, resource_ids):
+        GSResource.lock_resources(locker_id, resource_ids)
+
+    def get_resources(self, q='', is_locked=None, offset=0, count=50, include_content=True, cursor=None,
+                      total='cached'):
+        resources = GSResource.objects
+        if q:
+            resources = resources.filter(title_lower__startswith=q.lower())
         if is_locked is not None:
             resources = resources.filter(lockers__0__exists=is_locked)
         if not include_content:
             resources = resources.exclude('content')
-        total = resources.clone().count()
-        resources = resources.skip(offset).limit(count)
-        return total, [resource.to_json() for resource in resources]
+        n_resources = self._counts.count(resources, total)
+        resources, next_cursor = paginate(resources, ('title_lower',), cursor, offset, count)
+        return n_resources, [resource.to_json() for resource in resources], next_cursor
 
     @staticmethod
-    def update_locker_list(resource):
+    def _release_stale_lockers():
         from dgs.gsserver.db.gstask import GSTask
-        nonlockers = []
-        for locker_id in resource.lockers:
-            if not GSTask.get_by_id(locker_id):
-                nonlockers.append(locker_id)
+        lockers = GSResource.objects(lockers__0__exists=True).distinct('lockers')
+        if not lockers:
+            return
+        existing = set(GSTask.objects(task_id__in=lockers).distinct('task_id'))
+        stale = [locker_id for locker_id in lockers if locker_id not in existing]
+        if stale:
+            GSResource._get_collection().update_many({'lockers': {'$in': stale}},
+                                                     {'$pull': {'lockers': {'$in': stale}}})
 
-        if nonlockers:
-            resource.lockers = list(set(resource.lockers).difference(nonlockers))
-            resource.save()
+    def _delete_requested_resources(self):
+        resources = list(GSResource.objects(is_deletion_requested=True, lockers__0__exists=False).only(
+            'resource_id', 'content_hash'))
+        blob_ids = self._pending_blobs | {resource.content_hash for resource in resources if resource.content_hash}
+        if resources:
+            GSResource._get_collection().delete_many({'_id': {'$in': [resource.resource_id for resource in resources]},
+                                                      'lockers.0': {'$exists': False}})
+        if blob_ids:
+            deleted, self._pending_blobs = GSBlob.delete_unreferenced(blob_ids)
+            spool.remove(deleted)
 
     def run(self):
         self._running = True
         while self._running:
-            with self._resource_locking_lock:
-                for resource in GSResource.objects(lockers__0__exists=True):
-                    self.update_locker_list(resource)
-
-                for resource in GSResource.objects(is_deletion_requested=True, lockers__0__exists=False):
-                    resource.delete()
+            sweep_start = time.time()
+            try:
+                self._release_stale_lockers()
+                self._delete_requested_resources()
+            except Exception:
+                logging.exception('resource sweep failed')
+            self.sweep_duration.observe(time.time() - sweep_start)
 
-            if GSResource.objects.count():
-                time.sleep(self.tick_interval)
-            else:
-                self._wait_for_resource_add_event()
+            self._notifier.wait(self.tick_interval)
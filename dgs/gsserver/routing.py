@@ -0,0 +1,137 @@
+import logging
+import socket
+import time
+from threading import Lock, Thread
+
+from dgs.gsserver import metrics
+from dgs.gsserver.celeryapp import app
+from dgs.gsserver.conf import conf
+from dgs.gsserver.db.gsworker import GSWorker
+from dgs.gsserver.script_cache import script_cache
+
+
+_worker_id = None
+
+
+def set_worker_id(node_name):
+    """Names this worker after its Celery node, the prefork children inherit it."""
+    global _worker_id
+    _worker_id = node_name
+
+
+def get_worker_id():
+    return _worker_id or socket.gethostname()
+
+
+def get_worker_queue(worker_id=None):
+    return 'dgs.worker.{}'.format(worker_id or get_worker_id())
+
+
+def get_default_queue():
+    return app.conf.CELERY_DEFAULT_QUEUE
+
+
+def _heartbeat(worker_id):
+    while True:
+        time.sleep(conf.Worker.heartbeat_interval)
+        try:
+            GSWorker.heartbeat(worker_id)
+        except Exception:
+            logging.exception('can not send worker heartbeat')
+
+
+def start_heartbeat(concurrency):
+    worker_id = get_worker_id()
+    GSWorker.register(worker_id, get_worker_queue(worker_id), concurrency)
+    Thread(target=_heartbeat, args=(worker_id,), daemon=True).start()
+
+
+class WorkerResidency:
+    """Mirrors the tasks held in this process' script cache into the GSWorker document of its host."""
+
+    def __init__(self):
+        self.worker_id = None
+        self._task_ids = set()
+        self._lock = Lock()
+
+    def connect(self):
+        self.worker_id = get_worker_id()
+        script_cache.add_put_listener(self._on_put)
+        script_cache.add_eviction_listener(self._on_evicted)
+
+    def _update(self, task_id, n):
+        try:
+            GSWorker.add_resident(self.worker_id, task_id, n)
+        except Exception:
+            logging.exception('can not report residency of task {}'.format(task_id))
+
+    def _on_put(self, task_id):
+        with self._lock:
+            if task_id in self._task_ids:
+                return
+            self._task_ids.add(task_id)
+        self._update(task_id, 1)
+
+    def _on_evicted(self, task_id, is_finished):
+        with self._lock:
+            if task_id not in self._task_ids:
+                return
+            self._task_ids.discard(task_id)
+        self._update(task_id, -1)
+
+
+worker_residency = WorkerResidency()
+
+
+class WorkerRouter:
+    """Picks a queue for every batch of a task.
+
+    Batches go to the queues of workers which already hold the task's namespace, as long as those queues
+    are shorter than `concurrency * batches_per_worker`; the rest goes to the default queue any worker takes.
+    """
+
+    def __init__(self):
+        self.n_warm = metrics.counter('dgs_routed_batches_warm_total', 'Batches routed to workers holding the task')
+        self.n_cold = metrics.counter('dgs_routed_batches_cold_total', 'Batches routed to the default queue')
+
+    @staticmethod
+    def get_queue_depth(queue):
+        with app.connection_or_acquire() as connection:
+            return connection.default_channel.queue_declare(queue=queue, passive=True).message_count
+
+    @staticmethod
+    def purge_queue(queue):
+        with app.connection_or_acquire() as connection:
+            return connection.default_channel.queue_purge(queue)
+
+    def requeue_dead_workers(self):
+        """Purges the queues of the workers whose heartbeat expired and sends their subtasks to other workers."""
+        from dgs.gsserver.db.gstask import GSTask
+
+        cfg = conf.TaskController
+        for worker in GSWorker.get_dead(cfg.worker_timeout):
+            try:
+                self.purge_queue(worker.queue)
+            except Exception:
+                logging.exception('can not purge queue {}'.format(worker.queue))
+            n_stranded = GSTask.requeue_stranded(worker.queue)
+            if n_stranded:
+                logging.warning('requeued {} subtask(s) of dead worker {}'.format(n_stranded, worker.worker_id))
+            worker.delete()
+
+    def assign(self, task_id, n_batches):
+        cfg = conf.TaskController
+        queues = []
+        if cfg.use_affinity_routing:
+            try:
+                for worker in GSWorker.get_warm(task_id, cfg.worker_timeout):
+                    n_free = (worker.concurrency or 1) * cfg.batches_per_worker - self.get_queue_depth(worker.queue)
+                    queues.extend([worker.queue] * max(0, min(n_free, n_batches - len(queues))))
+            except Exception:
+                logging.exception('can not route batches of task {}'.format(task_id))
+        self.n_warm.inc(len(queues))
+        self.n_cold.inc(n_batches - len(queues))
+        return queues + [None] * (n_batches - len(queues))
+
+
+worker_router = WorkerRouter()
@@ -0,0 +1,93 @@
+import logging
+from collections import OrderedDict
+from threading import Lock
+
+import numpy as np
+
+from dgs.gsserver.conf import conf
+
+
+class ScriptCache:
+    def __init__(self, max_size, max_bytes=None):
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self._eviction_listeners = []
+        self._put_listeners = []
+        self._lock = Lock()
+
+    def add_eviction_listener(self, callback):
+        self._eviction_listeners.append(callback)
+
+    def add_put_listener(self, callback):
+        self._put_listeners.append(callback)
+
+    def _notify_evicted(self, task_ids, is_finished):
+        for task_id in task_ids:
+            for callback in self._eviction_listeners:
+                callback(task_id, is_finished)
+
+    @staticmethod
+    def get_namespace_size(namespace):
+        return sum(value.nbytes for value in namespace.values()
+                   if isinstance(value, np.ndarray) and not isinstance(value, np.memmap))
+
+    @property
+    def n_bytes(self):
+        return sum(self._sizes.values())
+
+    def get(self, key):
+        with self._lock:
+            namespace = self._entries.get(key)
+            if namespace is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+            return namespace
+
+    def put(self, key, namespace):
+        with self._lock:
+            is_new = key not in self._entries
+            self._entries[key] = namespace
+            self._entries.move_to_end(key)
+            self._sizes[key] = self.get_namespace_size(namespace)
+            evicted = self._evict()
+        if is_new:
+            for callback in self._put_listeners:
+                callback(key[0])
+        self._notify_evicted(evicted, False)
+        logging.debug('Script cache: {}'.format(self.stats()))
+
+    def _evict(self):
+        evicted = []
+        while len(self._entries) > 1 and (len(self._entries) > self.max_size or
+                                          self.max_bytes is not None and self.n_bytes > self.max_bytes):
+            key, _ = self._entries.popitem(last=False)
+            del self._sizes[key]
+            self.evictions += 1
+            evicted.append(key[0])
+        return evicted
+
+    def invalidate(self, task_id):
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == task_id]:
+                del self._entries[key]
+                del self._sizes[key]
+        self._notify_evicted([task_id], True)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._sizes.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'size': len(self._entries), 'n_bytes': self.n_bytes}
+
+
+script_cache = ScriptCache(conf.Worker.script_cache_size, conf.Worker.script_cache_max_bytes)
@@ -0,0 +1,270 @@
+import datetime
+import math
+
+import numpy as np
+from sklearn.grid_search import ParameterGrid
+
+from dgs.gsserver.conf import conf
+
+distribution_types = ('uniform', 'loguniform', 'randint')
+
+
+def is_valid_distributions(param_distributions):
+    for distribution in param_distributions.values():
+        if isinstance(distribution, dict):
+            if len(distribution) != 1:
+                return False
+            (kind, bounds), = distribution.items()
+            if kind not in distribution_types or len(bounds) != 2 or not bounds[0] < bounds[1]:
+                return False
+            if kind == 'loguniform' and bounds[0] <= 0:
+                return False
+        elif not isinstance(distribution, (list, tuple)) or not distribution:
+            return False
+    return True
+
+
+class _Dimension:
+    def __init__(self, distribution):
+        if isinstance(distribution, dict):
+            (self.kind, (low, high)), = distribution.items()
+            self.choices = None
+            self.bounds = low, high
+            if self.kind == 'loguniform':
+                self.low, self.high = math.log(low), math.log(high)
+            elif self.kind == 'randint':
+                # Every integer rounds from a unit wide interval, the bounds included
+                self.low, self.high = low - .5, high + .5
+            else:
+                self.low, self.high = low, high
+        else:
+            self.kind = 'choice'
+            self.choices = list(distribution)
+
+    def to_value(self, x):
+        if self.kind == 'choice':
+            return self.choices[int(x)]
+        if self.kind == 'loguniform':
+            return float(math.exp(x))
+        if self.kind == 'randint':
+            return int(min(max(round(x), self.bounds[0]), self.bounds[1]))
+        return float(x)
+
+    def from_value(self, value):
+        if value is None:
+            return None
+        if self.kind == 'choice':
+            return self.choices.index(value) if value in self.choices else None
+        return math.log(value) if self.kind == 'loguniform' else value
+
+    def sample_prior(self, random_state, size):
+        if self.kind == 'choice':
+            return random_state.randint(len(self.choices), size=size)
+        return random_state.uniform(self.low, self.high, size=size)
+
+    def sample(self, observations, random_state, size):
+        if self.kind == 'choice':
+            return random_state.choice(len(self.choices), size=size, p=self._get_weights(observations))
+        bandwidth = self._get_bandwidth(observations)
+        components = random_state.randint(len(observations) + 1, size=size)
+        samples = self.sample_prior(random_state, size)
+        from_observations = components < len(observations)
+        samples[from_observations] = random_state.normal(observations[components[from_observations]], bandwidth)
+        return np.clip(samples, self.low, self.high)
+
+    def log_density(self, observations, x):
+        if self.kind == 'choice':
+            return np.log(self._get_weights(observations)[x.astype(int)])
+        n = len(observations)
+        bandwidth = self._get_bandwidth(observations)
+        density = np.full(len(x), 1 / (self.high - self.low))
+        if n:
+            kernels = np.exp(-0.5 * ((x[:, None] - observations[None, :]) / bandwidth) ** 2)
+            density += kernels.sum(axis=1) / (bandwidth * math.sqrt(2 * math.pi))
+        return np.log(density / (n + 1))
+
+    def _get_weights(self, observations):
+        counts = np.bincount(observations.astype(int), minlength=len(self.choices)) + 1
+        return counts / counts.sum()
+
+    def _get_bandwidth(self, observations):
+        width = self.high - self.low
+        return max(width / (2 * math.sqrt(len(observations) + 1)), width / 100)
+
+
+class GridSearch:
+    default_batch_size = None
+
+    @staticmethod
+    def plan(param_grid, search_params):
+        return len(ParameterGrid(param_grid)), []
+
+    @staticmethod
+    def get_n_available(task):
+        return task.n_subtasks
+
+    @staticmethod
+    def get_candidates(task, start, stop):
+        grid = ParameterGrid(task.param_grid)
+        return [{'params': grid[i]} for i in range(start, stop)]
+
+
+class HalvingSearch:
+    default_params = {'factor': 3, 'min_samples': 30, 'random_state': 0}
+    default_batch_size = None
+
+    @classmethod
+    def get_params(cls, search_params):
+        params = dict(cls.default_params)
+        params.update(search_params)
+        return params
+
+    @classmethod
+    def plan(cls, param_grid, search_params):
+        params = cls.get_params(search_params)
+        factor = params['factor']
+        n_candidates = len(ParameterGrid(param_grid))
+        max_samples = params['n_samples']
+        n_rungs = 1
+        while (math.ceil(n_candidates / factor ** (n_rungs - 1)) > factor and
+               max_samples >= params['min_samples'] * factor ** n_rungs):
+            n_rungs += 1
+
+        rungs = []
+        for rung in range(n_rungs):
+            n_samples = max(1, int(max_samples / factor ** (n_rungs - 1 - rung)))
+            rungs.append({'rung': rung, 'n_candidates': math.ceil(n_candidates / factor ** rung),
+                          'n_samples': n_samples, 'n_completed': 0, 'best_score': None, 'best_params': None})
+        return sum(rung['n_candidates'] for rung in rungs), rungs
+
+    @staticmethod
+    def _get_rung_bounds(task):
+        start = 0
+        for rung in task.rungs:
+            yield rung, start, start + rung['n_candidates']
+            start += rung['n_candidates']
+
+    @classmethod
+    def get_n_available(cls, task):
+        n_available = 0
+        for rung, start, stop in cls._get_rung_bounds(task):
+            n_available = stop
+            if rung['n_completed'] < rung['n_candidates']:
+                break
+        return n_available
+
+    @classmethod
+    def get_candidates(cls, task, start, stop):
+        from dgs.gsserver.db.gstask import GSSubtask, TaskState
+
+        candidates = []
+        for rung, rung_start, rung_stop in cls._get_rung_bounds(task):
+            begin, end = max(start, rung_start), min(stop, rung_stop)
+            if begin >= end:
+                continue
+            if rung['rung'] == 0:
+                grid = ParameterGrid(task.param_grid)
+                params = [grid[i] for i in range(begin, end)]
+            else:
+                params = GSSubtask.objects(parent_task_id=task.task_id, rung=rung['rung'] - 1,
+                                           state=TaskState.SUCCESS).order_by('-score', 'subtask_id').skip(
+                    begin - rung_start).limit(end - begin).scalar('params')
+            candidates.extend({'params': dict(param_comb), 'rung': rung['rung'], 'n_samples': rung['n_samples']}
+                              for param_comb in params)
+        return candidates
+
+
+class RandomSearch:
+    default_params = {'n_iter': None, 'time_budget': None, 'max_iter': 1000, 'random_state': 0}
+    default_batch_size = None
+
+    @classmethod
+    def get_params(cls, search_params):
+        params = dict(cls.default_params)
+        params.update(search_params)
+        return params
+
+    @classmethod
+    def plan(cls, param_grid, search_params):
+        params = cls.get_params(search_params)
+        return params['n_iter'] or params['max_iter'], []
+
+    @classmethod
+    def _is_budget_exhausted(cls, task):
+        time_budget = cls.get_params(task.search_params)['time_budget']
+        return (time_budget is not None and task.start_time is not None and
+                datetime.datetime.utcnow() - task.start_time > datetime.timedelta(seconds=time_budget))
+
+    @classmethod
+    def get_n_available(cls, task):
+        if task.n_materialized < task.n_subtasks and cls._is_budget_exhausted(task):
+            from dgs.gsserver.db.gstask import GSTask
+            GSTask.objects(task_id=task.task_id, n_materialized=task.n_materialized).update_one(
+                set__n_subtasks=task.n_materialized)
+            task.reload()
+        return task.n_subtasks
+
+    @classmethod
+    def _get_dimensions(cls, task):
+        return {name: _Dimension(distribution) for name, distribution in
+                task.search_params['param_distributions'].items()}
+
+    @classmethod
+    def _get_random_state(cls, task, start):
+        return np.random.RandomState([cls.get_params(task.search_params)['random_state'], start])
+
+    @classmethod
+    def get_candidates(cls, task, start, stop):
+        dimensions = cls._get_dimensions(task)
+        random_state = cls._get_random_state(task, start)
+        samples = {name: dimension.sample_prior(random_state, stop - start) for name, dimension in dimensions.items()}
+        return [{'params': {name: dimensions[name].to_value(samples[name][i]) for name in dimensions}}
+                for i in range(stop - start)]
+
+
+class TPESearch(RandomSearch):
+    default_params = dict(RandomSearch.default_params, n_startup=10, n_parallel=None, gamma=0.25,
+                          n_ei_candidates=24)
+    default_batch_size = 1
+
+    @classmethod
+    def get_n_available(cls, task):
+        n_subtasks = super().get_n_available(task)
+        n_parallel = cls.get_params(task.search_params)['n_parallel'] or conf.TaskController.n_workers
+        return min(n_subtasks, task.n_completed + task.n_failed + n_parallel)
+
+    @classmethod
+    def get_candidates(cls, task, start, stop):
+        from dgs.gsserver.db.gstask import GSSubtask, TaskState
+
+        params = cls.get_params(task.search_params)
+        history = list(GSSubtask.objects(parent_task_id=task.task_id, state=TaskState.SUCCESS,
+                                         score__ne=None).order_by('-score').only('params', 'score'))
+        if len(history) < params['n_startup']:
+            return super().get_candidates(task, start, stop)
+
+        n_good = max(1, int(math.ceil(params['gamma'] * len(history))))
+        dimensions = cls._get_dimensions(task)
+        random_state = cls._get_random_state(task, start)
+        n_candidates = params['n_ei_candidates']
+        samples = {}
+        scores = np.zeros((stop - start, n_candidates))
+        for name, dimension in dimensions.items():
+            observations = [dimension.from_value(subtask.params.get(name)) for subtask in history]
+            good = np.array([x for x in observations[:n_good] if x is not None], dtype=float)
+            bad = np.array([x for x in observations[n_good:] if x is not None], dtype=float)
+            x = dimension.sample(good, random_state, (stop - start) * n_candidates)
+            scores += (dimension.log_density(good, x) - dimension.log_density(bad, x)).reshape(scores.shape)
+            samples[name] = x.reshape(scores.shape)
+
+        best = scores.argmax(axis=1)
+        return [{'params': {name: dimensions[name].to_value(samples[name][i, best[i]]) for name in dimensions}}
+                for i in range(stop - start)]
+
+
+search_strategies = {
+    'grid': GridSearch,
+    'halving': HalvingSearch,
+    'random': RandomSearch,
+    'tpe': TPESearch,
+}
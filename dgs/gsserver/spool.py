@@ -0,0 +1,101 @@
+import io
+import logging
+import os
+import re
+import shutil
+import tempfile
+import zipfile
+
+import numpy as np
+
+from dgs.gsserver.conf import conf
+
+array_formats = ('npy', 'npz')
+_spool_name = re.compile(r'^([0-9a-f]{40})(\.npy)?$')
+
+
+def _read_npy_header(fp):
+    version = np.lib.format.read_magic(fp)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(fp)
+    else:
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(fp)
+    if dtype.hasobject:
+        raise ValueError('arrays of objects are not supported')
+    return {'dtype': dtype.str, 'shape': list(shape)}
+
+
+def get_array_meta(content, resource_format):
+    if resource_format == 'npy':
+        return _read_npy_header(io.BytesIO(content))
+    with zipfile.ZipFile(io.BytesIO(content)) as archive:
+        names = [name[:-len('.npy')] for name in archive.namelist() if name.endswith('.npy')]
+        # Member names become spool file names and script variable names
+        invalid = [name for name in names if not name.isidentifier()]
+        if invalid:
+            raise ValueError('npz array names should be identifiers, got {}'.format(', '.join(map(repr, invalid))))
+        return {name: _read_npy_header(archive.open(name + '.npy')) for name in names}
+
+
+def _write_atomic(path, data):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+def _spool(resource):
+    spool_dir = conf.Worker.spool_dir
+    os.makedirs(spool_dir, exist_ok=True)
+    if resource.format == 'npy':
+        path = os.path.join(spool_dir, '{}.npy'.format(resource.content_hash))
+        if not os.path.exists(path):
+            _write_atomic(path, resource.read_content())
+        return path
+
+    path = os.path.join(spool_dir, resource.content_hash)
+    paths = {name: os.path.join(path, '{}.npy'.format(name)) for name in resource.arrays}
+    if not all(os.path.exists(member_path) for member_path in paths.values()):
+        os.makedirs(path, exist_ok=True)
+        with zipfile.ZipFile(io.BytesIO(resource.read_content())) as archive:
+            for name, member_path in paths.items():
+                _write_atomic(member_path, archive.read('{}.npy'.format(name)))
+    return paths
+
+
+def load(resource):
+    paths = _spool(resource)
+    if isinstance(paths, dict):
+        return {name: np.load(path, mmap_mode='r') for name, path in paths.items()}
+    return np.load(paths, mmap_mode='r')
+
+
+def remove(content_hashes):
+    spool_dir = conf.Worker.spool_dir
+    for content_hash in content_hashes:
+        path = os.path.join(spool_dir, content_hash)
+        try:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            if os.path.exists(path + '.npy'):
+                os.remove(path + '.npy')
+        except OSError:
+            logging.exception('can not remove spool files of {}'.format(content_hash))
+
+
+def prune():
+    """Removes the spool files of contents no resource references any more."""
+    from dgs.gsserver.db.gsresource import GSResource
+
+    try:
+        names = os.listdir(conf.Worker.spool_dir)
+    except FileNotFoundError:
+        return
+    content_hashes = {match.group(1) for match in map(_spool_name.match, names) if match}
+    if content_hashes:
+        referenced = set(GSResource.objects(content_hash__in=list(content_hashes)).distinct('content_hash'))
+        remove(content_hashes - referenced)
@@ -1,84 +1,192 @@
 import logging
 import time
-from threading import Thread, Condition
+from threading import Thread
 
 import mongoengine as me
 from celery.task.control import discard_all
 
+from dgs.gsserver import metrics
+from dgs.gsserver.celeryapp import app, TASK_CHANGED_EVENT
 from dgs.gsserver.conf import conf
-from dgs.gsserver.db.gstask import GSTask, TaskState
-from dgs.gsserver.errors import TaskNotFoundError
+from dgs.gsserver.db.gsresource import GSResource
+from dgs.gsserver.db.gstask import GSTask, TaskState, terminal_states
+from dgs.gsserver.errors import TaskNotFoundError, TaskStateError
+from dgs.gsserver.local_backend import local_backend
+from dgs.gsserver.notifier import Notifier, CeleryEventListener
+from dgs.gsserver.pagination import CountCache, paginate
+from dgs.gsserver.routing import worker_router
+from dgs.gsserver.task_events import TaskEventStream
+from dgs.gsserver.validator import ScriptValidator
 
 logging.basicConfig(level=logging.DEBUG)
 
+task_orders = {
+    'date': ('-start_time',),
+    'date_asc': ('start_time',),
+    'title': ('title_lower',),
+}
+
 
 class TaskController(Thread):
     cfg = conf.TaskController
 
+    propagation_latency = metrics.histogram('dgs_state_propagation_seconds',
+                                            'Time from a worker-side change to its task state update')
+    sweep_duration = metrics.histogram('dgs_task_controller_sweep_seconds', 'Duration of task controller sweeps')
+    n_tasks_updated = metrics.counter('dgs_tasks_updated_total', 'Task updates done by the task controller')
+
     def __init__(self):
         super().__init__()
         self._running = False
-        self._task_add_condition = Condition()
+        self._notifier = Notifier()
+        self._counts = CountCache(conf.Master.count_cache_ttl)
+        self.events = TaskEventStream(conf.Master.event_buffer_size)
+        self._validator = ScriptValidator(self.cfg)
+        self._listeners = []
+        self._event_listener = CeleryEventListener(app, {TASK_CHANGED_EVENT: self._on_task_changed_event})
 
-    def _raise_task_add_event(self):
-        self._task_add_condition.acquire()
-        self._task_add_condition.notify()
-        self._task_add_condition.release()
+    def _on_task_changed_event(self, event):
+        self.notify_task_changed(event['task_id'], event.get('event_time'))
 
-    def _wait_for_task_add_event(self):
-        self._task_add_condition.acquire()
-        self._task_add_condition.wait()
-        self._task_add_condition.release()
+    def notify_task_changed(self, task_id, event_time=None):
+        self._notifier.notify(task_id, event_time)
+
+    def add_listener(self, callback):
+        self._listeners.append(callback)
 
     def add_task(self, task):
         # TODO: think about mutual exclusion with task updation
         task.delay()
-        task.save()
-        self._raise_task_add_event()
+        self.notify_task_changed(task.task_id, time.time())
 
-    @staticmethod
-    def get_tasks(sort='date', state=None, q='', offset=0, count=50):
-        tasks = GSTask.objects(title__icontains=q).order_by('-start_time')
+    def submit_task(self, task):
+        self.events.publish(task)
+        try:
+            self._validator.submit(task.script, task.resources,
+                                   lambda spec, errors: self._on_validated(task, spec, errors))
+        except Exception:
+            task.delete()
+            GSResource.unlock_resources(task.task_id, task.resources.values())
+            raise
+
+    def _on_validated(self, task, spec, errors):
+        try:
+            if errors is None:
+                task.configure(**spec)
+                task.state = TaskState.PENDING
+            else:
+                task.state = TaskState.FAILED
+                task.param_errors = errors
+            task.save(save_condition={'state': TaskState.VALIDATING})
+        except me.errors.SaveConditionError:
+            logging.info('task {} was canceled while being validated'.format(task.task_id))
+            return
+        except Exception as e:
+            logging.exception('can not configure task {}'.format(task.task_id))
+            # The task object may hold the values which could not be saved, only the failure is written
+            try:
+                if not GSTask.objects(task_id=task.task_id, state=TaskState.VALIDATING).update_one(
+                        set__state=TaskState.FAILED, set__param_errors={'script': {'ex_message': str(e)}}):
+                    logging.info('task {} was canceled while being validated'.format(task.task_id))
+                    return
+                task = GSTask.get_by_id(task.task_id)
+            except Exception:
+                logging.exception('can not mark task {} as failed'.format(task.task_id))
+                return
+            if task is None:
+                return
+
+        if task.state == TaskState.PENDING:
+            self.add_task(task)
+        else:
+            GSResource.unlock_resources(task.task_id, task.resources.values())
+            for callback in self._listeners:
+                callback(task)
+        self.events.publish(task)
+
+    def _resume_validation(self):
+        for task in GSTask.objects(state=TaskState.VALIDATING):
+            self._validator.submit(task.script, task.resources,
+                                   lambda spec, errors, task=task: self._on_validated(task, spec, errors))
+
+    def get_tasks(self, sort='date', state=None, q='', offset=0, count=50, cursor=None, total='cached'):
+        tasks = GSTask.objects
+        if q:
+            tasks = tasks.filter(title_lower__startswith=q.lower())
         if state and state != 'ALL':
-            tasks = tasks.filter(state__iexact=state)
-        total = tasks.clone().count()
-        if sort != 'date':
-            tasks = tasks
-        tasks = tasks.skip(offset).limit(count)
-        return total, [task.to_json() for task in tasks]
+            tasks = tasks.filter(state=state.upper())
+        n_tasks = self._counts.count(tasks, total)
+        tasks, next_cursor = paginate(tasks, task_orders[sort], cursor, offset, count)
+        return n_tasks, [task.to_json() for task in tasks], next_cursor
 
-    @staticmethod
-    def cancel_task(task_id):
+    def cancel_task(self, task_id):
         task = GSTask.get_by_id(task_id)
         if task:
             task.cancel()
+            self.events.publish(task)
         else:
             raise TaskNotFoundError(task_id)
 
-    @staticmethod
-    def cancel_all_tasks():
-        discard_all()
+    def cancel_all_tasks(self):
+        for task in GSTask.objects(state__nin=terminal_states):
+            try:
+                task.cancel()
+            except TaskStateError:
+                continue
+            self.events.publish(task)
+        if self.cfg.backend == 'celery':
+            discard_all()
 
-    @staticmethod
-    def _update(tasks):
+    def _update(self, tasks):
         for task in tasks:
-            task.update_state()
+            state = task.state
+            # A task canceled since it was loaded is reloaded, and not dispatched
+            if task.update_state():
+                task.dispatch()
+            self.events.publish(task)
+            if task.state != state:
+                for callback in self._listeners:
+                    callback(task)
 
     @staticmethod
-    def _get_tasks_to_update():
-        return GSTask.objects(
-            me.Q(state__ne=TaskState.FAILED) & me.Q(state__ne=TaskState.CANCELED) & me.Q(state__ne=TaskState.SUCCESS))
+    def _get_tasks_to_update(task_ids=None):
+        tasks = GSTask.objects(state__nin=terminal_states + (TaskState.VALIDATING,))
+        if task_ids is not None:
+            tasks = tasks.filter(task_id__in=task_ids)
+        return tasks
 
     def run(self):
         self._running = True
+        if self.cfg.backend == 'local':
+            local_backend.start(self.notify_task_changed)
+        elif self.cfg.use_celery_events:
+            self._event_listener.start()
+        self._resume_validation()
+        last_full_sweep = 0
         while self._running:
-            tasks_to_update = self._get_tasks_to_update()
+            pending = self._notifier.wait(self.cfg.tick_interval)
+            if pending:
+                time.sleep(self.cfg.event_coalesce_interval)
+                pending.update(self._notifier.wait(0))
+            sweep_start = time.time()
+            # Events keep coming on a busy cluster, the full sweep still runs every tick
+            task_ids = None if not pending or None in pending else list(pending)
+            if sweep_start - last_full_sweep >= self.cfg.tick_interval:
+                task_ids = None
+            if task_ids is None:
+                last_full_sweep = sweep_start
+                if self.cfg.backend == 'celery':
+                    try:
+                        worker_router.requeue_dead_workers()
+                    except Exception:
+                        logging.exception('can not requeue subtasks of dead workers')
+            tasks_to_update = list(self._get_tasks_to_update(task_ids))
             logging.debug('Found {} task(s) to update'.format(len(tasks_to_update)))
-            if tasks_to_update:
-                self._update(tasks_to_update)
-                time.sleep(self.cfg.tick_interval)
-            elif self.cfg.wait_task_add_event:
-                logging.debug('Waiting an event')
-                self._wait_for_task_add_event()
-            else:
-                time.sleep(self.cfg.tick_interval)
+            self._update(tasks_to_update)
+            self.n_tasks_updated.inc(len(tasks_to_update))
+
+            now = time.time()
+            self.sweep_duration.observe(now - sweep_start)
+            for event_time in pending.values():
+                if event_time is not None:
+                    self.propagation_latency.observe(now - event_time)
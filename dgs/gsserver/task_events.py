@@ -0,0 +1,115 @@
+import calendar
+import datetime
+import json
+import math
+from email.utils import formatdate
+from collections import OrderedDict
+from threading import Condition, Lock
+
+from dgs.gsserver.db.gstask import TaskState, terminal_states
+
+delta_fields = ('state', 'n_subtasks', 'n_completed', 'n_failed', 'best_score', 'best_params', 'start_time',
+                'end_time', 'param_errors', 'runtime_errors', 'actualize_date')
+
+# Changes on every sweep, only sent along with another change
+_passive_fields = ('actualize_date',)
+
+
+def _to_json_value(value):
+    if isinstance(value, datetime.datetime):
+        # The format of /task_info
+        return formatdate(calendar.timegm(value.utctimetuple()), usegmt=True)
+    # JSON.parse rejects the NaN json.dumps writes for a NaN score
+    return None if isinstance(value, float) and not math.isfinite(value) else value
+
+
+def get_delta(task):
+    return dict({'task_id': task.task_id}, **{field: _to_json_value(getattr(task, field)) for field in delta_fields})
+
+
+def format_event(event, data):
+    return 'event: {}\ndata: {}\n\n'.format(event, json.dumps(data))
+
+
+class Subscription:
+    """Pending deltas of one client, coalesced per task.
+
+    A client that falls more than `buffer_size` tasks behind loses its pending deltas and is told to resync
+    from /task_info instead, so a slow consumer never holds more than `buffer_size` deltas in the master.
+    With `include_new`, a client following some tasks also gets the first delta of every submitted task.
+    """
+
+    def __init__(self, task_ids, buffer_size, include_new=False):
+        self.task_ids = set(task_ids) if task_ids or include_new else None
+        self.buffer_size = buffer_size
+        self.include_new = include_new
+        self.n_resyncs = 0
+        self._pending = OrderedDict()
+        self._is_lagging = False
+        self._condition = Condition()
+
+    def put(self, delta):
+        if self.task_ids is not None and delta['task_id'] not in self.task_ids and not (
+                self.include_new and delta.get('state') == TaskState.VALIDATING):
+            return
+        with self._condition:
+            if delta['task_id'] in self._pending:
+                self._pending[delta['task_id']].update(delta)
+            elif len(self._pending) >= self.buffer_size:
+                self._pending.clear()
+                self._is_lagging = True
+                self.n_resyncs += 1
+            else:
+                self._pending[delta['task_id']] = dict(delta)
+            self._condition.notify()
+
+    def get(self, timeout):
+        with self._condition:
+            if not self._pending and not self._is_lagging:
+                self._condition.wait(timeout)
+            events = [('resync', {})] if self._is_lagging else []
+            events.extend(('task', delta) for delta in self._pending.values())
+            self._pending.clear()
+            self._is_lagging = False
+            return events
+
+
+class TaskEventStream:
+    def __init__(self, buffer_size):
+        self.buffer_size = buffer_size
+        self._subscriptions = set()
+        self._last_deltas = {}
+        self._lock = Lock()
+
+    def subscribe(self, task_ids=(), include_new=False):
+        subscription = Subscription(task_ids, self.buffer_size, include_new)
+        with self._lock:
+            self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    def publish(self, task):
+        delta = get_delta(task)
+        with self._lock:
+            last_delta = self._last_deltas.get(task.task_id, {})
+            changes = {field: value for field, value in delta.items()
+                       if field != 'task_id' and last_delta.get(field) != value}
+            if all(field in _passive_fields for field in changes):
+                changes = {}
+            if task.state in terminal_states:
+                self._last_deltas.pop(task.task_id, None)
+            else:
+                self._last_deltas[task.task_id] = delta
+            subscriptions = list(self._subscriptions)
+        if not changes:
+            return
+        changes['task_id'] = task.task_id
+        for subscription in subscriptions:
+            subscription.put(changes)
+
+    def stats(self):
+        with self._lock:
+            return {'n_subscriptions': len(self._subscriptions), 'n_tracked_tasks': len(self._last_deltas)}
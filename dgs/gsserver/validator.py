@@ -0,0 +1,145 @@
+import hashlib
+import logging
+import multiprocessing
+import pickle
+import resource
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+from dgs.gsserver.conf import conf
+from dgs.gsserver.db.gsresource import GSResource
+from dgs.gsserver.db.gsresult import GSResult
+from dgs.gsserver.errors import ResourceNotFoundError, ScriptParseError, ValidationQueueFullError
+
+
+def _get_error(message):
+    return {'script': {'ex_message': message}}
+
+
+def _run_validation(script, resources, memory_limit=None):
+    from dgs.gsserver.db.gstask import GSTask
+
+    try:
+        return GSTask.validate_script(script, resources), None
+    except ScriptParseError as e:
+        return None, e.script_errors
+    except ResourceNotFoundError as e:
+        return None, {'resources': {'ex_message': 'Resource {} not found'.format(e.resource_id)}}
+    except MemoryError:
+        return None, _get_error('Script exceeded the memory limit of {} bytes'.format(memory_limit))
+
+
+def _validate(conn, conf_values, script, resources, memory_limit):
+    # Runs in a spawned process: the script and its resources never touch the master's memory
+    from dgs.gsserver.db import init_mongodb
+
+    if memory_limit:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+    conf.set_values(conf_values)
+    init_mongodb(conf.Mongo.connection)
+    try:
+        result = _run_validation(script, resources, memory_limit)
+        try:
+            conn.send(result)
+        except Exception as e:
+            conn.send((None, _get_error('Script validation result can not be sent back: {}'.format(e))))
+    finally:
+        conn.close()
+
+
+class ScriptValidator:
+    """Validates task scripts in a bounded pool of spawned processes.
+
+    Every script runs in a fresh process under an address space limit and is killed when it outlives the
+    timeout, unless `isolate_validation` is off and scripts run on the pool threads themselves. Outcomes
+    other than timeouts and crashes are cached by script and resource content hashes.
+    """
+
+    def __init__(self, cfg):
+        self.n_validators = cfg.n_validators
+        self.timeout = cfg.validation_timeout
+        self.memory_limit = cfg.validation_memory_limit
+        self.max_pending = cfg.max_pending_validations
+        self.cache_size = cfg.validation_cache_size
+        self.isolate = cfg.isolate_validation
+        self._context = multiprocessing.get_context('spawn')
+        self._executor = ThreadPoolExecutor(max_workers=self.n_validators)
+        self._results = OrderedDict()
+        self._n_pending = 0
+        self._lock = Lock()
+
+    @staticmethod
+    def get_key(script, resources):
+        content_hashes = GSResource.get_content_hashes(resources.values())
+        return GSResult.get_key(hashlib.sha256(script.encode('utf8')).hexdigest(),
+                                {alias: content_hashes.get(resource_id, resource_id)
+                                 for alias, resource_id in resources.items()})
+
+    def _get_cached(self, key):
+        with self._lock:
+            result = self._results.get(key)
+            if result is not None:
+                self._results.move_to_end(key)
+            return result
+
+    def _put_cached(self, key, result):
+        with self._lock:
+            self._results[key] = result
+            while len(self._results) > self.cache_size:
+                self._results.popitem(last=False)
+
+    def submit(self, script, resources, callback):
+        """Schedules `callback(spec, errors)` for when the script is validated, without running a cached script."""
+        key = self.get_key(script, resources)
+        cached = self._get_cached(key)
+        if cached is not None:
+            self._executor.submit(callback, *cached)
+            return
+        with self._lock:
+            if self._n_pending >= self.max_pending:
+                raise ValidationQueueFullError()
+            self._n_pending += 1
+        self._executor.submit(self._run, key, script, resources, callback)
+
+    def _run(self, key, script, resources, callback):
+        try:
+            result, is_cacheable = self._validate(script, resources)
+            if is_cacheable:
+                self._put_cached(key, result)
+        except Exception:
+            logging.exception('script validation failed')
+            result = None, _get_error('Script validation failed')
+        finally:
+            with self._lock:
+                self._n_pending -= 1
+        try:
+            callback(*result)
+        except Exception:
+            logging.exception('can not handle validation result')
+
+    def _validate(self, script, resources):
+        if not self.isolate:
+            return _run_validation(script, resources), True
+        parent_conn, child_conn = self._context.Pipe(duplex=False)
+        process = self._context.Process(target=_validate, daemon=True, args=(
+            child_conn, conf.get_values(), script, resources, self.memory_limit))
+        process.start()
+        child_conn.close()
+        try:
+            if not parent_conn.poll(self.timeout):
+                return (None, _get_error('Script validation timed out after {} seconds'.format(self.timeout))), False
+            return parent_conn.recv(), True
+        except (EOFError, OSError, pickle.UnpicklingError):
+            process.join(1)
+            return (None, _get_error('Script validation process crashed with exit code {}'.format(
+                process.exitcode))), False
+        finally:
+            if process.is_alive():
+                process.kill()
+            process.join()
+            parent_conn.close()
+
+    def stats(self):
+        with self._lock:
+            return {'n_pending': self._n_pending, 'n_cached': len(self._results)}
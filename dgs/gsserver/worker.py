@@ -1,21 +1,25 @@
+import sys
+
 from dgs.gsserver.celeryapp import app
 from dgs.gsserver.celeryapp import init_celery_app
 from dgs.gsserver.conf import conf
 from dgs.gsserver.db import init_mongodb
+from dgs.gsserver.routing import get_default_queue
 
 
-def run_worker():
+def run_worker(args=()):
     init_mongodb(conf.Mongo.connection)
     init_celery_app(conf.Celery.conf)
 
     app.worker_main([
         'worker',
         '--loglevel=info',
-    ])
+        '--queues={}'.format(get_default_queue()),
+    ] + list(args))
 
 
 def entry_point():
-    run_worker()
+    run_worker(sys.argv[1:])
 
 
 if __name__ == '__main__':
@@ -0,0 +1,80 @@
+import pytest
+
+from dgs.gsserver.cost_model import CostModel, balance_batches, get_cost
+
+
+def make_candidates():
+    return [{'params': {'n_estimators': n, 'kernel': kernel}} for n in (10, 20, 50, 100, 200)
+            for kernel in ('rbf', 'linear')]
+
+
+def true_cost(candidate):
+    return candidate['params']['n_estimators'] * (3 if candidate['params']['kernel'] == 'rbf' else 1) / 100
+
+
+def test_falls_back_to_hints_until_enough_observations():
+    candidates = make_candidates()
+    model = CostModel({'n_estimators': 1}, min_observations=20).fit(candidates, map(true_cost, candidates))
+    assert model.n_observations == 10
+    assert model.predict([{'params': {'n_estimators': 50}}]) == [50.]
+    assert model.is_informative()
+
+    without_hints = CostModel(min_observations=20).fit(candidates, map(true_cost, candidates))
+    assert without_hints.predict([{'params': {'n_estimators': 50}}]) == [1.]
+    assert not without_hints.is_informative()
+
+
+def test_learns_numeric_and_categorical_costs():
+    candidates = make_candidates()
+    model = CostModel(min_observations=5).fit(candidates, [true_cost(candidate) for candidate in candidates])
+    unseen = [{'params': {'n_estimators': 400, 'kernel': 'rbf'}}, {'params': {'n_estimators': 400, 'kernel': 'linear'}}]
+    rbf, linear = model.predict(unseen)
+    assert rbf == pytest.approx(12, rel=.05)
+    assert linear == pytest.approx(4, rel=.05)
+
+
+def test_ignores_missing_and_zero_costs():
+    candidates = make_candidates()
+    costs = [true_cost(candidate) for candidate in candidates]
+    costs[0], costs[1] = None, 0
+    assert CostModel(min_observations=1).fit(candidates, costs).n_observations == 8
+
+
+def test_halving_sample_size_is_a_feature():
+    candidates = [{'params': {'C': 1}, 'n_samples': n} for n in (10, 30, 90, 270)]
+    model = CostModel(min_observations=4).fit(candidates, [n / 10 for n in (10, 30, 90, 270)])
+    assert model.predict([{'params': {'C': 1}, 'n_samples': 810}])[0] == pytest.approx(81, rel=.05)
+
+
+def test_score_is_the_median_log_ratio():
+    model = CostModel()
+    assert model.score([], [2, 1, 4], [1, 1, 4]) == pytest.approx(0)
+    assert model.score([], [2, 2, 4], [1, 1, 4]) == pytest.approx(0.6931, rel=1e-3)
+    assert model.score([], [None], [1]) is None
+
+
+def test_get_cost_sums_fit_and_score_times():
+    class Subtask:
+        fit_times = [1., None, 2.]
+        score_times = [.5]
+
+    assert get_cost(Subtask) == 3.5
+    Subtask.fit_times = Subtask.score_times = None
+    assert get_cost(Subtask) is None
+
+
+def test_balance_batches_packs_longest_first():
+    items = ['a', 'b', 'c', 'd', 'e', 'f']
+    costs = [5, 4, 3, 3, 2, 1]
+    batches = balance_batches(items, costs, 3)
+    assert sorted(item for batch in batches for item in batch) == items
+    assert all(len(batch) <= 3 for batch in batches)
+    totals = [sum(costs[items.index(item)] for item in batch) for batch in batches]
+    assert totals == [9, 9]
+    assert batches[0][0] == 'a'
+
+
+def test_balance_batches_orders_batches_most_expensive_first():
+    batches = balance_batches(list(range(5)), [1, 1, 1, 1, 10], 1)
+    assert batches[0] == [4]
+    assert len(batches) == 5
@@ -0,0 +1,41 @@
+"""Checks that the hot queries are answered by an index.
+
+Needs a real mongod, set DGS_TEST_MONGO to its URI (e.g. mongodb://localhost/dgs-test). The database
+named in the URI is dropped after the test.
+"""
+import os
+
+import pytest
+
+pytest.importorskip('mongoengine')
+
+mongo_uri = os.environ.get('DGS_TEST_MONGO')
+needs_mongo = pytest.mark.skipif(not mongo_uri, reason='DGS_TEST_MONGO is not set')
+
+
+@pytest.fixture
+def database():
+    from mongoengine import connect, disconnect
+
+    client = connect(host=mongo_uri)
+    yield client.get_default_database()
+    client.drop_database(client.get_default_database().name)
+    disconnect()
+
+
+@needs_mongo
+def test_hot_queries_use_indexes(database):
+    from dgs.gsserver.db.indexes import check_query_plans, ensure_indexes
+
+    ensure_indexes()
+    assert check_query_plans() == []
+
+
+def test_stages_of_classic_and_sbe_plans():
+    from dgs.gsserver.db.indexes import _get_stages
+
+    classic = {'stage': 'FETCH', 'inputStage': {'stage': 'IXSCAN'}}
+    sbe = {'queryPlan': {'stage': 'SORT', 'inputStage': {'stage': 'COLLSCAN'}},
+           'slotBasedPlan': {'stages': '[1] scan s1'}}
+    assert _get_stages(classic) == ['FETCH', 'IXSCAN']
+    assert _get_stages(sbe) == ['SORT', 'COLLSCAN']
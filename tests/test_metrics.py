@@ -0,0 +1,49 @@
+from dgs.gsserver import metrics
+
+
+def test_render_counters_and_cumulative_histogram_buckets():
+    counter = metrics.Counter('dgs_test_total', 'Things counted')
+    counter.inc(3)
+    histogram = metrics.Histogram('dgs_test_seconds', buckets=(.1, 1))
+    for value in (.05, .1, .5, 2):
+        histogram.observe(value)
+
+    text = metrics.render({'dgs_test_total': counter.snapshot(), 'dgs_test_seconds': histogram.snapshot()})
+    assert text.splitlines() == [
+        '# TYPE dgs_test_seconds histogram',
+        'dgs_test_seconds_bucket{le="0.1"} 2',
+        'dgs_test_seconds_bucket{le="1"} 3',
+        'dgs_test_seconds_bucket{le="+Inf"} 4',
+        'dgs_test_seconds_sum 2.65',
+        'dgs_test_seconds_count 4',
+        '# HELP dgs_test_total Things counted',
+        '# TYPE dgs_test_total counter',
+        'dgs_test_total 3',
+    ]
+
+
+def test_merge_snapshots_adds_up_processes():
+    first, second = metrics.Histogram('h', buckets=(1,)), metrics.Histogram('h', buckets=(1,))
+    first.observe(.5)
+    second.observe(5)
+    counter = metrics.Counter('c')
+    counter.inc(2)
+
+    merged = metrics.merge_snapshots([{'h': first.snapshot(), 'c': counter.snapshot()},
+                                      {'h': second.snapshot(), 'c': counter.snapshot()}])
+    assert merged['c']['value'] == 4
+    assert merged['h']['bucket_counts'] == [1, 1]
+    assert merged['h']['count'] == 2
+
+
+def test_histogram_quantiles():
+    histogram = metrics.Histogram('q')
+    assert histogram.quantile(.5) is None
+    for value in range(100):
+        histogram.observe(value)
+    assert histogram.quantile(.5) == 50
+    assert histogram.quantile(.99) == 99
+
+
+def test_registry_returns_the_same_metric():
+    assert metrics.counter('dgs_test_registry_total') is metrics.counter('dgs_test_registry_total')
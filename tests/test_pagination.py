@@ -0,0 +1,97 @@
+import datetime
+
+import pytest
+
+pytest.importorskip('bson')
+
+
+class FakeCollection:
+    def estimated_document_count(self):
+        return 1000
+
+
+class FakeDocument:
+    @staticmethod
+    def _get_collection():
+        return FakeCollection()
+
+
+class FakeQuerySet:
+    _document = FakeDocument
+
+    def __init__(self, query, total):
+        self._query = query
+        self.total = total
+        self.n_counts = 0
+
+    def count(self):
+        self.n_counts += 1
+        return self.total
+
+
+def test_cursor_round_trip():
+    from dgs.gsserver.pagination import decode_cursor, encode_cursor
+
+    values = ['title', 3, 1.5, None, True, datetime.datetime(2020, 1, 2, 3, 4, 5, tzinfo=datetime.timezone.utc)]
+    assert decode_cursor(encode_cursor(values)) == values
+
+
+@pytest.mark.parametrize('values', [{'a': 1}, [{'$gt': ''}], [['x']]])
+def test_cursor_rejects_operators_and_containers(values):
+    from dgs.gsserver.pagination import decode_cursor, encode_cursor
+
+    with pytest.raises(ValueError):
+        decode_cursor(encode_cursor(values))
+
+
+def test_after_filter_ascending():
+    from dgs.gsserver.pagination import _get_after_filter
+
+    sort_keys = [('title_lower', 'title_lower', 1), ('task_id', '_id', 1)]
+    assert _get_after_filter(sort_keys, ['b', 'id1']) == {'$or': [
+        {'title_lower': {'$gt': 'b'}},
+        {'title_lower': 'b', '_id': {'$gt': 'id1'}},
+    ]}
+
+
+def test_after_filter_descending_keeps_nulls_after_values():
+    from dgs.gsserver.pagination import _get_after_filter
+
+    sort_keys = [('start_time', 'start_time', -1), ('task_id', '_id', -1)]
+    assert _get_after_filter(sort_keys, [5, 'id1']) == {'$or': [
+        {'start_time': {'$not': {'$gte': 5}}},
+        {'start_time': 5, '_id': {'$not': {'$gte': 'id1'}}},
+    ]}
+    # Nothing sorts after null in a descending order but the tie breaker
+    assert _get_after_filter(sort_keys, [None, 'id1']) == {'$or': [
+        {'start_time': None, '_id': {'$not': {'$gte': 'id1'}}},
+    ]}
+
+
+def test_after_filter_ascending_null_is_followed_by_any_value():
+    from dgs.gsserver.pagination import _get_after_filter
+
+    sort_keys = [('end_time', 'end_time', 1), ('task_id', '_id', 1)]
+    assert _get_after_filter(sort_keys, [None, 'id1']) == {'$or': [
+        {'end_time': {'$ne': None}},
+        {'end_time': None, '_id': {'$gt': 'id1'}},
+    ]}
+
+
+def test_count_cache_modes(monkeypatch):
+    from dgs.gsserver import pagination
+
+    now = [100.]
+    monkeypatch.setattr(pagination.time, 'time', lambda: now[0])
+    counts = pagination.CountCache(ttl=10)
+    queryset = FakeQuerySet({'state': 'RUNNING'}, total=7)
+
+    assert counts.count(queryset, 'none') is None
+    assert counts.count(FakeQuerySet({}, total=7)) == 1000
+    assert counts.count(queryset) == 7
+    queryset.total = 8
+    assert counts.count(queryset) == 7
+    assert counts.count(queryset, 'exact') == 8
+    now[0] += 10
+    assert counts.count(queryset) == 8
+    assert queryset.n_counts == 3
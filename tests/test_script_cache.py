@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('pymongo')
+
+
+def make_cache(max_size, max_bytes=None):
+    from dgs.gsserver.script_cache import ScriptCache
+
+    cache = ScriptCache(max_size, max_bytes)
+    evicted = []
+    cache.add_eviction_listener(lambda task_id, is_finished: evicted.append((task_id, is_finished)))
+    return cache, evicted
+
+
+def test_evicts_least_recently_used():
+    cache, evicted = make_cache(2)
+    cache.put(('a',), {})
+    cache.put(('b',), {})
+    assert cache.get(('a',)) is not None
+    cache.put(('c',), {})
+
+    assert cache.get(('b',)) is None
+    assert cache.get(('a',)) is not None
+    assert evicted == [('b', False)]
+    assert cache.stats()['evictions'] == 1
+
+
+def test_evicts_by_bytes_but_keeps_the_last_entry():
+    cache, evicted = make_cache(10, max_bytes=100)
+    cache.put(('a',), {'X': np.zeros(10)})
+    cache.put(('b',), {'X': np.zeros(10)})
+    assert evicted == [('a', False)]
+
+    cache.put(('c',), {'X': np.zeros(100)})
+    assert cache.get(('c',)) is not None
+    assert cache.stats()['size'] == 1
+
+
+def test_memory_mapped_arrays_are_not_counted(tmp_path):
+    path = str(tmp_path / 'X.npy')
+    np.save(path, np.zeros(1000))
+    cache, _ = make_cache(10, max_bytes=100)
+    cache.put(('a',), {'X': np.load(path, mmap_mode='r'), 'y': np.zeros(2)})
+    assert cache.n_bytes == 16
+
+
+def test_invalidate_tells_the_task_is_finished():
+    cache, evicted = make_cache(10)
+    cache.put(('a', 1), {})
+    cache.put(('a', 2), {})
+    cache.put(('b', 1), {})
+    cache.invalidate('a')
+
+    assert evicted == [('a', True)]
+    assert cache.get(('a', 1)) is None
+    assert cache.get(('b', 1)) is not None
+
+
+def test_put_listeners_see_new_entries_only():
+    cache, _ = make_cache(10)
+    added = []
+    cache.add_put_listener(added.append)
+    cache.put(('a',), {})
+    cache.put(('a',), {})
+    assert added == ['a']
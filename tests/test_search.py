@@ -0,0 +1,96 @@
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip('pymongo')
+pytest.importorskip('sklearn.grid_search')
+
+
+def test_halving_plan_divides_candidates_and_multiplies_samples():
+    from dgs.gsserver.search import HalvingSearch
+
+    n_subtasks, rungs = HalvingSearch.plan({'a': list(range(27))}, {'n_samples': 810})
+    assert n_subtasks == 27 + 9 + 3
+    assert [rung['n_candidates'] for rung in rungs] == [27, 9, 3]
+    assert [rung['n_samples'] for rung in rungs] == [90, 270, 810]
+    assert all(rung['n_completed'] == 0 and rung['best_score'] is None for rung in rungs)
+
+
+def test_halving_plan_stops_at_min_samples():
+    from dgs.gsserver.search import HalvingSearch
+
+    n_subtasks, rungs = HalvingSearch.plan({'a': list(range(27))}, {'n_samples': 100})
+    assert n_subtasks == 27 + 9
+    assert [rung['n_samples'] for rung in rungs] == [33, 100]
+
+
+def test_halving_plan_of_a_single_candidate_is_one_full_rung():
+    from dgs.gsserver.search import HalvingSearch
+
+    n_subtasks, rungs = HalvingSearch.plan({'a': [1]}, {'n_samples': 1000, 'factor': 2})
+    assert n_subtasks == 1
+    assert [(rung['n_candidates'], rung['n_samples']) for rung in rungs] == [(1, 1000)]
+
+
+def test_halving_makes_the_next_rung_available_once_the_previous_one_completes():
+    from dgs.gsserver.search import HalvingSearch
+
+    _, rungs = HalvingSearch.plan({'a': list(range(27))}, {'n_samples': 810})
+    task = SimpleNamespace(rungs=rungs)
+    assert HalvingSearch.get_n_available(task) == 27
+
+    rungs[0]['n_completed'] = 27
+    assert HalvingSearch.get_n_available(task) == 36
+
+    rungs[1]['n_completed'] = 9
+    assert HalvingSearch.get_n_available(task) == 39
+
+
+def test_randint_gives_the_bounds_the_weight_of_any_other_value():
+    import numpy as np
+    from dgs.gsserver.search import _Dimension
+
+    dimension = _Dimension({'randint': [1, 3]})
+    values = [dimension.to_value(x) for x in dimension.sample_prior(np.random.RandomState(0), 30000)]
+    counts = np.bincount(values, minlength=4)[1:]
+    assert counts.sum() == 30000
+    assert all(abs(count - 10000) < 500 for count in counts)
+
+
+def test_dimensions_map_samples_back_to_values():
+    from dgs.gsserver.search import _Dimension
+
+    loguniform = _Dimension({'loguniform': [1e-3, 1e3]})
+    assert loguniform.to_value(loguniform.from_value(10.)) == pytest.approx(10.)
+    choice = _Dimension(['a', 'b'])
+    assert choice.to_value(choice.from_value('b')) == 'b'
+    assert choice.from_value('c') is None
+
+
+def test_random_search_is_reproducible_and_within_bounds():
+    from dgs.gsserver.search import RandomSearch
+
+    task = SimpleNamespace(search_params={'param_distributions': {
+        'C': {'loguniform': [0.01, 100]}, 'n': {'randint': [1, 5]}, 'kernel': ['rbf', 'linear']}})
+    candidates = RandomSearch.get_candidates(task, 0, 50)
+    assert candidates == RandomSearch.get_candidates(task, 0, 50)
+    assert candidates != RandomSearch.get_candidates(task, 50, 100)
+    for candidate in candidates:
+        params = candidate['params']
+        assert 0.01 <= params['C'] <= 100
+        assert params['n'] in range(1, 6)
+        assert params['kernel'] in ('rbf', 'linear')
+
+
+def test_tpe_samples_around_good_observations():
+    import numpy as np
+    from dgs.gsserver.search import _Dimension
+
+    dimension = _Dimension({'uniform': [0, 10]})
+    good = np.array([2., 2.1, 1.9])
+    bad = np.array([8., 7.5, 8.5, 9., 6.])
+    x = dimension.sample(good, np.random.RandomState(0), 1000)
+    assert x.min() >= 0 and x.max() <= 10
+    assert np.mean(np.abs(x - 2) < 2) > .5
+    ratio = dimension.log_density(good, x) - dimension.log_density(bad, x)
+    assert x[ratio.argmax()] < 4
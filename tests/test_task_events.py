@@ -0,0 +1,92 @@
+import datetime
+from types import SimpleNamespace
+
+import pytest
+
+for module in ('mongoengine', 'celery', 'sklearn'):
+    pytest.importorskip(module)
+
+
+def make_task(task_id='t1', **fields):
+    values = {'state': 'RUNNING', 'n_subtasks': 10, 'n_completed': 0, 'n_failed': 0, 'best_score': None,
+              'best_params': {}, 'start_time': None, 'end_time': None, 'param_errors': {}, 'runtime_errors': [],
+              'actualize_date': None}
+    values.update(fields)
+    return SimpleNamespace(task_id=task_id, **values)
+
+
+def test_subscription_coalesces_deltas_per_task():
+    from dgs.gsserver.task_events import Subscription
+
+    subscription = Subscription(['t1', 't2'], buffer_size=10)
+    subscription.put({'task_id': 't1', 'n_completed': 1})
+    subscription.put({'task_id': 't3', 'n_completed': 1})
+    subscription.put({'task_id': 't1', 'n_completed': 2, 'state': 'SUCCESS'})
+
+    assert subscription.get(0) == [('task', {'task_id': 't1', 'n_completed': 2, 'state': 'SUCCESS'})]
+    assert subscription.get(0) == []
+
+
+def test_subscription_to_new_tasks_skips_other_pages():
+    from dgs.gsserver.task_events import Subscription
+
+    subscription = Subscription([], buffer_size=10, include_new=True)
+    subscription.put({'task_id': 't1', 'n_completed': 1})
+    subscription.put({'task_id': 't2', 'state': 'VALIDATING'})
+    assert subscription.get(0) == [('task', {'task_id': 't2', 'state': 'VALIDATING'})]
+
+    unfiltered = Subscription([], buffer_size=10)
+    unfiltered.put({'task_id': 't1', 'n_completed': 1})
+    assert unfiltered.get(0) == [('task', {'task_id': 't1', 'n_completed': 1})]
+
+
+def test_lagging_subscription_is_told_to_resync():
+    from dgs.gsserver.task_events import Subscription
+
+    subscription = Subscription([], buffer_size=2)
+    for task_id in ('t1', 't2', 't3'):
+        subscription.put({'task_id': task_id, 'n_completed': 1})
+    subscription.put({'task_id': 't4', 'n_completed': 1})
+
+    assert subscription.get(0) == [('resync', {}), ('task', {'task_id': 't4', 'n_completed': 1})]
+    assert subscription.n_resyncs == 1
+
+
+def test_stream_publishes_changed_fields_only():
+    from dgs.gsserver.task_events import TaskEventStream
+
+    stream = TaskEventStream(buffer_size=10)
+    subscription = stream.subscribe()
+    stream.publish(make_task(state='VALIDATING', best_score=.5))
+    first, = subscription.get(0)
+    assert first[1]['state'] == 'VALIDATING' and 'runtime_errors' in first[1]
+
+    start_time = datetime.datetime(2020, 1, 2, 3, 4, 5)
+    stream.publish(make_task(n_completed=3, best_score=float('nan'), start_time=start_time))
+    assert subscription.get(0) == [('task', {'task_id': 't1', 'state': 'RUNNING', 'n_completed': 3,
+                                             'best_score': None, 'start_time': 'Thu, 02 Jan 2020 03:04:05 GMT'})]
+
+
+def test_stream_sends_actualize_date_only_with_another_change():
+    from dgs.gsserver.task_events import TaskEventStream
+
+    stream = TaskEventStream(buffer_size=10)
+    subscription = stream.subscribe()
+    stream.publish(make_task())
+    subscription.get(0)
+
+    stream.publish(make_task(actualize_date=datetime.datetime(2020, 1, 1)))
+    assert subscription.get(0) == []
+    stream.publish(make_task(actualize_date=datetime.datetime(2020, 1, 2), n_completed=1))
+    (_, delta), = subscription.get(0)
+    assert set(delta) == {'task_id', 'n_completed', 'actualize_date'}
+
+
+def test_stream_forgets_finished_tasks():
+    from dgs.gsserver.task_events import TaskEventStream
+
+    stream = TaskEventStream(buffer_size=10)
+    stream.publish(make_task())
+    assert stream.stats()['n_tracked_tasks'] == 1
+    stream.publish(make_task(state='SUCCESS'))
+    assert stream.stats()['n_tracked_tasks'] == 0
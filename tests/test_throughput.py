@@ -0,0 +1,24 @@
+"""Runs the throughput benchmark on a small grid in eager mode with mongomock."""
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+for module in ('mongomock', 'mongoengine', 'celery', 'flask', 'sklearn'):
+    pytest.importorskip(module)
+
+benchmark = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks', 'throughput.py')
+
+
+def test_eager_benchmark(tmp_path):
+    output = tmp_path / 'results.json'
+    subprocess.run([sys.executable, benchmark, '--grid-sizes', '20', '--resource-rows', '50', '--timeout', '120',
+                    '--output', str(output)], check=True, timeout=300)
+
+    result, = json.loads(output.read_text())['results']
+    assert result['state'] == 'SUCCESS'
+    assert result['n_completed'] == 20
+    assert result['mongo_ops'] > 0
+    assert result['mongo_ops_per_subtask'] is not None